@@ -14,7 +14,12 @@ from .renderers import compact_jsonp_renderer
 from .renderers import pretty_json_renderer
 from .sql import Base
 from .sql import Session
+from .views import configure_postcode_caching
+from demo.api.common.pyramid.timing import mark_validated
+from demo.api.common.utils.replicas import IReadReplicas
+from demo.api.common.utils.replicas import ReadReplicas
 from demo.api.common.utils.settings import sqlalchemy_engine_from_config
+from demo.api.common.utils.settings import sqlalchemy_replicas_from_config
 
 
 def main(global_config, **settings):
@@ -25,21 +30,35 @@ def main(global_config, **settings):
         **settings)
 
     engine = sqlalchemy_engine_from_config(settings)
-    Session.configure(bind=engine)
+    read_engines = sqlalchemy_replicas_from_config(settings)
+    replicas = None
+    if read_engines:
+        replicas = ReadReplicas(read_engines, retry_interval=float(
+            settings.get('sqlalchemy.read.retry_interval', 30)))
+    Session.configure(bind=engine, replicas=replicas)
     Base.metadata.bind = engine
 
+    configure_postcode_caching(settings)
+
     # XXX: Basic authentication and authorization omitted purposefully,
     # unneeded
     config = Configurator(settings=settings,
                           authentication_policy=None,
                           authorization_policy=None)
 
+    if replicas is not None:
+        config.registry.registerUtility(replicas, IReadReplicas)
+
     # Disable Cornice's built-in exception handling
     config.add_settings(handle_exceptions=False)
     config.include('cornice')
     config.include('pyramid_jinja2')
     config.include('pyramid_tm')
     config.include('demo.api.common.pyramid.assets')
+    config.include('demo.api.store')
+    config.include('demo.api.common.utils.cache')
+    config.include('demo.api.common.pyramid.timing')
+    config.include('demo.api.metrics')
     config.include(add_routes)
     config.include(add_views)
     config.include(add_request_methods)
@@ -85,9 +104,11 @@ def add_views(config, proxy_enabled=False):
                     renderer='json')
 
     config.add_view('.views.demo_home', route_name='demo_home',
+                    decorator=multiple('.decorators.read_only',),
                     renderer='home.html')
 
     config.add_view('.views.demo_average', route_name='demo_average',
+                    decorator=multiple('.decorators.read_only',),
                     renderer='average.html')
 
     static_prefix = config.get_settings().get('static.prefix', '')
@@ -123,6 +144,7 @@ def create_cornice_services(path_prefix=''):
     path = lambda original_path: path_prefix + original_path  # noqa
     resolver = DottedNameResolver()
     Service.default_filters = []
+    Service.default_validators = [mark_validated]
 
     # /average
 
@@ -131,11 +153,58 @@ def create_cornice_services(path_prefix=''):
     average.add_view(
         'get', resolver.resolve('.views.get_averages'),
         accept='application/json',
-        decorator=multiple('.decorators.pretty',),
+        decorator=multiple('.decorators.pretty',
+                           '.decorators.read_only'),
         schema=resolver.resolve('.schemas.AverageQuerySchema'),
         permission=None,
         renderer='jsonp')
 
+    # /average/batch
+
+    average_batch = Service('average_batch', path('/average/batch'),
+                            renderer='json')
+
+    average_batch.add_view(
+        'post', resolver.resolve('.views.get_batch_averages'),
+        accept='application/json',
+        decorator=multiple('.decorators.pretty',
+                           '.decorators.read_only'),
+        schema=resolver.resolve('.schemas.AverageBatchQuerySchema'),
+        permission=None,
+        renderer='json')
+
+    # /average/area, /average/district and /average/sector
+
+    rollup_services = []
+    for granularity in ('area', 'district', 'sector'):
+        rollup = Service('average_' + granularity,
+                         path('/average/' + granularity), renderer='json')
+
+        rollup.add_view(
+            'get', resolver.resolve(
+                '.views.get_{}_averages'.format(granularity)),
+            accept='application/json',
+            decorator=multiple('.decorators.pretty',
+                               '.decorators.read_only'),
+            schema=resolver.resolve('.schemas.AverageRollupQuerySchema'),
+            permission=None,
+            renderer='jsonp')
+
+        rollup_services.append(rollup)
+
+    # /cache
+
+    cache = Service('cache', path('/cache'), renderer='json')
+
+    cache.add_view(
+        'get', resolver.resolve('.views.get_cache_stats'),
+        accept='application/json',
+        decorator=multiple('.decorators.pretty',),
+        permission=None,
+        renderer='json')
+
     return [
-        average
-    ]
+        average,
+        average_batch,
+        cache
+    ] + rollup_services
@@ -0,0 +1,125 @@
+"""Helpers shared by the benchmark scripts.
+
+Benchmarks run against a throwaway SQLite database unless a database URL is
+given. They are not part of the test suite.
+"""
+import itertools
+import random
+import string
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+
+from demo.api.models.sql import Base
+from demo.api.models.sql.postcode import PostcodeArea
+from demo.api.models.sql.postcode import PostcodeDistrict
+from demo.api.models.sql.postcode import PostcodeUnit
+from demo.api.models.sql.readings import all_tables
+
+
+class StatementCounter(object):
+    """Counts statements and database time spent by an engine.
+
+    Usage:
+
+        with StatementCounter(engine) as counter:
+            ...
+        counter.count, counter.seconds
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.seconds = 0.0
+        self._started = None
+
+    def _before_cursor_execute(self, *args):
+        self._started = time.perf_counter()
+
+    def _after_cursor_execute(self, *args):
+        self.count += 1
+        self.seconds += time.perf_counter() - self._started
+
+    def __enter__(self):
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute',
+                                self._before_cursor_execute)
+        sqlalchemy.event.listen(self.engine, 'after_cursor_execute',
+                                self._after_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute',
+                                self._before_cursor_execute)
+        sqlalchemy.event.remove(self.engine, 'after_cursor_execute',
+                                self._after_cursor_execute)
+
+
+def generate_postcodes(count, seed=0):
+    """Generate `count` unique postcode parts tuples.
+
+    Returns:
+        A sorted list of (area, district, sector, unit) tuples
+
+    """
+    rng = random.Random(seed)
+    letters = string.ascii_uppercase
+    areas = ['A' + letter for letter in letters] + list(letters)
+    units = [''.join(unit) for unit in itertools.product(letters, repeat=2)]
+
+    postcodes = set()
+    while len(postcodes) < count:
+        postcodes.add((rng.choice(areas), str(rng.randint(1, 99)),
+                       str(rng.randint(0, 9)), rng.choice(units)))
+    return sorted(postcodes)
+
+
+def populate_database(engine, postcodes, years=(2015, 2016), seed=0):
+    """Create the tables and fill every reading table with readings.
+
+    Returns:
+        A list of (area id, district id, sector, unit id) reading keys in the
+        order of `postcodes`
+
+    """
+    rng = random.Random(seed)
+    Base.metadata.create_all(engine)
+
+    ids = {}
+    for model, column, index in ((PostcodeArea, 'area', 0),
+                                 (PostcodeDistrict, 'district', 1),
+                                 (PostcodeUnit, 'unit', 3)):
+        values = sorted(set(postcode[index] for postcode in postcodes))
+        engine.execute(model.__table__.insert(),
+                       [{column: value} for value in values])
+        ids[index] = dict(engine.execute(
+            sqlalchemy.select([getattr(model, column), model.id])).fetchall())
+
+    keys = [(ids[0][area], ids[1][district], sector, ids[3][unit])
+            for area, district, sector, unit in postcodes]
+
+    for table in all_tables.values():
+        engine.execute(table.__table__.insert(), [
+            {'postcode_area_id': area_id,
+             'postcode_district_id': district_id,
+             'postcode_sector': sector,
+             'postcode_unit_id': unit_id,
+             'year': year,
+             'download': round(rng.uniform(0, 100), 1),
+             'upload': round(rng.uniform(0, 20), 1)}
+            for area_id, district_id, sector, unit_id in keys
+            for year in years])
+
+    return keys
+
+
+def create_session(engine):
+    return scoped_session(sessionmaker(bind=engine))
+
+
+def percentile(values, percent):
+    """Get the nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[index]
@@ -0,0 +1,131 @@
+"""Benchmark average lookups for connection=all.
+
+Compares the baked single statement lookup used by the views with the
+previous implementations: one ORM query per reading table with eagerly joined
+postcode parts, and an unbaked UNION ALL query. The in-memory readings store
+is measured as well. The time spent in the database
+driver is reported separately from the time spent in Python.
+
+Usage: benchmark-averages [--postcodes N] [--lookups N] [--database URL]
+
+Options:
+    -h --help          Show this screen
+    --postcodes N      Number of postcodes to populate [default: 10000]
+    --lookups N        Number of lookups to time [default: 2000]
+    --database URL     Database URL to populate. Defaults to a temporary
+                       SQLite database file
+
+Round trips are much cheaper on SQLite than on a networked MySQL server, so
+the latency difference measured on SQLite is a lower bound.
+"""
+import os
+import random
+import tempfile
+import time
+
+from docopt import docopt
+import sqlalchemy
+from sqlalchemy import desc
+from sqlalchemy import literal
+from sqlalchemy.pool import QueuePool
+
+from . import StatementCounter
+from . import generate_postcodes
+from . import percentile
+from . import populate_database
+from demo.api.common.utils import FRIENDLY_CONNECTION_CATEGORIES
+from demo.api.models.sql.readings import all_tables
+from demo.api.sql import Session
+from demo.api.store import ReadingsStore
+from demo.api.views._averages import _get_averages
+
+
+def _get_averages_per_table(categories, postcode_area_id, district_id,
+                            sector, unit_id):
+    """The previous lookup, running one query per table."""
+    results = []
+    for table in [all_tables[category] for category in categories]:
+        entry = (Session.query(table)
+                 .filter(table.postcode_area_id == postcode_area_id,
+                         table.postcode_district_id == district_id,
+                         table.postcode_sector == sector,
+                         table.postcode_unit_id == unit_id)
+                 .order_by(desc(table.year))
+                 .first())
+
+        if entry:
+            results.append({'connection': table.reading_type,
+                            'upload': entry.upload,
+                            'download': entry.download})
+    return results
+
+
+def _get_averages_unbaked(categories, postcode_area_id, district_id, sector,
+                          unit_id):
+    """A UNION ALL lookup built and compiled on every call."""
+    queries = [
+        (Session.query(table)
+         .with_entities(literal(table.reading_type).label('connection'),
+                        table.year, table.download, table.upload)
+         .filter(table.postcode_area_id == postcode_area_id,
+                 table.postcode_district_id == district_id,
+                 table.postcode_sector == sector,
+                 table.postcode_unit_id == unit_id))
+        for table in [all_tables[category] for category in categories]]
+
+    entries = {}
+    for connection, year, download, upload in queries[0].union_all(
+            *queries[1:]):
+        if connection in entries and entries[connection][0] > year:
+            continue
+        entries[connection] = (year, download, upload)
+    return entries
+
+
+def run(engine, name, get_averages, keys):
+    categories = list(FRIENDLY_CONNECTION_CATEGORIES.values())
+    timings = []
+    with StatementCounter(engine) as counter:
+        for key in keys:
+            started = time.perf_counter()
+            get_averages(categories, *key)
+            timings.append(time.perf_counter() - started)
+            Session.remove()
+
+    mean = sum(timings) / len(timings)
+    sql = counter.seconds / len(keys)
+    print('{:<12} {:>8.2f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'
+          ''.format(name, counter.count / len(keys), 1000 * mean,
+                    1000 * (mean - sql), 1000 * sql,
+                    1000 * percentile(timings, 50),
+                    1000 * percentile(timings, 95)))
+
+
+def main():
+    args = docopt(__doc__)
+
+    database = args['--database']
+    if not database:
+        database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(),
+                                               'benchmark.db')
+    engine = sqlalchemy.create_engine(database, poolclass=QueuePool)
+    Session.configure(bind=engine)
+
+    keys = populate_database(
+        engine, generate_postcodes(int(args['--postcodes'])))
+    keys = [random.choice(keys) for _ in range(int(args['--lookups']))]
+
+    print('{:<12} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'lookup', 'queries', 'mean ms', 'py ms', 'sql ms', 'p50 ms',
+        'p95 ms'))
+    run(engine, 'per-table', _get_averages_per_table, keys)
+    run(engine, 'union-all', _get_averages_unbaked, keys)
+    run(engine, 'baked', _get_averages, keys)
+
+    store = ReadingsStore.load(Session())
+    Session.remove()
+    run(engine, 'store', store.get_averages, keys)
+
+
+if __name__ == "__main__":
+    main()
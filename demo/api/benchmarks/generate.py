@@ -0,0 +1,185 @@
+"""Generate synthetic readings csv files.
+
+Usage: benchmark-generate OUTPUT_DIR [--rows ROWS] [--areas AREAS]
+                          [--seed SEED] [--blank-ratio RATIO]
+                          [--new-ratio RATIO]
+
+Options:
+    -h --help               Show this screen
+    -r --rows ROWS          Number of rows of every area file [default: 10000]
+    -a --areas AREAS        Number of postal areas, or comma separated postal
+                            areas [default: 4]
+    -s --seed SEED          Random seed, the same seed writes the same files
+                            [default: 0]
+    --blank-ratio RATIO     Share of blank readings [default: 0.1]
+    --new-ratio RATIO       Share of rows with postcode districts and units
+                            that files written with a new ratio of 0 do not
+                            have [default: 0]
+
+Writes one <area>.csv file per postal area with the default headers of
+demo-api-updatedb, in the format of the Ofcom fixed postcode files. Postcodes
+are written in order, sectors have up to 160 units like real ones and
+districts are added as rows grow, up to 750000 postcodes per area.
+
+Files written with a new ratio of 0 only use a base set of districts and
+units. Importing files written with a positive new ratio on top of them adds
+new districts and units, like a new Ofcom release does.
+"""
+import csv
+import os
+import random
+
+from docopt import docopt
+
+from demo.api.scripts.update_db import DEFAULT_DOWNLOAD_CSV_HEADERS
+from demo.api.scripts.update_db import DEFAULT_UPLOAD_CSV_HEADERS
+from demo.api.scripts.update_db import POSTCODE_CSV_HEADER
+
+
+POSTAL_AREAS = (
+    'AB AL B BA BB BD BH BL BN BR BS BT CA CB CF CH CM CO CR CT CV CW DA DD '
+    'DE DG DH DL DN DT DY E EC EH EN EX FK FY G GL GU HA HD HG HP HR HS HU '
+    'HX IG IP IV KA KT KW KY L LA LD LE LL LN LS LU M ME MK ML N NE NG NN NP '
+    'NR NW OL OX PA PE PH PL PO PR RG RH RM S SA SE SG SK SL SM SN SO SP SR '
+    'SS ST SW SY TA TD TF TN TQ TR TS TW UB W WA WC WD WF WN WR WS WV YO '
+    'ZE').split()
+
+# Letters used in the inward code of real postcodes
+UNIT_LETTERS = 'ABDEFGHJLNPQRSTUWXYZ'
+UNITS = [first + second for first in UNIT_LETTERS for second in UNIT_LETTERS]
+# Units of files without new postcodes, the other units are new
+BASE_UNITS = UNITS[:300]
+NEW_UNITS = UNITS[300:]
+
+DISTRICTS = ([str(number) for number in range(1, 100)] +
+             [str(number) + letter for number in range(1, 10)
+              for letter in UNIT_LETTERS])
+# Districts of files without new postcodes, the other districts are new
+BASE_DISTRICTS = DISTRICTS[:250]
+NEW_DISTRICTS = DISTRICTS[250:]
+SECTORS = [str(sector) for sector in range(10)]
+UNITS_PER_SECTOR = 160
+
+# Ranges of the download and upload readings of every category, in Mbit/s
+READING_RANGES = {
+    '0': ((1, 120), (0.2, 20)),
+    '1': ((0.5, 10), (0.1, 1)),
+    '2': ((1, 24), (0.2, 2)),
+    '3': ((24, 80), (5, 20)),
+    '4': ((300, 1000), (30, 200)),
+}
+
+EXTRA_CSV_HEADERS = ['Number of connections',
+                     '% of premises unable to receive 2Mbit/s']
+
+
+def get_csv_headers():
+    """Get the csv headers of generated files."""
+    return ([POSTCODE_CSV_HEADER] +
+            [header.split(':', 1)[1]
+             for header in DEFAULT_DOWNLOAD_CSV_HEADERS +
+             DEFAULT_UPLOAD_CSV_HEADERS] +
+            EXTRA_CSV_HEADERS)
+
+
+def get_postal_areas(areas):
+    """Get postal areas from a number of areas or comma separated areas."""
+    if areas.isdigit():
+        count = int(areas)
+        if not 0 < count <= len(POSTAL_AREAS):
+            raise ValueError('Invalid number of areas {}, up to {}'
+                             ''.format(count, len(POSTAL_AREAS)))
+        return POSTAL_AREAS[:count]
+    return [area.strip().upper() for area in areas.split(',')]
+
+
+def iter_postcodes(area, rows, rng, new_ratio=0.0):
+    """Iterate the postcodes of an area file in order.
+
+    Base postcodes fill the units of a sector before the next sector and the
+    sectors of a district before the next district. A new_ratio share of the
+    rows is moved to districts after the base districts or to new units.
+    """
+    units_per_sector = min(len(BASE_UNITS), max(
+        UNITS_PER_SECTOR, -(-rows // (len(BASE_DISTRICTS) * len(SECTORS)))))
+    if rows > len(BASE_DISTRICTS) * len(SECTORS) * units_per_sector:
+        raise ValueError('Too many rows {} for postal area {}'
+                         ''.format(rows, area))
+
+    for row in range(rows):
+        district = BASE_DISTRICTS[row // (units_per_sector * len(SECTORS))]
+        sector = SECTORS[row // units_per_sector % len(SECTORS)]
+        unit = BASE_UNITS[row % units_per_sector]
+        if new_ratio and rng.random() < new_ratio:
+            if rng.random() < 0.5:
+                district = rng.choice(NEW_DISTRICTS)
+            else:
+                unit = rng.choice(NEW_UNITS)
+        yield '{}{} {}{}'.format(area, district, sector, unit)
+
+
+def get_readings(rng, blank_ratio):
+    """Get the download and upload readings of a row, with a blank_ratio
+    share of blank readings.
+    """
+    # Download columns come before upload columns, see get_csv_headers
+    readings = []
+    for direction in (0, 1):
+        for category in sorted(READING_RANGES):
+            low, high = READING_RANGES[category][direction]
+            if rng.random() < blank_ratio:
+                readings.append('')
+            else:
+                readings.append(round(rng.uniform(low, high), 1))
+    return readings
+
+
+def write_area_file(filepath, area, rows, rng, blank_ratio, new_ratio):
+    """Write a csv file of readings of a postal area."""
+    with open(filepath, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(get_csv_headers())
+        for postcode in iter_postcodes(area, rows, rng, new_ratio):
+            writer.writerow(
+                [postcode] + get_readings(rng, blank_ratio) +
+                [rng.randint(1, 50), rng.choice(['0', '0', '0', '5', ''])])
+
+
+def generate(output_dir, areas, rows, seed=0, blank_ratio=0.1,
+             new_ratio=0.0):
+    """Write a csv file of readings for every postal area.
+
+    Returns:
+        The paths of the written files
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+
+    filepaths = []
+    for area in areas:
+        filepath = os.path.join(output_dir, '{}.csv'.format(area))
+        write_area_file(filepath, area, rows, rng, blank_ratio, new_ratio)
+        print('Wrote {} rows to {}'.format(rows, filepath))
+        filepaths.append(filepath)
+    return filepaths
+
+
+def main():
+    args = docopt(__doc__)
+
+    rows = int(args['--rows'])
+    if rows < 1:
+        raise ValueError('Invalid rows {}'.format(rows))
+    blank_ratio = float(args['--blank-ratio'])
+    new_ratio = float(args['--new-ratio'])
+    for ratio in (blank_ratio, new_ratio):
+        if not 0 <= ratio <= 1:
+            raise ValueError('Invalid ratio {}'.format(ratio))
+
+    generate(args['OUTPUT_DIR'], get_postal_areas(args['--areas']), rows,
+             int(args['--seed']), blank_ratio, new_ratio)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Benchmark imports end to end.
+
+Generates area csv files (see generate) and runs demo-api-initialisedb and
+demo-api-updatedb in subprocesses against a SQLite database, reporting the
+throughput and peak RSS of every import scenario:
+
+    initial     import into an empty database
+    reimport    import the same files again with --force
+    unchanged   import the same files again, skipped as unchanged
+    update      import a new release with new districts, new units and other
+                readings
+
+Usage: benchmark-ingest [--rows ROWS] [--areas AREAS] [--seed SEED]
+                        [--work-dir DIR] [--output FILE] [--baseline FILE]
+                        [--tolerance PERCENT] [--] [UPDATEDB_ARG...]
+
+Options:
+    -h --help               Show this screen
+    -r --rows ROWS          Number of rows of every area file [default: 50000]
+    -a --areas AREAS        Number of postal areas, or comma separated postal
+                            areas [default: 4]
+    -s --seed SEED          Random seed of the generated files [default: 0]
+    --work-dir DIR          Directory of the database, csv files and import
+                            logs. Defaults to a temporary directory
+    --output FILE           Append the results as a JSON line to FILE
+    --baseline FILE         Compare the throughput with the last results of
+                            a JSON lines file written with --output
+    --tolerance PERCENT     Slowdown against the baseline that fails the
+                            benchmark [default: 10]
+
+Arguments after -- are passed to demo-api-updatedb, e.g.
+'-- --jobs 4 --chunk-size 50000'. The command exits with an error when a
+scenario is slower than the baseline by more than the tolerance.
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+import sqlalchemy
+
+from .generate import generate
+from .generate import get_postal_areas
+
+
+YEAR = '2016'
+
+
+def run_command(args, log_path):
+    """Run a command, appending its output to a log file.
+
+    Returns:
+        A tuple of the wall clock seconds and the peak RSS in MiB
+
+    """
+    with open(log_path, 'a') as log:
+        log.write('$ {}\n'.format(' '.join(args)))
+        log.flush()
+
+        start = time.perf_counter()
+        process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT)
+        # Unlike getrusage, wait4 gives the peak RSS of this process only
+        _, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        # Negative signal numbers like subprocess, e.g. -9 when OOM killed
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+
+    if process.returncode < 0:
+        raise RuntimeError('{} was killed by signal {}, see {}'.format(
+            args[2], -process.returncode, log_path))
+    if process.returncode:
+        raise RuntimeError('{} failed, see {}'.format(args[2], log_path))
+
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin'
+                                   else 1024)
+    return seconds, peak_rss
+
+
+def run_scenarios(work_dir, areas, rows, seed, updatedb_args):
+    """Run the import scenarios in a new database.
+
+    Returns:
+        A mapping of scenario names to their results
+
+    """
+    ini_path = os.path.join(work_dir, 'benchmark.ini')
+    db_path = os.path.join(work_dir, 'benchmark.db')
+    log_path = os.path.join(work_dir, 'benchmark.log')
+    release_dir = os.path.join(work_dir, 'release')
+    update_dir = os.path.join(work_dir, 'update')
+
+    for path in (db_path, log_path):
+        if os.path.exists(path):
+            os.remove(path)
+    with open(ini_path, 'w') as ini_file:
+        ini_file.write('[app:main]\nsqlalchemy.url = sqlite:///{}\n'
+                       ''.format(db_path))
+
+    generate(release_dir, areas, rows, seed)
+    generate(update_dir, areas, rows, seed + 1, new_ratio=0.05)
+
+    run_command([sys.executable, '-m', 'demo.api.scripts.init_db',
+                 ini_path], log_path)
+
+    results = {}
+    for name, csv_dir, args, loaded in (
+            ('initial', release_dir, [], True),
+            ('reimport', release_dir, ['--force'], True),
+            ('unchanged', release_dir, [], False),
+            ('update', update_dir, [], True)):
+        seconds, peak_rss = run_command(
+            [sys.executable, '-m', 'demo.api.scripts.update_db', ini_path,
+             YEAR, csv_dir] + args + updatedb_args, log_path)
+        scenario_rows = rows * len(areas) if loaded else 0
+        results[name] = {
+            'rows': scenario_rows,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(scenario_rows / seconds, 1),
+            'peak_rss_mib': round(peak_rss, 1)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the throughput change of every scenario against a baseline.
+
+    Returns:
+        The names of the scenarios slower than the tolerance
+
+    """
+    regressions = []
+    print('{:<12} {:>12} {:>12} {:>8}'.format(
+        'scenario', 'rows/s', 'baseline', 'change'))
+    for name, result in results.items():
+        baseline_rate = baseline['scenarios'].get(name, {}).get(
+            'rows_per_second')
+        if not result['rows'] or not baseline_rate:
+            continue
+
+        change = 100.0 * (result['rows_per_second'] / baseline_rate - 1)
+        print('{:<12} {:>12.0f} {:>12.0f} {:>+7.1f}%'.format(
+            name, result['rows_per_second'], baseline_rate, change))
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def read_baseline(path):
+    with open(path) as baseline_file:
+        lines = [line for line in baseline_file if line.strip()]
+    if not lines:
+        raise ValueError('No results in baseline {}'.format(path))
+    return json.loads(lines[-1])
+
+
+def main():
+    args = docopt(__doc__)
+
+    rows = int(args['--rows'])
+    areas = get_postal_areas(args['--areas'])
+    seed = int(args['--seed'])
+    tolerance = float(args['--tolerance'])
+    updatedb_args = args['UPDATEDB_ARG']
+    baseline = args['--baseline'] and read_baseline(args['--baseline'])
+
+    work_dir = args['--work-dir'] or tempfile.mkdtemp()
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = run_scenarios(work_dir, areas, rows, seed, updatedb_args)
+
+    print('{:<12} {:>10} {:>10} {:>12} {:>10}'.format(
+        'scenario', 'rows', 'seconds', 'rows/s', 'peak MiB'))
+    for name, result in results.items():
+        print('{:<12} {:>10} {:>10.2f} {:>12.0f} {:>10.1f}'.format(
+            name, result['rows'], result['seconds'],
+            result['rows_per_second'], result['peak_rss_mib']))
+
+    record = {
+        'time': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'rows': rows,
+        'areas': len(areas),
+        'seed': seed,
+        'updatedb_args': updatedb_args,
+        'scenarios': results}
+    if args['--output']:
+        with open(args['--output'], 'a') as output_file:
+            output_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    if baseline:
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            print('Slower than the baseline by more than {}%: {}'
+                  ''.format(tolerance, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Benchmark requests end to end.
+
+Populates a database and sends requests to the WSGI application of
+demo.api:main in process, through routing, validation, views, renderers and
+pyramid_tm, reporting the latency percentiles and throughput of every
+request scenario:
+
+    average     /api/average of a postcode
+    all         /api/average of a postcode with connection=all
+    invalid     /api/average of an invalid postcode
+    unknown     /api/average of a valid postcode missing from the database
+    demo        /demo_average page of a postcode with connection=all
+
+Usage: benchmark-latency [--postcodes N] [--requests N] [--warmup N]
+                         [--database URL] [--setting SETTING]...
+                         [--output FILE]
+
+Options:
+    -h --help          Show this screen
+    --postcodes N      Number of postcodes to populate [default: 10000]
+    --requests N       Number of requests to time per scenario [default: 2000]
+    --warmup N         Number of untimed requests per scenario [default: 100]
+    --database URL     Database URL to populate. Defaults to a temporary
+                       SQLite database file
+    --setting SETTING  Application setting as KEY=VALUE, e.g.
+                       store.enabled=true. Can be repeated
+    --output FILE      Append the results as a JSON line to FILE, to compare
+                       them across commits
+
+No server or network is involved, so the latency is the cost of the
+application and the database only.
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from docopt import docopt
+import sqlalchemy
+from webob import Request
+
+from . import generate_postcodes
+from . import percentile
+from . import populate_database
+from demo.api import main as make_app
+
+
+def format_postcode(postcode):
+    area, district, sector, unit = postcode
+    return '{}{}{}{}'.format(area, district, sector, unit)
+
+
+def get_scenarios(postcodes, count, seed=0):
+    """Get the paths of the requests of every scenario.
+
+    Returns:
+        A list of (name, paths) tuples
+
+    """
+    rng = random.Random(seed)
+    sample = [format_postcode(rng.choice(postcodes)) for _ in range(count)]
+    return [
+        ('average', ['/api/average?postcode={}'.format(postcode)
+                     for postcode in sample]),
+        ('all', ['/api/average?postcode={}&connection=all'.format(postcode)
+                 for postcode in sample]),
+        ('invalid', ['/api/average?postcode=X{}X'.format(index)
+                     for index in range(count)]),
+        # Area ZZ is never generated
+        ('unknown', ['/api/average?postcode=ZZ{}'.format(postcode[2:])
+                     for postcode in sample]),
+        ('demo', ['/demo_average?postcode={}&connection=all'.format(postcode)
+                  for postcode in sample]),
+    ]
+
+
+def send(app, path):
+    request = Request.blank(path, headers={'Accept': 'application/json'})
+    response = request.get_response(app)
+    if response.status_code not in (200, 400):
+        raise RuntimeError('{} failed with {}'.format(path, response.status))
+    return response
+
+
+def run(app, name, paths, warmup):
+    for path in paths[:warmup]:
+        send(app, path)
+
+    timings = []
+    started = time.perf_counter()
+    for path in paths:
+        request_started = time.perf_counter()
+        send(app, path)
+        timings.append(time.perf_counter() - request_started)
+    seconds = time.perf_counter() - started
+
+    result = {'requests': len(paths),
+              'requests_per_second': round(len(paths) / seconds, 1)}
+    for percent in (50, 95, 99):
+        result['p{}_ms'.format(percent)] = round(
+            1000 * percentile(timings, percent), 3)
+    print('{:<10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.0f}'.format(
+        name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+        result['requests_per_second']))
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = docopt(__doc__)
+
+    database = args['--database']
+    if not database:
+        database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(),
+                                               'benchmark.db')
+    # Without a static prefix the static view shadows the API routes
+    settings = {'static.prefix': 'assets'}
+    settings.update(setting.split('=', 1) for setting in args['--setting'])
+    settings['sqlalchemy.url'] = database
+
+    postcodes = generate_postcodes(int(args['--postcodes']))
+    populate_database(sqlalchemy.create_engine(database), postcodes)
+
+    app = make_app({}, **settings)
+
+    print('{:<10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    results = {}
+    for name, paths in get_scenarios(postcodes, int(args['--requests'])):
+        results[name] = run(app, name, paths, int(args['--warmup']))
+
+    if args['--output']:
+        record = {
+            'time': datetime.datetime.utcnow().isoformat() + 'Z',
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'postcodes': len(postcodes),
+            'settings': settings,
+            'scenarios': results}
+        with open(args['--output'], 'a') as output_file:
+            output_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Per-request timing for Pyramid apps.
+
+Include the module in Pyramid and enable timing in the ini file:
+
+    config.include('demo.api.common.pyramid.timing')
+
+    timing.enabled = true
+    # Share of requests timed, e.g. 0.01 to time 1% of production requests
+    timing.sample_rate = 1
+    # Send the timings in a Server-Timing response header
+    timing.header = true
+
+Timed requests split their time into phases (see PhaseTimer):
+
+    sql         -- time spent executing SQL statements, of any engine
+    validate    -- cornice schema validation
+    view        -- view callables, excluding the other phases
+    serialize   -- colander serialization of results, see timed_phase
+    render      -- renderers and templates
+    app         -- everything else, e.g. routing, tweens and committing
+
+The phases and the number of SQL statements are sent in a `Server-Timing`
+header, in milliseconds, and logged on a single line of key=value pairs:
+
+    Server-Timing: sql;dur=0.412;desc="3 queries", validate;dur=0.081, ...
+"""
+import contextlib
+import logging
+import random
+import threading
+import time
+
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+from demo.api.common.utils.timers import PhaseTimer
+
+_logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestTimer(PhaseTimer):
+    """Phase timer of a request.
+
+    Attributes:
+    queries -- Number of SQL statements executed
+    started -- perf_counter value at the start of the request
+
+    """
+
+    def __init__(self):
+        super(RequestTimer, self).__init__()
+        self.queries = 0
+        self.started = time.perf_counter()
+        self._statement_started = None
+        self._view_started = None
+
+    def server_timing(self, total):
+        """Format the phases as a Server-Timing header value."""
+        metrics = []
+        for name, seconds in self.durations.items():
+            metric = '{};dur={:.3f}'.format(name, 1000 * seconds)
+            if name == 'sql':
+                metric += ';desc="{} queries"'.format(self.queries)
+            metrics.append(metric)
+        metrics.append('total;dur={:.3f}'.format(1000 * total))
+        return ', '.join(metrics)
+
+
+def get_request_timer():
+    """Get the timer of the request handled by this thread, None when the
+    request is not timed.
+    """
+    return getattr(_local, 'timer', None)
+
+
+def timed_phase(name):
+    """Time the enclosed block as a phase of the current request, if any."""
+    timer = get_request_timer()
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.phase(name)
+
+
+def mark_validated(request):
+    """Cornice validator ending the validation phase.
+
+    Cornice runs validators after schema validation and before the view, so
+    the time since the view pipeline started is validation.
+    """
+    timer = get_request_timer()
+    if timer is not None and timer._view_started is not None:
+        timer.add('validate', time.perf_counter() - timer._view_started)
+        timer._view_started = None
+
+
+def _before_cursor_execute(*args):
+    timer = get_request_timer()
+    if timer is not None:
+        timer._statement_started = time.perf_counter()
+
+
+def _after_cursor_execute(*args):
+    timer = get_request_timer()
+    if timer is not None and timer._statement_started is not None:
+        timer.queries += 1
+        timer.add('sql', time.perf_counter() - timer._statement_started)
+        timer._statement_started = None
+
+
+def timed_render_view(view, info):
+    """View deriver timing renderers, placed above rendered_view."""
+    def wrapped(context, request):
+        timer = get_request_timer()
+        if timer is None:
+            return view(context, request)
+        with timer.phase('render'):
+            return view(context, request)
+    return wrapped
+
+
+def timed_view(view, info):
+    """View deriver timing view callables, placed below rendered_view."""
+    def wrapped(context, request):
+        timer = get_request_timer()
+        if timer is None:
+            return view(context, request)
+        timer._view_started = time.perf_counter()
+        with timer.phase('view'):
+            return view(context, request)
+    return wrapped
+
+
+def format_log_line(request, response, timer, total):
+    fields = [('method', request.method),
+              ('path', request.path),
+              ('status', response.status_int),
+              ('queries', timer.queries),
+              ('total_ms', '{:.3f}'.format(1000 * total))]
+    fields.extend(('{}_ms'.format(name), '{:.3f}'.format(1000 * seconds))
+                  for name, seconds in timer.durations.items())
+    return ' '.join('{}={}'.format(key, value) for key, value in fields)
+
+
+def timing_tween_factory(handler, registry):
+    settings = registry.settings or {}
+    sample_rate = float(settings.get('timing.sample_rate', 1))
+    send_header = asbool(settings.get('timing.header', True))
+
+    def timing_tween(request):
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return handler(request)
+
+        timer = RequestTimer()
+        _local.timer = timer
+        try:
+            response = handler(request)
+        finally:
+            _local.timer = None
+
+        total = time.perf_counter() - timer.started
+        timer.add('app', max(total - timer.total, 0.0))
+        if send_header:
+            response.headers['Server-Timing'] = timer.server_timing(total)
+        _logger.info(format_log_line(request, response, timer, total))
+        return response
+
+    return timing_tween
+
+
+def includeme(config):
+    settings = config.get_settings()
+    if not asbool(settings.get('timing.enabled', False)):
+        return
+
+    # Listen on the Engine class to time the statements of every engine
+    for identifier, listener in (
+            ('before_cursor_execute', _before_cursor_execute),
+            ('after_cursor_execute', _after_cursor_execute)):
+        if not sqlalchemy.event.contains(Engine, identifier, listener):
+            sqlalchemy.event.listen(Engine, identifier, listener)
+
+    config.add_view_deriver(timed_render_view, 'timed_render_view',
+                            under='decorated_view', over='rendered_view')
+    config.add_view_deriver(timed_view, 'timed_view',
+                            under='rendered_view', over='mapped_view')
+    # Outermost, so the time of pyramid_tm committing is included
+    config.add_tween('demo.api.common.pyramid.timing.timing_tween_factory',
+                     under=INGRESS)
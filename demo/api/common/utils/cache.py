@@ -0,0 +1,210 @@
+"""In-process response cache.
+
+Include the module in Pyramid and enable the cache in the ini file:
+
+    config.include('demo.api.common.utils.cache')
+
+    cache.enabled = true
+    cache.max_entries = 10000
+    cache.ttl = 300
+    cache.stale_ttl = 60
+    cache.max_refreshes = 100
+
+Views get the cache with `request.registry.queryUtility(IResponseCache)`,
+None when it is disabled.
+"""
+from collections import OrderedDict
+import logging
+import queue
+import threading
+import time
+
+from pyramid.settings import asbool
+from zope.interface import implementer
+from zope.interface import Interface
+
+_logger = logging.getLogger(__name__)
+
+
+class IResponseCache(Interface):
+    pass
+
+
+@implementer(IResponseCache)
+class ResponseCache(object):
+    """A bounded, thread-safe LRU cache with a time to live per entry.
+
+    Entries belong to a dataset generation, all entries are dropped when a
+    lookup is made with a newer generation. Values of older generations are
+    never cached.
+
+    Entries older than `ttl` seconds are stale. Stale entries younger than
+    `ttl + stale_ttl` seconds are still served while a single background
+    thread recomputes them one at a time (stale-while-revalidate). At most
+    `max_refreshes` entries wait to be recomputed, when more entries are
+    stale at once the others are revalidated by later lookups.
+
+        max_entries: the maximum number of entries, least recently used
+                     entries are evicted first
+        ttl: seconds an entry is fresh
+        stale_ttl: seconds a stale entry may be served while revalidating
+        max_refreshes: the maximum number of entries waiting to be
+                       recomputed
+
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0, stale_ttl=0.0,
+                 max_refreshes=100):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.generation = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._refreshes = queue.Queue(max_refreshes)
+        self._refresh_thread = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_outdated(self, generation):
+        return self.generation is not None and generation < self.generation
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.generation = generation
+
+    def _store(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key, value, generation):
+        with self._lock:
+            # Computed before lookups moved the cache to a new generation
+            if self._is_outdated(generation):
+                return
+            self._check_generation(generation)
+            self._store(key, value)
+
+    def get(self, key, generation, compute, refresh=None):
+        """Get a cached value, computing it on a miss.
+
+            key: a hashable cache key
+            generation: the current dataset generation
+            compute: a function computing the value in the calling thread
+            refresh: a function computing the value in a background thread
+                     when a stale value is served, e.g. within its own
+                     database transaction. Defaults to `compute`
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            # Values of an older generation are computed, not cached
+            entry = None
+            if not self._is_outdated(generation):
+                self._check_generation(generation)
+                entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if now < expires + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    if now < expires:
+                        self.hits += 1
+                        return value
+
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._queue_refresh(key, generation,
+                                            refresh or compute)
+                    return value
+
+                del self._entries[key]
+            self.misses += 1
+
+        value = compute()
+        self.set(key, value, generation)
+        return value
+
+    def _queue_refresh(self, key, generation, refresh):
+        # Called with the lock held
+        try:
+            self._refreshes.put_nowait((key, generation, refresh))
+        except queue.Full:
+            return
+        self._refreshing.add(key)
+
+        # Threads do not survive forking, e.g. into worker processes
+        if (self._refresh_thread is None or
+                not self._refresh_thread.is_alive()):
+            self._refresh_thread = threading.Thread(
+                target=self._run_refreshes, name='response-cache-refresh',
+                daemon=True)
+            self._refresh_thread.start()
+
+    def _run_refreshes(self):
+        while True:
+            key, generation, refresh = self._refreshes.get()
+            try:
+                self._revalidate(key, generation, refresh)
+            finally:
+                self._refreshes.task_done()
+
+    def wait_for_refreshes(self):
+        """Block until the queued entries are recomputed."""
+        self._refreshes.join()
+
+    def _revalidate(self, key, generation, refresh):
+        try:
+            value = refresh()
+        except Exception:
+            _logger.exception('Failed to revalidate cache entry {!r}'
+                              ''.format(key))
+        else:
+            with self._lock:
+                # Lookups may have moved the cache to a new generation
+                # during the refresh, the value must not clear their entries
+                if generation == self.generation:
+                    self._store(key, value)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'max_entries': self.max_entries,
+                    'generation': self.generation,
+                    'hits': self.hits,
+                    'stale_hits': self.stale_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+
+
+def includeme(config):
+    settings = config.get_settings()
+    if not asbool(settings.get('cache.enabled', False)):
+        return
+
+    cache = ResponseCache(
+        max_entries=int(settings.get('cache.max_entries', 10000)),
+        ttl=float(settings.get('cache.ttl', 300)),
+        stale_ttl=float(settings.get('cache.stale_ttl', 0)),
+        max_refreshes=int(settings.get('cache.max_refreshes', 100)))
+    config.registry.registerUtility(cache, IResponseCache)
@@ -0,0 +1,140 @@
+import datetime
+
+from sqlalchemy.orm import scoped_session
+from zope.sqlalchemy import mark_changed
+
+from demo.api.models.sql.dataset import DatasetGeneration
+from demo.api.models.sql.dataset import ImportedFile
+from demo.api.models.sql.dataset import PostcodeAreaVersion
+from demo.api.models.sql.postcode import PostcodeArea
+
+DATASET_GENERATION_ID = 1
+
+
+def mark_session_changed(session):
+    """Mark a session, or the session of a scoped session, as changed.
+
+    Statements executed outside the ORM unit of work are not tracked, the
+    transaction would not commit them otherwise.
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    mark_changed(session)
+
+
+def get_dataset_generation(session):
+    """Get the dataset generation, 0 before the first import."""
+    generation = (session.query(DatasetGeneration.generation)
+                  .filter(DatasetGeneration.id == DATASET_GENERATION_ID)
+                  .scalar())
+    return generation or 0
+
+
+def ensure_dataset_generation(session):
+    """Add the dataset generation row at generation 0 when it is missing.
+
+    Concurrent imports must add the row before they start, otherwise each
+    of them inserts it in increment_dataset_generation and all but one fail.
+    """
+    table = DatasetGeneration.__table__
+    if session.query(DatasetGeneration.id).filter(
+            DatasetGeneration.id == DATASET_GENERATION_ID).scalar() is None:
+        session.execute(table.insert().values(
+            id=DATASET_GENERATION_ID, generation=0,
+            modified=datetime.datetime.utcnow()))
+        mark_session_changed(session)
+
+
+def increment_dataset_generation(session):
+    """Increment the dataset generation.
+
+    The generation row stays locked until the transaction ends, so concurrent
+    imports commit distinct generations. The row is added by the first
+    import, concurrent imports must add it up front with
+    ensure_dataset_generation.
+
+    Returns:
+        The new generation
+
+    """
+    table = DatasetGeneration.__table__
+    modified = datetime.datetime.utcnow()
+
+    result = session.execute(
+        table.update()
+        .where(table.c.id == DATASET_GENERATION_ID)
+        .values(generation=table.c.generation + 1, modified=modified))
+    if not result.rowcount:
+        session.execute(table.insert().values(
+            id=DATASET_GENERATION_ID, generation=1, modified=modified))
+    mark_session_changed(session)
+
+    return get_dataset_generation(session)
+
+
+def get_postcode_area_versions(session):
+    """Get the versions of postcode areas.
+
+    Returns:
+        A mapping of postcode areas to tuples of the dataset generation and
+        time (UTC) of their last change
+
+    """
+    return {area: (generation, modified)
+            for area, generation, modified in (
+                session.query(PostcodeArea.area,
+                              PostcodeAreaVersion.generation,
+                              PostcodeAreaVersion.modified)
+                .join(PostcodeAreaVersion,
+                      PostcodeAreaVersion.postcode_area_id ==
+                      PostcodeArea.id))}
+
+
+def set_postcode_area_version(session, postcode_area_id, generation):
+    """Set the version of a postcode area to a dataset generation."""
+    table = PostcodeAreaVersion.__table__
+    modified = datetime.datetime.utcnow()
+
+    result = session.execute(
+        table.update()
+        .where(table.c.postcode_area_id == postcode_area_id)
+        .values(generation=generation, modified=modified))
+    if not result.rowcount:
+        session.execute(table.insert().values(
+            postcode_area_id=postcode_area_id, generation=generation,
+            modified=modified))
+    mark_session_changed(session)
+
+
+def get_imported_files(session, year):
+    """Get the files committed for a year.
+
+    Returns:
+        A mapping of file names to tuples of the content and header mapping
+        hashes
+
+    """
+    return {filename: (content_hash, mapping_hash)
+            for filename, content_hash, mapping_hash in (
+                session.query(ImportedFile.filename,
+                              ImportedFile.content_hash,
+                              ImportedFile.mapping_hash)
+                .filter(ImportedFile.year == year))}
+
+
+def set_imported_file(session, filename, year, content_hash, mapping_hash):
+    """Record the hashes of a file committed for a year."""
+    table = ImportedFile.__table__
+    modified = datetime.datetime.utcnow()
+
+    result = session.execute(
+        table.update()
+        .where(table.c.filename == filename)
+        .where(table.c.year == year)
+        .values(content_hash=content_hash, mapping_hash=mapping_hash,
+                modified=modified))
+    if not result.rowcount:
+        session.execute(table.insert().values(
+            filename=filename, year=year, content_hash=content_hash,
+            mapping_hash=mapping_hash, modified=modified))
+    mark_session_changed(session)
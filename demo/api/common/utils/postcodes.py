@@ -1,11 +1,21 @@
+from bisect import bisect_left
+from collections import namedtuple
 import re
+import threading
+import time
 
 from demo.api.models.sql.postcode import PostcodeArea
 from demo.api.models.sql.postcode import PostcodeUnit
 from demo.api.models.sql.postcode import PostcodeDistrict
+from demo.api.common.utils.dataset import get_dataset_generation
 
 postcode_regex = re.compile(
     r'^([A-Z]{1,2})([0-9]{1,2}|[0-9][A-Z])\s*([0-9])([A-Z]{2})$')
+postcode_prefix_regexes = {
+    'area': re.compile(r'^([A-Z]{1,2})$'),
+    'district': re.compile(r'^([A-Z]{1,2})([0-9]{1,2}|[0-9][A-Z])$'),
+    'sector': re.compile(
+        r'^([A-Z]{1,2})([0-9]{1,2}|[0-9][A-Z])\s*([0-9])$')}
 
 
 def get_postcode_areas(session):
@@ -26,7 +36,215 @@ def get_postcode_units(session):
             .all())
 
 
+PostcodeParts = namedtuple('PostcodeParts',
+                           ['generation', 'areas', 'districts', 'units',
+                            'area_versions'])
+
+
+class PostcodeCache(object):
+    """Postcode part ids cached per dataset generation.
+
+    The areas, districts, units and area versions mappings (see
+    demo.api.common.utils.dataset.get_postcode_area_versions) are loaded
+    together and replaced
+    atomically as a PostcodeParts tuple, requests holding the previous tuple
+    keep using it. The dataset generation is checked at most every
+    `check_interval` seconds and the mappings are reloaded when it changed.
+    While one thread reloads, other threads carry on with the previous
+    mappings instead of waiting.
+
+        loader: a function called with a session returning the areas,
+                districts, units and area versions mappings
+        check_interval: seconds between dataset generation checks
+
+    """
+
+    def __init__(self, loader, check_interval=5.0):
+        self.loader = loader
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._parts = None
+        self._checked = None
+
+    def clear(self):
+        with self._lock:
+            self._parts = None
+            self._checked = None
+
+    @property
+    def parts(self):
+        """The current PostcodeParts, None before the first lookup."""
+        return self._parts
+
+    def _is_fresh(self):
+        return (self._parts is not None and
+                time.monotonic() - self._checked < self.check_interval)
+
+    def get(self, session):
+        """Get the current PostcodeParts."""
+        parts = self._parts
+        if self._is_fresh():
+            return parts
+
+        if not self._lock.acquire(blocking=parts is None):
+            return parts
+
+        try:
+            if self._is_fresh():
+                return self._parts
+
+            generation = get_dataset_generation(session)
+            parts = self._parts
+            if parts is None or parts.generation != generation:
+                parts = PostcodeParts(generation, *self.loader(session))
+                self._parts = parts
+            self._checked = time.monotonic()
+            return parts
+        finally:
+            self._lock.release()
+
+
 def split_postcode(postcode):
     postcode = postcode.upper() if postcode else postcode
     parts = postcode_regex.match(postcode)
     return parts.groups() if parts else None
+
+
+def split_postcode_prefix(postcode, granularity):
+    """Split a partial postcode, e.g. 'AB10' or 'AB10 1'.
+
+        postcode: the partial postcode
+        granularity: 'area', 'district' or 'sector'
+
+    Returns:
+        A tuple of the postcode parts up to the granularity or None when
+        the postcode is invalid
+
+    """
+    postcode = postcode.upper() if postcode else postcode
+    parts = postcode_prefix_regexes[granularity].match(postcode)
+    return parts.groups() if parts else None
+
+
+# Packed postcode keys
+#
+# The four postcode parts are packed into a single integer using a mixed radix
+# per part:
+#
+#     area      702 values, a letter and an optional second letter
+#     district  370 values, a digit and an optional digit or letter
+#     sector     10 values, a digit
+#     unit      676 values, two letters
+#
+# Keys are below 2 ** 31 and fit a signed 32 bit integer. Keys sort by area,
+# district, sector and unit, so every area, district and sector covers a
+# contiguous range of keys.
+
+_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_DIGITS = '0123456789'
+_DISTRICT_SUFFIXES = _DIGITS + _LETTERS
+
+_AREA_SIZE = 26 * 27
+_DISTRICT_SIZE = 10 * 37
+_SECTOR_SIZE = 10
+_UNIT_SIZE = 26 * 26
+
+POSTCODE_KEY_LIMIT = _AREA_SIZE * _DISTRICT_SIZE * _SECTOR_SIZE * _UNIT_SIZE
+
+
+def _pack_area(area):
+    value = _LETTERS.index(area[0]) * 27
+    if len(area) > 1:
+        value += _LETTERS.index(area[1]) + 1
+    return value
+
+
+def _pack_district(district):
+    value = _DIGITS.index(district[0]) * 37
+    if len(district) > 1:
+        value += _DISTRICT_SUFFIXES.index(district[1]) + 1
+    return value
+
+
+def _pack_unit(unit):
+    return _LETTERS.index(unit[0]) * 26 + _LETTERS.index(unit[1])
+
+
+def pack_postcode(postcode_parts):
+    """Pack postcode parts, as returned by split_postcode, into an integer."""
+    area, district, sector, unit = postcode_parts
+    key = _pack_area(area)
+    key = key * _DISTRICT_SIZE + _pack_district(district)
+    key = key * _SECTOR_SIZE + _DIGITS.index(sector)
+    return key * _UNIT_SIZE + _pack_unit(unit)
+
+
+def unpack_postcode(key):
+    """Unpack an integer made by pack_postcode into postcode parts."""
+    key, unit = divmod(key, _UNIT_SIZE)
+    key, sector = divmod(key, _SECTOR_SIZE)
+    area, district = divmod(key, _DISTRICT_SIZE)
+
+    area_first, area_second = divmod(area, 27)
+    area = _LETTERS[area_first] + (
+        _LETTERS[area_second - 1] if area_second else '')
+
+    district_first, district_second = divmod(district, 37)
+    district = _DIGITS[district_first] + (
+        _DISTRICT_SUFFIXES[district_second - 1] if district_second else '')
+
+    unit_first, unit_second = divmod(unit, 26)
+    return (area, district, _DIGITS[sector],
+            _LETTERS[unit_first] + _LETTERS[unit_second])
+
+
+def postcode_key_range(area, district=None, sector=None):
+    """Get the range of packed keys within an area, district or sector.
+
+    Returns:
+        A (start, stop) tuple, stop is exclusive
+
+    """
+    start = _pack_area(area)
+    size = _DISTRICT_SIZE * _SECTOR_SIZE * _UNIT_SIZE
+    if district is not None:
+        start = start * _DISTRICT_SIZE + _pack_district(district)
+        size = _SECTOR_SIZE * _UNIT_SIZE
+        if sector is not None:
+            start = start * _SECTOR_SIZE + _DIGITS.index(sector)
+            size = _UNIT_SIZE
+    elif sector is not None:
+        raise ValueError('A sector requires a district')
+
+    start *= size
+    return start, start + size
+
+
+class PostcodeIndex(object):
+    """A sorted array of packed postcode keys.
+
+    Maps packed keys to row numbers with binary searches. Rows of an area,
+    district or sector are contiguous.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def find(self, key):
+        """Get the row of a key or None if the key is missing."""
+        row = bisect_left(self.keys, key)
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        return None
+
+    def find_range(self, area, district=None, sector=None):
+        """Get the rows of an area, district or sector as a range."""
+        start, stop = postcode_key_range(area, district, sector)
+        return range(bisect_left(self.keys, start),
+                     bisect_left(self.keys, stop))
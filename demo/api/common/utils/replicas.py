@@ -0,0 +1,124 @@
+"""Read replica routing.
+
+Sessions created with RoutingSession send the statements of read-only
+sessions to read replica engines and all others to their bind, the primary:
+
+    Session = scoped_session(sessionmaker(class_=RoutingSession))
+    Session.configure(bind=primary,
+                      replicas=ReadReplicas([replica1, replica2]))
+
+    Session().info['read_only'] = True
+
+Each read-only session uses a single replica, replicas are chosen
+round-robin. The chosen replica is connected to once before the session uses
+it; a replica failing to connect is skipped for `retry_interval` seconds and
+the session fails over to the next replica, or to the primary when every
+replica failed.
+"""
+import logging
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+from zope.interface import implementer
+from zope.interface import Interface
+
+_logger = logging.getLogger(__name__)
+
+
+class IReadReplicas(Interface):
+    pass
+
+
+@implementer(IReadReplicas)
+class ReadReplicas(object):
+    """Read replica engines chosen round-robin.
+
+        engines: the replica engines
+        retry_interval: seconds a failed replica is skipped
+
+    """
+
+    def __init__(self, engines, retry_interval=30.0):
+        self.engines = list(engines)
+        self.retry_interval = retry_interval
+        self._next = 0
+        self._failed = {}
+        self._lock = threading.Lock()
+
+        for engine in self.engines:
+            sqlalchemy.event.listen(engine, 'handle_error',
+                                    self._handle_error)
+
+    def _handle_error(self, context):
+        # Disconnects while executing, connection errors are handled by
+        # choose_connectable
+        if context.is_disconnect:
+            self.mark_failed(context.engine)
+
+    def choose(self):
+        """Get the next replica that did not fail recently, None when every
+        replica failed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for offset in range(len(self.engines)):
+                index = (self._next + offset) % len(self.engines)
+                engine = self.engines[index]
+                if self._failed.get(engine, 0) <= now:
+                    self._next = index + 1
+                    return engine
+        return None
+
+    def choose_connectable(self):
+        """Get the next replica accepting a connection, None when every
+        replica failed.
+
+        The connection is returned to the pool of the replica right away,
+        the session using the replica checks it out again.
+        """
+        while True:
+            engine = self.choose()
+            if engine is None:
+                return None
+            try:
+                engine.connect().close()
+            except sqlalchemy.exc.DBAPIError:
+                self.mark_failed(engine)
+            else:
+                return engine
+
+    def mark_failed(self, engine):
+        _logger.warning('Read replica {!r} failed, skipping it for {}s'
+                        ''.format(engine.url, self.retry_interval))
+        with self._lock:
+            self._failed[engine] = time.monotonic() + self.retry_interval
+
+
+class RoutingSession(Session):
+    """A session routing read-only sessions to read replicas.
+
+    A session is read-only while its `info['read_only']` is true, see
+    demo.api.decorators.read_only. The replica of the session is kept in
+    `info['read_engine']`.
+
+        replicas: the ReadReplicas, None to use the bind only
+
+    """
+
+    def __init__(self, replicas=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replicas is None or not self.info.get('read_only'):
+            return super(RoutingSession, self).get_bind(
+                mapper, clause, **kwargs)
+
+        engine = self.info.get('read_engine')
+        if engine is None:
+            engine = self.replicas.choose_connectable() or super(
+                RoutingSession, self).get_bind(mapper, clause, **kwargs)
+            self.info['read_engine'] = engine
+        return engine
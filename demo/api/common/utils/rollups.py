@@ -0,0 +1,52 @@
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import select
+
+from demo.api.models.sql.readings import all_tables
+from demo.api.models.sql.rollups import all_rollups
+
+
+def update_rollups(session, postcode_area_id, year, reading_tables=None,
+                   rollup_tables=None):
+    """Recompute the rollups of a postcode area and year.
+
+    The rollups are replaced with aggregates of the readings tables using
+    INSERT ... SELECT statements, so readings are not loaded. Pending reading
+    changes must be flushed first.
+
+        reading_tables: optional mapping of categories to the reading tables
+                        to aggregate, defaults to the reading model tables
+        rollup_tables: optional mapping of rollup names to the rollup tables
+                       to replace, defaults to the rollup model tables
+    """
+    if reading_tables is None:
+        reading_tables = {category: reading.__table__
+                          for category, reading in all_tables.items()}
+    if rollup_tables is None:
+        rollup_tables = {name: rollup.__table__
+                         for name, rollup in all_rollups.items()}
+
+    for name, rollup in all_rollups.items():
+        table = rollup_tables[name]
+        session.execute(
+            table.delete()
+            .where(table.c.postcode_area_id == postcode_area_id)
+            .where(table.c.year == year))
+
+        for category, reading_table in reading_tables.items():
+            group_columns = [reading_table.c[column]
+                             for column in rollup.rollup_columns]
+            columns = list(rollup.rollup_columns) + [
+                'category', 'year', 'download', 'upload', 'count']
+
+            session.execute(table.insert().from_select(
+                columns,
+                select(group_columns + [
+                    literal(category),
+                    reading_table.c.year,
+                    func.avg(reading_table.c.download),
+                    func.avg(reading_table.c.upload),
+                    func.count()])
+                .where(reading_table.c.postcode_area_id == postcode_area_id)
+                .where(reading_table.c.year == year)
+                .group_by(*group_columns + [reading_table.c.year])))
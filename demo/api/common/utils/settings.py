@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 
 import pkg_resources
+from pyramid.settings import aslist
 import sqlalchemy
 
+from demo.api.common.utils.slow_queries import SlowQueryLog
+
 
 def sqlalchemy_engine_from_config(configuration, prefix='sqlalchemy.',
                                   **kwargs):
@@ -14,9 +17,24 @@ def sqlalchemy_engine_from_config(configuration, prefix='sqlalchemy.',
     contain a dict with a mapping from types to conversion functions which
     will be used to update the default converters. The used converter
     if multiple converters are registered for the same type is undefined.
+
+    Settings with another dot after the prefix are not passed to SQLAlchemy,
+    e.g. the slow query log settings starting with the prefix and
+    'slow_query.' (see demo.api.common.utils.slow_queries) or the read
+    replica settings starting with 'read.' (see
+    sqlalchemy_replicas_from_config).
     """
     assert 'connect_args' not in kwargs
 
+    slow_query_prefix = prefix + 'slow_query.'
+    slow_query_settings = dict(
+        (key[len(slow_query_prefix):], value)
+        for key, value in configuration.items()
+        if key.startswith(slow_query_prefix))
+    configuration = dict(
+        (key, value) for key, value in configuration.items()
+        if not key.startswith(prefix) or '.' not in key[len(prefix):])
+
     url = sqlalchemy.engine.url.make_url(configuration[prefix + 'url'])
     if url.drivername == 'mysql+pymysql':
         import pymysql
@@ -27,5 +45,51 @@ def sqlalchemy_engine_from_config(configuration, prefix='sqlalchemy.',
             conversions.update(entry_point.load())
         kwargs['connect_args'] = {'conv': conversions}
 
-    return sqlalchemy.engine_from_config(
-        configuration, prefix, **kwargs)
+    engine = sqlalchemy.engine_from_config(configuration, prefix, **kwargs)
+
+    slow_query_log = SlowQueryLog.from_settings(slow_query_settings)
+    if slow_query_log is not None:
+        slow_query_log.attach(engine)
+    return engine
+
+
+def sqlalchemy_replicas_from_config(configuration, prefix='sqlalchemy.',
+                                    **kwargs):
+    """Set up the read replica engines.
+
+    Replicas are configured like the primary engine with settings starting
+    with the prefix and 'read.', e.g.:
+
+        sqlalchemy.read.url = mysql+pymysql://replica1/irdemoapi
+                              mysql+pymysql://replica2/irdemoapi
+        sqlalchemy.read.pool_pre_ping = true
+
+    `read.url` is a whitespace separated list of URLs, one engine is created
+    for each URL with the other settings. `read.retry_interval` is the number
+    of seconds a failed replica is skipped (see
+    demo.api.common.utils.replicas.ReadReplicas). Replicas log slow queries
+    with the primary's 'slow_query.' settings, unless they are overridden
+    by 'read.slow_query.' settings.
+
+    Returns:
+        A list of engines, empty without replicas
+
+    """
+    read_prefix = prefix + 'read.'
+    read_configuration = dict(
+        (key, value) for key, value in configuration.items()
+        if key.startswith(read_prefix) and
+        key != read_prefix + 'retry_interval')
+
+    slow_query_prefix = prefix + 'slow_query.'
+    for key, value in configuration.items():
+        if key.startswith(slow_query_prefix):
+            read_configuration.setdefault(
+                read_prefix + key[len(prefix):], value)
+
+    engines = []
+    for url in aslist(read_configuration.pop(read_prefix + 'url', '')):
+        read_configuration[read_prefix + 'url'] = url
+        engines.append(sqlalchemy_engine_from_config(
+            read_configuration, read_prefix, **kwargs))
+    return engines
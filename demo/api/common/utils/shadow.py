@@ -0,0 +1,156 @@
+"""Shadow copies of tables.
+
+Imports can load shadow copies of the reading and rollup tables while the
+application keeps reading the live tables, then swap the copies into place
+with table renames. Readers see either the old or the new tables, never a
+partially loaded dataset, and never wait on the locks of the import.
+"""
+import logging
+
+from sqlalchemy import MetaData
+from sqlalchemy.schema import CreateTable
+
+SHADOW_SUFFIX = '_shadow'
+OLD_SUFFIX = '_old'
+
+_logger = logging.getLogger(__name__)
+
+_shadow_metadata = MetaData()
+
+
+def get_shadow_table(table):
+    """Get the shadow copy of a table.
+
+    Index names get the shadow suffix too, SQLite index names are unique per
+    database.
+    """
+    name = table.name + SHADOW_SUFFIX
+    if name not in _shadow_metadata.tables:
+        # Referenced tables are copied so that foreign keys resolve
+        for foreign_key in table.foreign_keys:
+            referred_table = foreign_key.column.table
+            if referred_table.key not in _shadow_metadata.tables:
+                referred_table.tometadata(_shadow_metadata)
+
+        shadow_table = table.tometadata(_shadow_metadata, name=name)
+        for index in shadow_table.indexes:
+            index.name = index.name + SHADOW_SUFFIX
+    return _shadow_metadata.tables[name]
+
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def _drop_table(connection, name):
+    if connection.dialect.has_table(connection, name):
+        connection.execute('DROP TABLE {}'.format(_quote(connection, name)))
+
+
+def create_shadow_tables(connection, tables):
+    """Create shadow copies of tables holding a copy of their rows.
+
+    Leftover shadow tables of an interrupted import are replaced. Indexes are
+    created once the rows are copied.
+    """
+    for table in tables:
+        shadow_table = get_shadow_table(table)
+        _drop_table(connection, shadow_table.name)
+
+        _logger.info('Copying table {} to {}'
+                     ''.format(table.name, shadow_table.name))
+        connection.execute(CreateTable(shadow_table))
+        columns = [column.name for column in table.columns]
+        connection.execute(shadow_table.insert().from_select(
+            columns, table.select()))
+        for index in shadow_table.indexes:
+            index.create(connection)
+
+
+def drop_shadow_tables(connection, tables):
+    """Drop the shadow copies of tables."""
+    for table in tables:
+        _drop_table(connection, get_shadow_table(table).name)
+
+
+def _rename_index(connection, table, index, shadow_index):
+    if connection.dialect.name == 'mysql':
+        connection.execute('ALTER TABLE {} RENAME INDEX {} TO {}'.format(
+            _quote(connection, table.name),
+            _quote(connection, shadow_index.name),
+            _quote(connection, index.name)))
+    else:
+        # SQLite can not rename indexes, the index is built again
+        index.create(connection)
+        shadow_index.drop(connection)
+
+
+def swap_shadow_tables(connection, tables, publish=None):
+    """Replace tables with their shadow copies.
+
+    All tables are renamed at once: in a single RENAME TABLE statement on
+    MySQL, in a single transaction on other databases. The replaced tables
+    are dropped and the indexes of the new tables get their usual names
+    back.
+
+        connection: the connection renaming the tables
+        tables: the live tables
+        publish: a function called with the connection once the tables are
+                 renamed, e.g. incrementing the dataset generation. It runs
+                 in the rename transaction, except on MySQL where RENAME
+                 TABLE commits: it runs in its own transaction right after
+                 the rename
+
+    Returns:
+        The result of publish
+
+    """
+    for table in tables:
+        _drop_table(connection, table.name + OLD_SUFFIX)
+
+    renames = []
+    for table in tables:
+        renames.append((table.name, table.name + OLD_SUFFIX))
+        renames.append((get_shadow_table(table).name, table.name))
+
+    _logger.info('Swapping shadow tables of {}'
+                 ''.format(', '.join(table.name for table in tables)))
+    result = publish_error = None
+    if connection.dialect.name == 'mysql':
+        connection.execute('RENAME TABLE {}'.format(', '.join(
+            '{} TO {}'.format(_quote(connection, name),
+                              _quote(connection, new_name))
+            for name, new_name in renames)))
+        if publish is not None:
+            try:
+                with connection.begin():
+                    result = publish(connection)
+            except Exception as error:
+                _logger.error(
+                    'Swapped the shadow tables without publishing them, '
+                    'readers may keep serving the previous dataset: '
+                    'increment the dataset generation, e.g. by importing '
+                    'the files again')
+                publish_error = error
+    else:
+        with connection.begin():
+            if connection.dialect.name == 'sqlite':
+                # pysqlite does not begin transactions for DDL statements
+                connection.execute('BEGIN')
+            for name, new_name in renames:
+                connection.execute('ALTER TABLE {} RENAME TO {}'.format(
+                    _quote(connection, name), _quote(connection, new_name)))
+            if publish is not None:
+                result = publish(connection)
+
+    for table in tables:
+        _drop_table(connection, table.name + OLD_SUFFIX)
+        shadow_indexes = {index.name: index
+                          for index in get_shadow_table(table).indexes}
+        for index in table.indexes:
+            _rename_index(connection, table, index,
+                          shadow_indexes[index.name + SHADOW_SUFFIX])
+
+    if publish_error is not None:
+        raise publish_error
+    return result
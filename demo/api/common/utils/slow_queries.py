@@ -0,0 +1,228 @@
+"""Slow query log.
+
+Statements taking longer than a threshold are logged with their bound
+parameters and the application function that ran them, e.g.:
+
+    Slow query 1 took 0.412s in demo.api.views._averages:_get_averages
+    (GET /api/average): SELECT ... [parameters: (1, 2, '1', 3)]
+
+Configured in the ini file with the engine settings, see
+demo.api.common.utils.settings.sqlalchemy_engine_from_config:
+
+    # Seconds, statements taking longer are logged
+    sqlalchemy.slow_query.threshold = 0.1
+    # Log the query plan of slow SELECT statements
+    sqlalchemy.slow_query.explain = false
+    # Logged slow queries per second and burst, others are counted only
+    sqlalchemy.slow_query.log_rate = 1
+    sqlalchemy.slow_query.log_burst = 10
+
+Query plans are captured by a background thread on a connection of its own,
+and logged on a separate line with the number of the slow query. Plans are
+skipped while the thread is busy with previous plans.
+"""
+import logging
+import queue
+import sys
+import threading
+import time
+
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+import sqlalchemy
+
+_logger = logging.getLogger(__name__)
+
+# Longest logged parameters representation
+MAX_PARAMETERS_LENGTH = 1000
+
+# Most slow queries waiting for a query plan
+MAX_PENDING_EXPLAINS = 10
+
+EXPLAIN_PREFIXES = {
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket rate limiter.
+
+        rate: tokens added per second
+        burst: the maximum number of tokens
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self):
+        """Take a token, returns False when there is none left."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def get_caller():
+    """Get the innermost application function of the calling thread, as
+    'module:function', outside of this module.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('demo.api.') and module != __name__:
+            return '{}:{}'.format(module, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def format_parameters(parameters):
+    parameters = repr(parameters)
+    if len(parameters) > MAX_PARAMETERS_LENGTH:
+        parameters = parameters[:MAX_PARAMETERS_LENGTH] + '...'
+    return parameters
+
+
+class SlowQueryLog(object):
+    """Logs the statements of an engine taking longer than a threshold.
+
+        threshold: seconds a statement may take without being logged
+        explain: whether to log the query plans of slow SELECT statements
+        log_rate: slow queries logged per second
+        log_burst: slow queries logged at once before log_rate applies
+
+    """
+
+    def __init__(self, threshold, explain=False, log_rate=1.0, log_burst=10):
+        self.threshold = threshold
+        self.explain = explain
+        self.bucket = TokenBucket(log_rate, log_burst)
+        self.count = 0
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        self._explains = queue.Queue(MAX_PENDING_EXPLAINS)
+        self._explain_thread = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create a slow query log from settings without the
+        'sqlalchemy.slow_query.' prefix, None without a threshold.
+        """
+        if not settings.get('threshold'):
+            return None
+        return cls(float(settings['threshold']),
+                   explain=asbool(settings.get('explain', False)),
+                   log_rate=float(settings.get('log_rate', 1)),
+                   log_burst=int(settings.get('log_burst', 10)))
+
+    def attach(self, engine):
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                self._before_cursor_execute)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                                self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info['slow_query_started'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        started = conn.info.pop('slow_query_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.threshold:
+            self.record(conn.engine, statement, parameters, executemany,
+                        elapsed)
+
+    def record(self, engine, statement, parameters, executemany, elapsed):
+        """Log a slow query, unless the log rate is exceeded."""
+        with self._lock:
+            if not self.bucket.consume():
+                self.suppressed += 1
+                return
+            self.count += 1
+            number = self.count
+            suppressed, self.suppressed = self.suppressed, 0
+
+        request = get_current_request()
+        location = get_caller() or 'unknown'
+        if request is not None:
+            location += ' ({} {})'.format(request.method, request.path)
+        message = ('Slow query {} took {:.3f}s in {}: {} [parameters: {}]'
+                   ''.format(number, elapsed, location, statement,
+                             format_parameters(parameters)))
+        if suppressed:
+            message += ' ({} slow queries not logged)'.format(suppressed)
+        _logger.warning(message)
+
+        if (self.explain and not executemany and
+                engine.dialect.name in EXPLAIN_PREFIXES and
+                statement.lstrip()[:6].upper() == 'SELECT'):
+            self._queue_explain(engine, number, statement, parameters)
+
+    def _queue_explain(self, engine, number, statement, parameters):
+        try:
+            self._explains.put_nowait((engine, number, statement, parameters))
+        except queue.Full:
+            _logger.info('Skipped the query plan of slow query {}'
+                         ''.format(number))
+            return
+
+        with self._lock:
+            # Threads do not survive forking, e.g. into worker processes
+            if (self._explain_thread is None or
+                    not self._explain_thread.is_alive()):
+                self._explain_thread = threading.Thread(
+                    target=self._run_explains, name='slow-query-explain',
+                    daemon=True)
+                self._explain_thread.start()
+
+    def _run_explains(self):
+        while True:
+            engine, number, statement, parameters = self._explains.get()
+            try:
+                plan = explain(engine, statement, parameters)
+                _logger.warning('Plan of slow query {}:\n{}'.format(
+                    number, '\n'.join(
+                        ' | '.join(str(value) for value in row)
+                        for row in plan)))
+            except Exception:
+                _logger.exception('Failed to explain slow query {}'
+                                  ''.format(number))
+            finally:
+                self._explains.task_done()
+
+    def wait_for_explains(self):
+        """Block until the queued query plans are logged."""
+        self._explains.join()
+
+
+def explain(engine, statement, parameters):
+    """Get the query plan rows of a statement.
+
+    The statement and parameters are in the format of the DB-API driver, as
+    passed to the cursor. A raw connection is used so the plan is not logged
+    as a slow query itself.
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(EXPLAIN_PREFIXES[engine.dialect.name] + statement,
+                           parameters)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
@@ -0,0 +1,68 @@
+"""Timers of the phases of long running tasks, e.g. imports."""
+import collections
+import contextlib
+import time
+
+
+class PhaseTimer(object):
+    """Accumulates the wall clock time of named phases.
+
+    Phases can be nested, the time of a phase excludes the time of the
+    phases run within it, so the phase times add up to the total time.
+
+    Attributes:
+    durations -- Mapping of phase names to seconds, in first run order
+    items -- Number of items processed, for rates
+
+    """
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self.items = 0
+        self._stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block as a phase."""
+        # Start time and time of nested phases
+        entry = [time.perf_counter(), 0.0]
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - entry[0]
+            self.durations[name] = (self.durations.get(name, 0.0) +
+                                    elapsed - entry[1])
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def add(self, name, seconds):
+        """Add time measured by the caller to a phase.
+
+        The time is excluded from the enclosing phase. Cheaper than phase
+        for timing many short calls.
+        """
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        if self._stack:
+            self._stack[-1][1] += seconds
+
+    def merge(self, other):
+        """Add the phase times and items of another timer."""
+        for name, seconds in other.durations.items():
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.items += other.items
+
+    @property
+    def total(self):
+        return sum(self.durations.values())
+
+    @property
+    def rate(self):
+        """Items per second, 0 before any time is measured."""
+        total = self.total
+        return self.items / total if total else 0.0
+
+    def format(self):
+        return ', '.join('{} {:.2f}s'.format(name, seconds)
+                         for name, seconds in self.durations.items())
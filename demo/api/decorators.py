@@ -1,5 +1,7 @@
 from pyramid.path import DottedNameResolver
 
+from .sql import Session
+
 
 def multiple(*decorators):
     def wrapped(f):
@@ -18,6 +20,20 @@ def pretty(f):
     return wrapped
 
 
+def read_only(f):
+    """Route the queries of a view to the read replicas, if any."""
+    def wrapped(context, request):
+        session = Session()
+        session.info['read_only'] = True
+        try:
+            return f(context, request)
+        finally:
+            # Scoped sessions are reused by the next request of the thread
+            session.info.pop('read_only', None)
+            session.info.pop('read_engine', None)
+    return wrapped
+
+
 def cornice_deserializer(f, deserializer):
     def wrapped(context, request):
         request.deserializer = deserializer
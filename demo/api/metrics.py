@@ -0,0 +1,168 @@
+"""Prometheus metrics.
+
+Enable the /metrics endpoint in the ini file:
+
+    metrics.enabled = true
+
+Collected metrics:
+
+    demo_api_request_duration_seconds       -- latency histogram per route
+                                               and method
+    demo_api_requests_total                 -- requests per route, method and
+                                               status code
+    demo_api_db_pool_checkouts_total        -- connections checked out of the
+                                               pool
+    demo_api_db_pool_checkout_seconds       -- histogram of the time
+                                               connections stay checked out
+    demo_api_db_pool_checked_out            -- connections checked out now
+    demo_api_postcode_cache_entries         -- postcode parts cached per part
+    demo_api_response_cache_entries         -- responses cached
+
+Pool metrics add up the primary engine and the read replica engines.
+
+Every worker process keeps its own metrics. When running several worker
+processes, point the PROMETHEUS_MULTIPROC_DIR environment variable of every
+worker to the same empty directory. Metrics are then kept in memory mapped
+files there and /metrics aggregates the files of all workers (see
+prometheus_client.multiprocess). Empty the directory before starting the
+workers and call prometheus_client.multiprocess.mark_process_dead when a
+worker exits, e.g. in the child_exit hook of gunicorn.
+
+Updating a metric is a dictionary lookup and a locked addition, or a write to
+a memory mapped file in multi-process mode, so requests are always measured.
+"""
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+from pyramid.response import Response
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+import sqlalchemy
+
+from .sql import Base
+from .views import POSTCODE_CACHE
+from demo.api.common.utils.cache import IResponseCache
+from demo.api.common.utils.replicas import IReadReplicas
+
+REQUEST_DURATION = Histogram(
+    'demo_api_request_duration_seconds', 'Request latency in seconds.',
+    ['route', 'method'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+             2.5, 5.0))
+REQUESTS = Counter(
+    'demo_api_requests', 'Requests by route, method and status code.',
+    ['route', 'method', 'status'])
+
+POOL_CHECKOUTS = Counter(
+    'demo_api_db_pool_checkouts', 'Connections checked out of the pool.')
+POOL_CHECKOUT_DURATION = Histogram(
+    'demo_api_db_pool_checkout_seconds',
+    'Seconds connections stay checked out of the pool.',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0, 5.0))
+POOL_CHECKED_OUT = Gauge(
+    'demo_api_db_pool_checked_out', 'Connections checked out of the pool.',
+    multiprocess_mode='livesum')
+
+POSTCODE_CACHE_ENTRIES = Gauge(
+    'demo_api_postcode_cache_entries', 'Postcode parts cached.', ['part'],
+    multiprocess_mode='liveall')
+RESPONSE_CACHE_ENTRIES = Gauge(
+    'demo_api_response_cache_entries', 'Responses cached.',
+    multiprocess_mode='livesum')
+
+# The postcode parts last reported, gauges are only set when they change
+_reported_parts = None
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info['metrics_checkout'] = time.perf_counter()
+    POOL_CHECKOUTS.inc()
+    POOL_CHECKED_OUT.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    started = connection_record.info.pop('metrics_checkout', None)
+    if started is not None:
+        POOL_CHECKOUT_DURATION.observe(time.perf_counter() - started)
+        POOL_CHECKED_OUT.dec()
+
+
+def instrument_engine(engine):
+    """Collect pool metrics of an engine."""
+    for identifier, listener in (('checkout', _on_checkout),
+                                 ('checkin', _on_checkin)):
+        if not sqlalchemy.event.contains(engine, identifier, listener):
+            sqlalchemy.event.listen(engine, identifier, listener)
+
+
+def update_cache_gauges(registry):
+    global _reported_parts
+
+    parts = POSTCODE_CACHE.parts
+    if parts is not None and parts is not _reported_parts:
+        for part in ('areas', 'districts', 'units'):
+            POSTCODE_CACHE_ENTRIES.labels(part).set(len(getattr(parts, part)))
+        _reported_parts = parts
+
+    cache = registry.queryUtility(IResponseCache)
+    if cache is not None:
+        RESPONSE_CACHE_ENTRIES.set(len(cache))
+
+
+def metrics_tween_factory(handler, registry):
+
+    def metrics_tween(request):
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            route = getattr(request, 'matched_route', None)
+            route = route.name if route is not None else ''
+            REQUEST_DURATION.labels(route, request.method).observe(
+                time.perf_counter() - started)
+            REQUESTS.labels(route, request.method, str(status)).inc()
+            update_cache_gauges(registry)
+
+    return metrics_tween
+
+
+def get_metrics(request):
+    """Get the metrics of this process or, in multi-process mode, of all
+    processes in the Prometheus text format.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    response = Response(body=generate_latest(registry))
+    response.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return response
+
+
+def includeme(config):
+    settings = config.get_settings()
+    if not asbool(settings.get('metrics.enabled', False)):
+        return
+
+    instrument_engine(Base.metadata.bind)
+    replicas = config.registry.queryUtility(IReadReplicas)
+    if replicas is not None:
+        for engine in replicas.engines:
+            instrument_engine(engine)
+    config.add_route('metrics', '/metrics')
+    config.add_view(get_metrics, route_name='metrics')
+    # Above the exception view, to count error responses by status code
+    config.add_tween('demo.api.metrics.metrics_tween_factory', under=INGRESS)
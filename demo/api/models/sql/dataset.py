@@ -0,0 +1,86 @@
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import String
+
+from . import Base
+
+
+class DatasetGeneration(Base):
+    """The dataset generation.
+
+    A single row counter incremented by every import that commits changes to
+    the readings or postcode tables. Readers compare generations to find out
+    whether their caches are stale.
+
+    Attributes:
+    id -- An id, always 1
+    generation -- The generation number
+    modified -- When the generation was last incremented (UTC)
+
+    """
+
+    __tablename__ = 'dataset_generations'
+    __table_args__ = (
+        {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    generation = Column(Integer, nullable=False)
+    modified = Column(DateTime, nullable=False)
+
+
+class PostcodeAreaVersion(Base):
+    """The dataset version of a postcode area.
+
+    Set to the dataset generation by every import that commits changes to the
+    readings of the area. Used to validate cached responses.
+
+    Attributes:
+    postcode_area_id -- The postcode area id
+    generation -- The dataset generation of the last change
+    modified -- When the area was last changed (UTC)
+
+    """
+
+    __tablename__ = 'postcode_area_versions'
+    __table_args__ = (
+        {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
+    )
+
+    postcode_area_id = Column(Integer, ForeignKey('postcode_areas.id'),
+                              primary_key=True, autoincrement=False)
+    generation = Column(Integer, nullable=False)
+    modified = Column(DateTime, nullable=False)
+
+
+class ImportedFile(Base):
+    """A csv file committed by an import.
+
+    Imports skip files whose content and header mapping did not change since
+    they were committed for the same year.
+
+    Attributes:
+    id -- An id for the entry
+    filename -- The file name, without the directory
+    year -- Year the readings were imported for
+    content_hash -- SHA-1 hex digest of the file content
+    mapping_hash -- SHA-1 hex digest of the csv header mapping
+    modified -- When the file was last committed (UTC)
+
+    """
+
+    __tablename__ = 'imported_files'
+    __table_args__ = (
+        Index('imported_files_lookup_idx', 'filename', 'year', unique=True),
+        {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    filename = Column(String(255), nullable=False)
+    year = Column(Integer, nullable=False)
+    content_hash = Column(String(40), nullable=False)
+    mapping_hash = Column(String(40), nullable=False)
+    modified = Column(DateTime, nullable=False)
@@ -1,5 +1,6 @@
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import Float
 from sqlalchemy import String
@@ -26,10 +27,19 @@ class ReadingMixin(object):
     postcode_sector -- The postcode sector. It is made up of a single digit
     postcode_unit_id -- The postcode unit id
 
+    The lookup index covers the postcode filter, the year ordering and the
+    reading values so that average lookups are served from the index alone.
+
     """
-    __table_args__ = (
-        {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
-    )
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            Index(cls.reading_type + '_lookup_idx', 'postcode_area_id',
+                  'postcode_district_id', 'postcode_sector',
+                  'postcode_unit_id', 'year', 'download', 'upload'),
+            {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
+        )
 
     @declared_attr
     def id(cls):
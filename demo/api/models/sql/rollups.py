@@ -0,0 +1,115 @@
+from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy.ext.declarative import declared_attr
+
+from . import Base
+from .postcode import PostcodeArea
+from .postcode import PostcodeDistrict
+
+
+class RollupMixin(object):
+    """A rollup of the readings of a postcode group mixin.
+
+    Holds the average of the unit readings of every postcode in the group,
+    for one reading table and year.
+
+    Attributes:
+    id -- An id for the rollup entry
+    category -- The reading table category, see readings.all_tables
+    year -- Year for the readings
+    download -- Average download reading, None when no reading has one
+    upload -- Average upload reading, None when no reading has one
+    count -- Number of postcode readings in the rollup
+    postcode_area_id -- The postcode area id
+
+    The lookup index covers the group columns, the category and the year so
+    that a rollup lookup is a single index read.
+
+    """
+
+    rollup_columns = ('postcode_area_id',)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            Index(cls.__tablename__ + '_lookup_idx',
+                  *cls.rollup_columns + ('category', 'year'), unique=True),
+            {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
+        )
+
+    @declared_attr
+    def id(cls):
+        return Column(Integer, primary_key=True)
+
+    @declared_attr
+    def category(cls):
+        return Column(String(1), nullable=False)
+
+    @declared_attr
+    def year(cls):
+        return Column(Integer, nullable=False)
+
+    @declared_attr
+    def download(cls):
+        return Column(Float, nullable=True)
+
+    @declared_attr
+    def upload(cls):
+        return Column(Float, nullable=True)
+
+    @declared_attr
+    def count(cls):
+        return Column(Integer, nullable=False)
+
+    @declared_attr
+    def postcode_area_id(cls):
+        return Column(Integer, ForeignKey(PostcodeArea.id), nullable=False)
+
+
+class AreaRollup(Base, RollupMixin):
+    """A rollup of the readings of a postcode area."""
+
+    __tablename__ = 'area_rollups'
+
+
+class DistrictRollup(Base, RollupMixin):
+    """A rollup of the readings of a postcode district.
+
+    Attributes:
+    postcode_district_id -- The postcode district id
+
+    """
+
+    __tablename__ = 'district_rollups'
+    rollup_columns = ('postcode_area_id', 'postcode_district_id')
+
+    postcode_district_id = Column(Integer, ForeignKey(PostcodeDistrict.id),
+                                  nullable=False)
+
+
+class SectorRollup(Base, RollupMixin):
+    """A rollup of the readings of a postcode sector.
+
+    Attributes:
+    postcode_district_id -- The postcode district id
+    postcode_sector -- The postcode sector
+
+    """
+
+    __tablename__ = 'sector_rollups'
+    rollup_columns = ('postcode_area_id', 'postcode_district_id',
+                      'postcode_sector')
+
+    postcode_district_id = Column(Integer, ForeignKey(PostcodeDistrict.id),
+                                  nullable=False)
+    postcode_sector = Column(String(1), nullable=False)
+
+
+all_rollups = {
+    'area': AreaRollup,
+    'district': DistrictRollup,
+    'sector': SectorRollup}
@@ -0,0 +1,47 @@
+from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import String
+
+from . import Base
+
+
+class StagedReading(Base):
+    """A reading staged by a chunked import before it is published.
+
+    Rows of a file are staged in separately committed chunks and copied to
+    the reading tables in a single transaction once the whole file is
+    staged. The postcode area and year are the same for every row of an
+    import and are not staged.
+
+    Attributes:
+    id -- An id for the staged entry
+    import_id -- The import the entry belongs to
+    row -- The file row number, the last row of a repeated postcode wins
+    category -- The reading table category, see readings.all_tables
+    postcode_district_id -- The postcode district id
+    postcode_sector -- The postcode sector
+    postcode_unit_id -- The postcode unit id
+    download -- Download reading
+    upload -- Upload reading
+
+    """
+
+    __tablename__ = 'staged_readings'
+    __table_args__ = (
+        Index('staged_readings_lookup_idx', 'import_id', 'category',
+              'postcode_district_id', 'postcode_sector', 'postcode_unit_id',
+              'row'),
+        {'mysql_charset': 'UTF8MB4', 'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    import_id = Column(String(32), nullable=False)
+    row = Column(Integer, nullable=False)
+    category = Column(String(1), nullable=False)
+    postcode_district_id = Column(Integer, nullable=False)
+    postcode_sector = Column(String(1), nullable=False)
+    postcode_unit_id = Column(Integer, nullable=False)
+    download = Column(Float, nullable=True)
+    upload = Column(Float, nullable=True)
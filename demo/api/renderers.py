@@ -36,11 +36,59 @@ def _dumps(value, **kwargs):
     return simplejson.JSONEncoder(**kwargs).encode(value)
 
 
-compact_json_renderer = JSON(adapters=adapters, serializer=_dumps,
-                             separators=(',', ':'))
+def get_cache_control(settings):
+    """Get the Cache-Control header value of cacheable responses.
 
-compact_jsonp_renderer = JSONP(adapters=adapters, serializer=_dumps,
-                               separators=(',', ':'))
+    Configured by the 'http.cache_control' setting, e.g.
+    'public, max-age=300'. None when unset.
+    """
+    return settings.get('http.cache_control') or None
 
-pretty_json_renderer = JSON(adapters=adapters, serializer=_dumps,
-                            sort_keys=True, indent=2)
+
+def is_cacheable(request, response):
+    return (request.method in ('GET', 'HEAD') and
+            response.status_int == 200 and
+            'Cache-Control' not in response.headers)
+
+
+class CacheControlMixin(object):
+    """Adds the configured Cache-Control header to cacheable responses.
+
+    Responses of views that set their own Cache-Control header are left
+    unchanged.
+    """
+
+    def __call__(self, info):
+        render = super(CacheControlMixin, self).__call__(info)
+        cache_control = get_cache_control(info.settings or {})
+        if cache_control is None:
+            return render
+
+        def _render(value, system):
+            request = system.get('request')
+            if request is not None and is_cacheable(request,
+                                                    request.response):
+                request.response.headers['Cache-Control'] = cache_control
+            return render(value, system)
+
+        return _render
+
+
+class CacheControlJSON(CacheControlMixin, JSON):
+    pass
+
+
+class CacheControlJSONP(CacheControlMixin, JSONP):
+    pass
+
+
+compact_json_renderer = CacheControlJSON(adapters=adapters,
+                                         serializer=_dumps,
+                                         separators=(',', ':'))
+
+compact_jsonp_renderer = CacheControlJSONP(adapters=adapters,
+                                           serializer=_dumps,
+                                           separators=(',', ':'))
+
+pretty_json_renderer = CacheControlJSON(adapters=adapters, serializer=_dumps,
+                                        sort_keys=True, indent=2)
@@ -1,4 +1,6 @@
+from colander import Integer
 from colander import Length
+from colander import MappingSchema
 from colander import SchemaNode
 from colander import SequenceSchema
 from colander import Mapping
@@ -6,6 +8,8 @@ from colander import Mapping
 from ._common import PrettyQuerySchema
 from .types import String
 
+MAX_BATCH_POSTCODES = 5000
+
 
 class AverageQuerySchema(PrettyQuerySchema):
     """A connection speed average query object."""
@@ -44,3 +48,78 @@ class AverageItemsSchema(SequenceSchema):
     """A series of connection speed averages."""
 
     average_item = AverageItemSchema()
+
+
+class AverageBatchItemSchema(MappingSchema):
+    """A single postcode lookup in a batch query."""
+    postcode = SchemaNode(
+        String(),
+        validator=Length(1, 16),
+        description='postal code')
+    connection = SchemaNode(
+        String(),
+        missing='average',
+        description='connection type')
+
+
+class AverageBatchItemsSchema(SequenceSchema):
+    """A series of postcode lookups."""
+
+    batch_item = AverageBatchItemSchema()
+
+
+class AverageBatchQuerySchema(PrettyQuerySchema):
+    """A connection speed averages batch query object."""
+    postcodes = AverageBatchItemsSchema(
+        location='body',
+        validator=Length(1, MAX_BATCH_POSTCODES),
+        description='postcode and connection type pairs')
+
+
+class AverageBatchResultSchema(SchemaNode):
+    """Connection speed averages for one postcode of a batch."""
+    schema_type = Mapping
+
+    postcode = SchemaNode(
+        String(),
+        description='Postal code as requested.')
+    connection = SchemaNode(
+        String(),
+        description='Connection type as requested.')
+    error = SchemaNode(
+        String(),
+        missing=None,
+        description='Lookup error, if any.')
+    results = AverageItemsSchema()
+
+
+class AverageBatchResultsSchema(SequenceSchema):
+    """A series of batch lookup results."""
+
+    batch_result = AverageBatchResultSchema()
+
+
+class AverageRollupQuerySchema(PrettyQuerySchema):
+    """A connection speed average query object for a postcode group."""
+    connection = SchemaNode(
+        String(),
+        missing='average',
+        location='querystring',
+        description='connection type')
+    postcode = SchemaNode(
+        String(),
+        location='querystring',
+        description='partial postal code, e.g. AB, AB10 or AB10 1')
+
+
+class AverageRollupItemSchema(AverageItemSchema):
+    """A connection speed averages of a postcode group."""
+    count = SchemaNode(
+        Integer(),
+        description='Number of postal codes averaged.')
+
+
+class AverageRollupItemsSchema(SequenceSchema):
+    """A series of connection speed averages of a postcode group."""
+
+    average_item = AverageRollupItemSchema()
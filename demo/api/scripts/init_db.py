@@ -1,6 +1,7 @@
 """Initialise database.
 
 Usage: initialisedb INI_FILE [--drop | --drop-tables | --drop-database]
+                    [--upgrade-indexes]
 
 
 Options:
@@ -11,6 +12,8 @@ Options:
     --drop-database         Drop the database (if it exists) before creating
                             tables (a new database with the same name is also
                             created)
+    --upgrade-indexes       Create indexes (that have a model) missing from
+                            existing tables
 
 
 The user connecting to the database (defined in the ini file) must have
@@ -61,6 +64,38 @@ def drop_database(settings):
     conn.close()
 
 
+def create_missing_indexes(bind):
+    """Create model indexes missing from existing tables.
+
+    Tables that do not exist yet are skipped, they are created along with
+    their indexes by `create_all`.
+
+    Returns:
+        The created indexes
+
+    """
+    inspector = sqlalchemy.inspect(bind)
+    table_names = set(inspector.get_table_names())
+
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+
+        index_names = set(index['name']
+                          for index in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in index_names:
+                continue
+
+            _logger.info('Creating index {} on table {}'
+                         ''.format(index.name, table.name))
+            index.create(bind)
+            created.append(index)
+
+    return created
+
+
 def main():
     args = docopt(__doc__)
 
@@ -76,6 +111,8 @@ def main():
         Base.metadata.drop_all()
     if args['--drop-database']:
         drop_database(settings)
+    if args['--upgrade-indexes']:
+        create_missing_indexes(Base.metadata.bind)
 
     Base.metadata.create_all()
 
@@ -0,0 +1,43 @@
+"""Write readings snapshot.
+
+Usage: snapshot INI_FILE [SNAPSHOT_PATH]
+
+Options:
+    -h --help               Show this screen
+
+Writes the latest readings of every postcode to a snapshot file served by the
+application (see demo.api.store). SNAPSHOT_PATH defaults to the
+'store.snapshot' setting of the ini file.
+"""
+import logging
+
+from docopt import docopt
+import transaction
+
+from . import get_settings
+from . import init_sqlalchemy
+from demo.api.store import save_snapshot
+
+
+logging.basicConfig(level=logging.INFO)
+_logger = logging.getLogger(__name__)
+
+
+def main():
+    args = docopt(__doc__)
+
+    settings = get_settings(args['INI_FILE'])
+    path = args['SNAPSHOT_PATH'] or settings.get('store.snapshot')
+    if not path:
+        raise ValueError('Missing snapshot path')
+
+    session = init_sqlalchemy(settings)
+
+    with transaction.manager:
+        save_snapshot(session, path)
+
+    _logger.info('Done.')
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ Usage: updatedb INI_FILE YEAR CSV_FILEPATH
                 [--postcode-header POSTCODE_HEADER]...
                 [--down-header DHEADER]...
                 [--up-header UHEADER]...
+                [--batch-size BATCH_SIZE] [--jobs JOBS]
+                [--chunk-size CHUNK_SIZE] [--force] [--shadow]
+                [--profile DIR]
 
 Options:
     -h --help                  Show this screen
@@ -17,12 +20,68 @@ Options:
                                description and defaults below.
     -u --up-header UHEADER     Optional indexed upload header name replacement.
                                Defaults to internal names. See indexed headers
+    --batch-size BATCH_SIZE    Number of readings written per insert statement
+                               [default: 1000]
+    -j --jobs JOBS             Number of files loaded in parallel processes
+                               [default: 1]
+    --chunk-size CHUNK_SIZE    Number of csv rows parsed and staged at a time;
+                               loads large files with bounded memory
+    -f --force                 Load files even when they are unchanged
+    --shadow                   Load shadow copies of the reading and rollup
+                               tables and swap them into place at the end
+    --profile DIR              Write cProfile stats of every file to DIR
+
+CSV_FILEPATH is a folder of csv files or a zip archive of csv files. Archive
+members are read straight from the archive without extracting them.
 
 The user connecting to the database (defined in the ini file) must have
 appropriate permissions to update tables on the database. Committing
 changes only occurs after each entire file is processed without incident. Each
-file must contain all entries for one postal area, other postal areas in the
-same file will raise and abort.
+file must contain all entries for one postal area, files with other postal
+areas fail. Files that fail are not committed, the other files are still
+loaded; failures are listed once all files are processed and the command
+exits with an error. Readings are written with multi-row insert statements of
+BATCH_SIZE rows; the last row of a postcode repeated in a file wins.
+
+With --jobs, files are loaded by a pool of processes, each file in its own
+transaction. Missing postcode areas, districts and units of all files are
+added first in sorted order, so workers never create them concurrently. Each
+postal area may only be in one file, files sharing a postal area fail without
+being loaded. Dry runs always load files one at a time.
+
+With --chunk-size, a file is read CHUNK_SIZE rows at a time instead of all at
+once. Each chunk is committed to the staged_readings table and the readings of
+the postal area are replaced from the staged rows in a single transaction once
+the whole file is staged, so a file is still committed entirely or not at all.
+Staged rows are deleted afterwards.
+
+The content of every committed file is hashed together with the csv header
+mapping and recorded in the imported_files table in the same transaction.
+Files with the same name, year, content and header mapping as a committed
+file are skipped unless --force is given, so rerunning an interrupted import
+resumes after the last committed file.
+
+With --shadow, the reading and rollup tables are copied to shadow tables
+first and files are committed to the copies, so the live tables are never
+locked by the import. Once all files are processed, the shadow tables replace
+the live tables with renames: a single RENAME TABLE statement on MySQL, a
+single transaction on SQLite. The dataset generation, area versions and
+imported files are then updated for every file at once.
+
+Every committed file increments the dataset generation, which running
+applications use to refresh their postcode caches, and sets the version of its
+postal area, which validates cached responses. The area, district and sector
+rollups of the postal area and year are recomputed in the same transaction.
+
+The time spent in every phase of a file (hashing, csv reading,
+split_postcode, adding postcode parts, deleting, inserting, rollups,
+publishing and committing) is logged with its rows per second once the file
+is loaded, followed by a summary table of all files and phases. With the
+profile option, each file is also profiled with cProfile and the stats are
+written to DIR/<file name>.prof, readable with pstats, snakeviz or flameprof.
+
+When the 'store.snapshot' setting is defined in the ini file, the readings
+snapshot served by the application is rewritten once all files are stored.
 
 Indexed headers:
     Header indexes represent the subset for the header type. Index start at 0
@@ -46,23 +105,57 @@ Default upload header arguments. Format is 'table_index:header':
 import os
 import logging
 import glob
+import contextlib
+import cProfile
 import csv
 import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import sys
+import time
+import uuid
+import zipfile
+from collections import namedtuple
 from itertools import chain
+from itertools import islice
 
 from docopt import docopt
+from sqlalchemy import and_
+from sqlalchemy import exists
+from sqlalchemy import literal
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
 import transaction
 
 from . import init_sqlalchemy
 from . import get_settings
+from demo.api.common.utils.dataset import ensure_dataset_generation
+from demo.api.common.utils.dataset import get_imported_files
+from demo.api.common.utils.dataset import increment_dataset_generation
+from demo.api.common.utils.dataset import mark_session_changed
+from demo.api.common.utils.dataset import set_imported_file
+from demo.api.common.utils.dataset import set_postcode_area_version
 from demo.api.common.utils.postcodes import get_postcode_areas
 from demo.api.common.utils.postcodes import get_postcode_districts
 from demo.api.common.utils.postcodes import get_postcode_units
+from demo.api.common.utils.postcodes import pack_postcode
 from demo.api.common.utils.postcodes import split_postcode
+from demo.api.common.utils.rollups import update_rollups
+from demo.api.common.utils.shadow import create_shadow_tables
+from demo.api.common.utils.shadow import drop_shadow_tables
+from demo.api.common.utils.shadow import get_shadow_table
+from demo.api.common.utils.shadow import swap_shadow_tables
+from demo.api.common.utils.timers import PhaseTimer
 from demo.api.models.sql.postcode import PostcodeArea
 from demo.api.models.sql.postcode import PostcodeUnit
 from demo.api.models.sql.postcode import PostcodeDistrict
 from demo.api.models.sql.readings import all_tables
+from demo.api.models.sql.rollups import all_rollups
+from demo.api.models.sql.staging import StagedReading
+from demo.api.store import save_snapshot
 
 
 logging.basicConfig(level=logging.INFO)
@@ -84,6 +177,22 @@ DEFAULT_UPLOAD_CSV_HEADERS = [
     '4:Average upload speed (Mbit/s) for UFBB lines']
 
 
+ARCHIVE_EXTENSION = '.zip'
+
+# The reading and rollup tables written by an import, see get_import_tables
+ImportTables = namedtuple('ImportTables', ['readings', 'rollups', 'shadow'])
+
+# A file committed by an import, published to readers by
+# publish_loaded_files
+LoadedFile = namedtuple('LoadedFile', ['filepath', 'postcode_area_id',
+                                       'content_hash', 'mapping_hash'])
+
+# The outcome of loading a file: the LoadedFile when it was committed, the
+# PhaseTimer of the load and the error when it failed
+LoadResult = namedtuple('LoadResult', ['filepath', 'loaded_file', 'timer',
+                                       'error'])
+
+
 def replace_header_arg(storage, header_arg):
     invalid = False
     try:
@@ -101,6 +210,835 @@ def replace_header_arg(storage, header_arg):
     storage[index] = name
 
 
+def iter_readings(rows, filepath, postcode_header, down_headers,
+                  up_headers, timer=None):
+    """Iterate the readings of csv rows.
+
+    Raises ValueError for invalid postcodes and postcodes of another postal
+    area than the first row. With a PhaseTimer, rows are counted and
+    split_postcode is timed as its own phase.
+
+    Yields:
+        Tuples of the postcode parts and a mapping of categories to download
+        and upload pairs
+
+    """
+    area = None
+    clock = time.perf_counter
+    for row_i, row in enumerate(rows):
+        row_postcode = row[postcode_header]
+        if timer is None:
+            postcode_parts = split_postcode(row_postcode)
+        else:
+            start = clock()
+            postcode_parts = split_postcode(row_postcode)
+            timer.add('split_postcode', clock() - start)
+            timer.items += 1
+        if not postcode_parts:
+            raise ValueError(
+                'Invalid postcode {} in file {!r} at row '
+                '{}'.format(row_postcode, filepath, row_i))
+
+        row_area = postcode_parts[0]
+        if area is None:
+            area = row_area
+        elif area != row_area:
+            raise ValueError(
+                'Invalid postcode area in file {!r} at row '
+                '{}'.format(filepath, row_i))
+
+        values = {}
+        for category in all_tables:
+            values[category] = (_read_value(row, down_headers.get(category)),
+                                _read_value(row, up_headers.get(category)))
+
+        yield postcode_parts, values
+
+
+def read_readings(rows, filepath, postcode_header, down_headers,
+                  up_headers, timer=None):
+    """Read the readings of csv rows.
+
+    Returns:
+        A tuple of the postal area and a mapping of packed postcode keys to
+        tuples of the district, sector, unit and a mapping of categories to
+        download and upload pairs. None when there are no rows
+
+    """
+    area = None
+    readings = {}
+    for postcode_parts, values in iter_readings(
+            rows, filepath, postcode_header, down_headers, up_headers,
+            timer):
+        area, district, sector, unit = postcode_parts
+        readings[pack_postcode(postcode_parts)] = (
+            district, sector, unit, values)
+
+    if area is None:
+        return None
+    return area, readings
+
+
+def _read_value(row, header):
+    if header is None:
+        return None
+    try:
+        return float(row[header])
+    except ValueError:
+        return None
+
+
+def add_postcode_parts(session, model, column, values, ids):
+    """Add missing postcode parts.
+
+        model: the postcode part model, e.g. PostcodeUnit
+        column: the postcode part column name, e.g. 'unit'
+        values: the postcode part values in the file
+        ids: mapping of existing postcode part values to ids, new ids are
+             added
+
+    Returns:
+        The number of added postcode parts
+
+    """
+    new_entries = [model(**{column: value})
+                   for value in sorted(set(values).difference(ids))]
+    session.add_all(new_entries)
+    session.flush(objects=new_entries)
+
+    for entry in new_entries:
+        ids[getattr(entry, column)] = entry.id
+    return len(new_entries)
+
+
+def insert_rows(session, table, columns, rows, batch_size):
+    """Insert rows with multi-row insert statements.
+
+        table: the table
+        columns: the column names of the row values
+        rows: iterable of tuples of column values
+        batch_size: the number of rows per statement
+
+    Returns:
+        The number of inserted rows
+
+    """
+    insert = table.insert()
+
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = [dict(zip(columns, row)) for row in islice(rows, batch_size)]
+        if not batch:
+            return count
+        session.execute(insert, batch)
+        count += len(batch)
+
+
+def store_readings(session, table, rows, batch_size):
+    """Store readings with multi-row insert statements.
+
+        table: the reading table
+        rows: iterable of tuples of the postcode area id, district id,
+              sector, unit id, year, download and upload
+        batch_size: the number of rows per statement
+
+    Returns:
+        The number of stored readings
+
+    """
+    return insert_rows(
+        session, table,
+        ('postcode_area_id', 'postcode_district_id', 'postcode_sector',
+         'postcode_unit_id', 'year', 'download', 'upload'),
+        rows, batch_size)
+
+
+def stage_readings(session, import_id, start_row, readings,
+                   postcode_districts, postcode_units, batch_size):
+    """Stage the readings of a chunk of csv rows.
+
+        import_id: the import the readings belong to
+        start_row: the file row number of the first reading
+        readings: list of postcode parts and readings tuples, see
+                  iter_readings
+        postcode_districts: mapping of districts to ids
+        postcode_units: mapping of units to ids
+        batch_size: the number of rows per statement
+
+    Returns:
+        The number of staged rows
+
+    """
+    rows = (
+        (import_id, start_row + i, category, postcode_districts[district],
+         sector, postcode_units[unit]) + values[category]
+        for i, ((_, district, sector, unit), values) in enumerate(readings)
+        for category in all_tables)
+
+    return insert_rows(
+        session, StagedReading.__table__,
+        ('import_id', 'row', 'category', 'postcode_district_id',
+         'postcode_sector', 'postcode_unit_id', 'download', 'upload'),
+        rows, batch_size)
+
+
+def publish_staged_readings(session, import_id, category, table,
+                            postcode_area_id, year):
+    """Copy staged readings of a category to a reading table.
+
+    Only the last staged row of every postcode is copied, blank readings are
+    skipped.
+
+    Returns:
+        The number of stored readings
+
+    """
+    staged = StagedReading.__table__
+    later = staged.alias('later_staged_readings')
+
+    result = session.execute(table.insert().from_select(
+        ['postcode_area_id', 'postcode_district_id', 'postcode_sector',
+         'postcode_unit_id', 'year', 'download', 'upload'],
+        select([literal(postcode_area_id), staged.c.postcode_district_id,
+                staged.c.postcode_sector, staged.c.postcode_unit_id,
+                literal(year), staged.c.download, staged.c.upload])
+        .where(staged.c.import_id == import_id)
+        .where(staged.c.category == category)
+        .where(or_(staged.c.download.isnot(None),
+                   staged.c.upload.isnot(None)))
+        .where(~exists().where(and_(
+            later.c.import_id == staged.c.import_id,
+            later.c.category == staged.c.category,
+            later.c.postcode_district_id == staged.c.postcode_district_id,
+            later.c.postcode_sector == staged.c.postcode_sector,
+            later.c.postcode_unit_id == staged.c.postcode_unit_id,
+            later.c.row > staged.c.row)))))
+    return result.rowcount
+
+
+def delete_staged_readings(session, import_id):
+    """Delete the staged readings of an import in its own transaction."""
+    with transaction.manager:
+        table = StagedReading.__table__
+        session.execute(table.delete().where(table.c.import_id == import_id))
+        mark_session_changed(session)
+
+
+def delete_readings(session, postcode_area_id, year, tables):
+    """Delete the readings of a postcode area and year.
+
+    Uses a single DELETE statement per reading table, readings are not
+    loaded.
+    """
+    for table in tables.readings.values():
+        result = session.execute(
+            table.delete()
+            .where(table.c.postcode_area_id == postcode_area_id)
+            .where(table.c.year == year))
+
+        _logger.info('Deleting {} old entries for table {}'
+                     ''.format(result.rowcount, table.name))
+
+
+def split_archive_path(filepath):
+    """Split the path of a zip archive member.
+
+    Returns:
+        A tuple of the archive path and the member name, or None and the
+        path for other files
+
+    """
+    head, separator, member = filepath.partition(ARCHIVE_EXTENSION + '/')
+    archive_path = head + ARCHIVE_EXTENSION
+    if separator and os.path.isfile(archive_path):
+        return archive_path, member
+    return None, filepath
+
+
+@contextlib.contextmanager
+def open_file(filepath, mode='r'):
+    """Open a file or a zip archive member, without extracting it.
+
+    Archive members are streamed from the archive, see split_archive_path.
+    """
+    archive_path, member = split_archive_path(filepath)
+    if archive_path is None:
+        with open(filepath, mode) as f:
+            yield f
+        return
+
+    with zipfile.ZipFile(archive_path) as archive:
+        with archive.open(member) as f:
+            if 'b' in mode:
+                yield f
+            else:
+                yield io.TextIOWrapper(f)
+
+
+def list_csv_files(path):
+    """Get the csv files of a folder or of a zip archive.
+
+    Zip archive members are listed as paths under the archive path, e.g.
+    'data.zip/AB.csv', and opened with open_file.
+    """
+    if path.endswith(ARCHIVE_EXTENSION) and os.path.isfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return sorted(os.path.join(path, name)
+                          for name in archive.namelist()
+                          if name.lower().endswith('.csv'))
+    return sorted(glob.glob(os.path.join(path, '*.csv')))
+
+
+def check_headers(reader, headers, filepath):
+    if not headers.issubset(reader.fieldnames or []):
+        missing_headers = headers.difference(reader.fieldnames or [])
+        missing_headers = ', '.join(
+            repr(h) for h in missing_headers)
+        raise ValueError('Missing csv headers {} in {}'
+                         ''.format(missing_headers, filepath))
+
+
+def hash_file(filepath):
+    """Get the SHA-1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open_file(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_header_mapping(postcode_header, down_headers, up_headers):
+    """Get the SHA-1 hex digest of a csv header mapping."""
+    mapping = json.dumps([postcode_header, sorted(down_headers.items()),
+                          sorted(up_headers.items())])
+    return hashlib.sha1(mapping.encode('utf-8')).hexdigest()
+
+
+def get_changed_files(session, filepaths, year, mapping_hash):
+    """Get the files that were not committed for a year with the same
+    content and header mapping.
+
+    Returns:
+        A mapping of the changed file paths, in order, to their content
+        hashes, passed on to load_file so files are hashed once
+
+    """
+    with transaction.manager:
+        imported_files = get_imported_files(session, year)
+
+    changed_files = {}
+    for filepath in filepaths:
+        content_hash = hash_file(filepath)
+        if (imported_files.get(os.path.basename(filepath)) ==
+                (content_hash, mapping_hash)):
+            _logger.info('Skipping unchanged file {}'.format(filepath))
+        else:
+            changed_files[filepath] = content_hash
+    return changed_files
+
+
+def get_import_tables(shadow=False):
+    """Get the tables an import writes readings and rollups to.
+
+    Returns:
+        The live tables, or their shadow copies when shadow is true
+
+    """
+    tables = ImportTables(
+        {category: reading.__table__
+         for category, reading in all_tables.items()},
+        {name: rollup.__table__ for name, rollup in all_rollups.items()},
+        False)
+    if not shadow:
+        return tables
+
+    return ImportTables(
+        {category: get_shadow_table(table)
+         for category, table in tables.readings.items()},
+        {name: get_shadow_table(table)
+         for name, table in tables.rollups.items()},
+        True)
+
+
+def publish_loaded_files(session, loaded_files, year):
+    """Publish the readings of loaded files to readers.
+
+    Increments the dataset generation, sets the versions of the postcode
+    areas and records the imported file hashes.
+
+    Returns:
+        The new dataset generation
+
+    """
+    generation = increment_dataset_generation(session)
+    for loaded_file in loaded_files:
+        set_postcode_area_version(session, loaded_file.postcode_area_id,
+                                  generation)
+        set_imported_file(session, os.path.basename(loaded_file.filepath),
+                          year, loaded_file.content_hash,
+                          loaded_file.mapping_hash)
+    return generation
+
+
+def publish_swapped_files(connection, loaded_files, year):
+    """Publish loaded files in the transaction of a connection.
+
+    Used as the publish function of swap_shadow_tables, readers see the
+    swapped tables together with the new dataset generation.
+
+    Returns:
+        The new dataset generation
+
+    """
+    session = sessionmaker(bind=connection)()
+    try:
+        generation = publish_loaded_files(session, loaded_files, year)
+        session.commit()
+    finally:
+        session.close()
+    return generation
+
+
+def commit_area(session, area, year, loaded_file, tables, timer):
+    """Commit the readings of a postcode area and year loaded from a file.
+
+    Updates the rollups of the area and year and publishes the file before
+    committing. Files loaded to shadow tables are published once the tables
+    are swapped.
+    """
+    _logger.info('Updating rollups for postcode area {!r}'.format(area))
+    with timer.phase('rollups'):
+        update_rollups(session, loaded_file.postcode_area_id, year,
+                       tables.readings, tables.rollups)
+
+    if tables.shadow:
+        mark_session_changed(session)
+        _logger.info('Committing shadow tables...')
+    else:
+        with timer.phase('publish'):
+            generation = publish_loaded_files(session, [loaded_file], year)
+        _logger.info('Committing dataset generation {}...'
+                     ''.format(generation))
+    with timer.phase('commit'):
+        transaction.commit()
+
+
+def load_file(session, filepath, year, headers, postcode_header,
+              down_headers, up_headers, batch_size, dry_run,
+              chunk_size=None, shadow=False, timer=None, content_hash=None):
+    """Load the readings of a csv file in a single transaction.
+
+    With a chunk_size, the file is loaded with bounded memory, see
+    load_file_in_chunks. With shadow, readings and rollups are written to
+    the shadow tables, see get_import_tables. The phases of the load are
+    timed with the optional PhaseTimer. The file is hashed unless its
+    content_hash is given, e.g. by get_changed_files.
+
+    Returns:
+        A LoadedFile when the file is committed, otherwise None
+
+    """
+    if timer is None:
+        timer = PhaseTimer()
+    if chunk_size:
+        return load_file_in_chunks(
+            session, filepath, year, headers, postcode_header, down_headers,
+            up_headers, batch_size, dry_run, chunk_size, shadow, timer,
+            content_hash)
+
+    tables = get_import_tables(shadow)
+
+    _logger.info('Loading file {}'.format(filepath))
+    if content_hash is None:
+        with timer.phase('hash'):
+            content_hash = hash_file(filepath)
+    mapping_hash = hash_header_mapping(postcode_header, down_headers,
+                                       up_headers)
+
+    with timer.phase('read'), open_file(filepath) as csv_file:
+        reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
+        check_headers(reader, headers, filepath)
+        file_readings = read_readings(reader, filepath, postcode_header,
+                                      down_headers, up_headers, timer)
+
+    if file_readings is None:
+        return None
+
+    area, readings = file_readings
+    loaded_file = None
+
+    with transaction.manager:
+        with timer.phase('postcode_parts'):
+            postcode_areas = dict(get_postcode_areas(session))
+            postcode_units = dict(get_postcode_units(session))
+            postcode_districts = dict(get_postcode_districts(session))
+
+            new_area = area not in postcode_areas
+            if new_area:
+                _logger.info('Adding new postcode area {!r}'.format(area))
+            add_postcode_parts(session, PostcodeArea, 'area', [area],
+                               postcode_areas)
+            postcode_area_id = postcode_areas[area]
+
+            new_units_count = add_postcode_parts(
+                session, PostcodeUnit, 'unit',
+                (unit for _, _, unit, _ in readings.values()),
+                postcode_units)
+            _logger.info('Adding {} new postcode units'
+                         ''.format(new_units_count))
+
+            new_districts_count = add_postcode_parts(
+                session, PostcodeDistrict, 'district',
+                (district for district, _, _, _ in readings.values()),
+                postcode_districts)
+            _logger.info('Adding {} new postcode districts'
+                         ''.format(new_districts_count))
+
+        with timer.phase('delete'):
+            delete_readings(session, postcode_area_id, year, tables)
+
+        stored_count = 0
+        for category, table in tables.readings.items():
+            rows = (
+                (postcode_area_id, postcode_districts[district], sector,
+                 postcode_units[unit], year) + values[category]
+                for district, sector, unit, values in readings.values()
+                if values[category] != (None, None))
+            with timer.phase('insert'):
+                count = store_readings(session, table, rows, batch_size)
+            stored_count += count
+
+            _logger.info(
+                'Storing {} new entries{} for table {}'
+                ''.format(count,
+                          (' (ignored {} blank entries)'
+                           ''.format(len(readings) - count)
+                           if len(readings) != count else ''),
+                          table.name))
+
+        if dry_run:
+            transaction.abort()
+        elif (new_area or new_units_count or new_districts_count or
+              stored_count):
+            loaded_file = LoadedFile(filepath, postcode_area_id,
+                                     content_hash, mapping_hash)
+            commit_area(session, area, year, loaded_file, tables, timer)
+        else:
+            transaction.abort()
+
+    _logger.info('Stored {} readings of {} postcodes from {}'
+                 ''.format(stored_count, len(readings), filepath))
+    return loaded_file
+
+
+def load_file_in_chunks(session, filepath, year, headers, postcode_header,
+                        down_headers, up_headers, batch_size, dry_run,
+                        chunk_size, shadow=False, timer=None,
+                        content_hash=None):
+    """Load the readings of a csv file with bounded memory.
+
+    Rows are parsed in chunks of chunk_size rows and staged in separately
+    committed transactions, together with any new postcode parts. Once the
+    whole file is staged, the readings of the area and year are replaced by
+    the staged readings in a single transaction, so readers still see the
+    whole file or nothing. Staged readings are deleted afterwards, also when
+    loading fails.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+
+    _logger.info('Loading file {} in chunks of {} rows'
+                 ''.format(filepath, chunk_size))
+    if content_hash is None:
+        with timer.phase('hash'):
+            content_hash = hash_file(filepath)
+    mapping_hash = hash_header_mapping(postcode_header, down_headers,
+                                       up_headers)
+
+    tables = get_import_tables(shadow)
+    import_id = uuid.uuid4().hex
+    area = None
+    loaded_file = None
+    rows_count = 0
+    staged_count = 0
+    postcode_ids = None
+    try:
+        with open_file(filepath) as csv_file:
+            reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
+            check_headers(reader, headers, filepath)
+            readings = iter_readings(reader, filepath, postcode_header,
+                                     down_headers, up_headers, timer)
+
+            while True:
+                with timer.phase('read'):
+                    chunk = list(islice(readings, chunk_size))
+                if not chunk:
+                    break
+
+                area = chunk[0][0][0]
+                start_row = rows_count
+                rows_count += len(chunk)
+                if dry_run:
+                    continue
+
+                with transaction.manager:
+                    with timer.phase('postcode_parts'):
+                        if postcode_ids is None:
+                            postcode_ids = (
+                                dict(get_postcode_areas(session)),
+                                dict(get_postcode_districts(session)),
+                                dict(get_postcode_units(session)))
+                        postcode_areas, postcode_districts, postcode_units = (
+                            postcode_ids)
+
+                        add_postcode_parts(session, PostcodeArea, 'area',
+                                           [area], postcode_areas)
+                        add_postcode_parts(
+                            session, PostcodeDistrict, 'district',
+                            (parts[1] for parts, _ in chunk),
+                            postcode_districts)
+                        add_postcode_parts(
+                            session, PostcodeUnit, 'unit',
+                            (parts[3] for parts, _ in chunk), postcode_units)
+
+                    with timer.phase('stage'):
+                        staged_count += stage_readings(
+                            session, import_id, start_row, chunk,
+                            postcode_districts, postcode_units, batch_size)
+                    mark_session_changed(session)
+                    with timer.phase('commit'):
+                        transaction.commit()
+
+                _logger.info('Staged {} rows of {}'
+                             ''.format(rows_count, filepath))
+
+        if area is None or dry_run:
+            return None
+
+        with transaction.manager:
+            postcode_area_id = postcode_ids[0][area]
+            with timer.phase('delete'):
+                delete_readings(session, postcode_area_id, year, tables)
+
+            stored_count = 0
+            for category, table in tables.readings.items():
+                with timer.phase('insert'):
+                    count = publish_staged_readings(
+                        session, import_id, category, table,
+                        postcode_area_id, year)
+                stored_count += count
+
+                _logger.info('Storing {} new entries for table {}'
+                             ''.format(count, table.name))
+
+            if stored_count:
+                loaded_file = LoadedFile(filepath, postcode_area_id,
+                                         content_hash, mapping_hash)
+                commit_area(session, area, year, loaded_file, tables, timer)
+            else:
+                transaction.abort()
+    finally:
+        if staged_count:
+            with timer.phase('cleanup'):
+                delete_staged_readings(session, import_id)
+
+    _logger.info('Stored {} readings of {} rows from {}'
+                 ''.format(stored_count, rows_count, filepath))
+    return loaded_file
+
+
+def timed_load_file(session, profile_dir, filepath, *args,
+                    content_hash=None):
+    """Load a csv file, see load_file, timing its phases.
+
+    With a profile_dir, the load is profiled with cProfile and the stats are
+    written to a <file name>.prof file in the directory.
+
+    Returns:
+        A LoadResult, with the error when loading failed
+
+    """
+    timer = PhaseTimer()
+    profile = cProfile.Profile() if profile_dir else None
+    if profile is not None:
+        profile.enable()
+    try:
+        loaded_file = load_file(session, filepath, *args, timer=timer,
+                                content_hash=content_hash)
+    except Exception as error:
+        _logger.exception('Failed to load file {}'.format(filepath))
+        return LoadResult(filepath, None, timer, format_error(error))
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile_path = os.path.join(
+                profile_dir, os.path.basename(filepath) + '.prof')
+            profile.dump_stats(profile_path)
+            _logger.info('Wrote profile {}'.format(profile_path))
+
+    _logger.info('Loaded {} rows from {} in {:.2f}s, {:.0f} rows/s ({})'
+                 ''.format(timer.items, filepath, timer.total, timer.rate,
+                           timer.format()))
+    return LoadResult(filepath, loaded_file, timer, None)
+
+
+def format_error(error):
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def log_summary(results):
+    """Log a table of the rows, time and rate of every file and of the
+    phases of all files.
+    """
+    if not results:
+        return
+
+    total_timer = PhaseTimer()
+    for result in results:
+        total_timer.merge(result.timer)
+    width = max(chain(
+        [len('Total')], map(len, total_timer.durations),
+        (len(os.path.basename(result.filepath)) for result in results)))
+
+    lines = ['{:<{}} {:>10} {:>10} {:>10}'.format(
+        'File', width, 'Rows', 'Seconds', 'Rows/s')]
+    for result in results:
+        timer = result.timer
+        lines.append('{:<{}} {:>10} {:>10.2f} {:>10.0f}{}'.format(
+            os.path.basename(result.filepath), width, timer.items,
+            timer.total, timer.rate,
+            ' failed' if result.error is not None else ''))
+    lines.append('{:<{}} {:>10} {:>10.2f} {:>10.0f}'.format(
+        'Total', width, total_timer.items, total_timer.total,
+        total_timer.rate))
+
+    lines.append('')
+    lines.append('{:<{}} {:>10} {:>10}'.format('Phase', width, 'Seconds',
+                                             'Share'))
+    for name, seconds in sorted(total_timer.durations.items(),
+                                key=lambda item: -item[1]):
+        lines.append('{:<{}} {:>10.2f} {:>9.1f}%'.format(
+            name, width, seconds,
+            100 * seconds / total_timer.total if total_timer.total else 0))
+
+    _logger.info('Summary:' + ''.join(
+        os.linesep + ('    ' + line if line else '') for line in lines))
+
+
+def scan_file(filepath, postcode_header):
+    """Get the postcode parts of a csv file.
+
+    Invalid postcodes are skipped, they are reported when the file is
+    loaded.
+
+    Returns:
+        A tuple of the sets of postal areas, districts and units
+
+    """
+    areas, districts, units = set(), set(), set()
+    with open_file(filepath) as csv_file:
+        reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
+        if postcode_header not in (reader.fieldnames or []):
+            return areas, districts, units
+
+        for row in reader:
+            postcode_parts = split_postcode(row[postcode_header])
+            if postcode_parts:
+                area, district, _, unit = postcode_parts
+                areas.add(area)
+                districts.add(district)
+                units.add(unit)
+    return areas, districts, units
+
+
+_worker_session = None
+
+
+def _init_worker(settings):
+    global _worker_session
+    _worker_session = init_sqlalchemy(settings)
+
+
+def _scan_file_job(args):
+    return scan_file(*args)
+
+
+def _load_file_job(job):
+    args, content_hash = job
+    return timed_load_file(_worker_session, *args, content_hash=content_hash)
+
+
+def load_files_in_parallel(settings, session, filepaths, jobs, year,
+                           headers, postcode_header, down_headers,
+                           up_headers, batch_size, chunk_size=None,
+                           shadow=False, profile_dir=None,
+                           content_hashes=None):
+    """Load csv files in a pool of processes.
+
+    Files sharing a postal area fail without being loaded. Files are hashed
+    by the workers unless their hash is in content_hashes. The dataset
+    generation row is added before the workers increment it.
+
+    Returns:
+        A list of the LoadResult tuples of the files, sorted by path
+
+    """
+    # Worker processes must not share the connections of this process
+    session.remove()
+    session.bind.dispose()
+
+    with multiprocessing.Pool(jobs, _init_worker, (settings,)) as pool:
+        files_parts = pool.map(
+            _scan_file_job,
+            [(filepath, postcode_header) for filepath in filepaths])
+
+        area_files = {}
+        for filepath, (areas, _, _) in zip(filepaths, files_parts):
+            for area in areas:
+                area_files.setdefault(area, []).append(filepath)
+
+        failed_results = {}
+        for area, area_filepaths in sorted(area_files.items()):
+            if len(area_filepaths) > 1:
+                error = format_error(ValueError(
+                    'Postal area {!r} in several files {}'
+                    ''.format(area, area_filepaths)))
+                _logger.error(error)
+                for filepath in area_filepaths:
+                    failed_results.setdefault(filepath, LoadResult(
+                        filepath, None, PhaseTimer(), error))
+
+        files_parts = [parts for filepath, parts in zip(filepaths, files_parts)
+                       if filepath not in failed_results]
+        filepaths = [filepath for filepath in filepaths
+                     if filepath not in failed_results]
+
+        with transaction.manager:
+            for i, (model, column, get_parts) in enumerate((
+                    (PostcodeArea, 'area', get_postcode_areas),
+                    (PostcodeDistrict, 'district', get_postcode_districts),
+                    (PostcodeUnit, 'unit', get_postcode_units))):
+                count = add_postcode_parts(
+                    session, model, column,
+                    set().union(*(parts[i] for parts in files_parts)),
+                    dict(get_parts(session)))
+                _logger.info('Adding {} new postcode {}s'
+                             ''.format(count, column))
+            ensure_dataset_generation(session)
+        session.remove()
+        session.bind.dispose()
+
+        content_hashes = content_hashes or {}
+        results = pool.imap_unordered(
+            _load_file_job,
+            [((profile_dir, filepath, year, headers, postcode_header,
+               down_headers, up_headers, batch_size, False, chunk_size,
+               shadow), content_hashes.get(filepath))
+             for filepath in filepaths])
+        return sorted(chain(results, failed_results.values()))
+
+
 def main():
     default_down_headers = {}
     for header in DEFAULT_DOWNLOAD_CSV_HEADERS:
@@ -137,6 +1075,18 @@ def main():
     down_headers_args = args['--down-header']
     up_headers_args = args['--up-header']
     dry_run = args['--dry-run']
+    force = args['--force']
+    shadow = args['--shadow'] and not dry_run
+    profile_dir = args['--profile']
+    batch_size = int(args['--batch-size'])
+    if batch_size < 1:
+        raise ValueError('Invalid batch size {}'.format(batch_size))
+    jobs = int(args['--jobs'])
+    if jobs < 1:
+        raise ValueError('Invalid jobs {}'.format(jobs))
+    chunk_size = args['--chunk-size'] and int(args['--chunk-size'])
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError('Invalid chunk size {}'.format(chunk_size))
 
     down_headers = dict(default_down_headers)
     for down_headers_arg in down_headers_args:
@@ -165,193 +1115,71 @@ def main():
     settings = get_settings(ini_file)
     session = init_sqlalchemy(settings)
 
-    def get_old_entries(reading_source, year, postcode_area_id):
-        return (session.query(reading_source)
-                .filter(reading_source.year == year,
-                        reading_source.postcode_area_id == postcode_area_id)
-                .all())
-
-    for filepath in sorted(glob.glob(os.path.join(filepath, '*.csv'))):
-        _logger.info('Loading file {}'.format(filepath))
-
-        postcode_areas = dict(get_postcode_areas(session))
-        postcode_units = dict(get_postcode_units(session))
-        postcode_districts = dict(get_postcode_districts(session))
-
-        with open(filepath, 'r') as csv_file:
-            reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
-
-            if not headers.issubset(reader.fieldnames):
-                missing_headers = headers.difference(reader.fieldnames)
-                missing_headers = ', '.join(
-                    repr(h) for h in missing_headers)
-                raise ValueError('Missing csv headers {} in {}'
-                                 ''.format(missing_headers, filepath))
-
-            with transaction.manager:
-                rows_entries = {}
-                new_postcode_units = {}
-                new_postcode_districts = {}
-
-                # Required to provide the postcode id to the query used to
-                # gather old entries from tables for deletion
-                first_row_postcode_area = None
-                for first_row in reader:
-                    row_postcode = first_row[postcode_header]
-                    postcode_parts = split_postcode(row_postcode)
-                    if not postcode_parts:
-                        raise ValueError(
-                            'Invalid postcode {} in file {!r} at row '
-                            '{}'.format(row_postcode, filepath, 0))
-
-                    first_row_postcode_area, _, _, _ = postcode_parts
-                    break
-
-                if not first_row_postcode_area:
-                    continue
-
-                postcode_area = None
-                postcode_area_id = postcode_areas.get(first_row_postcode_area)
-                if not postcode_area_id:
-                    _logger.info('Adding new postcode area {!r}'
-                                 ''.format(first_row_postcode_area))
-
-                    postcode_area = PostcodeArea(area=first_row_postcode_area)
-                    session.add(postcode_area)
-                    session.flush(objects=[postcode_area])
-                    postcode_area_id = postcode_area.id
-
-                deletes = []
-                for category in all_tables:
-                    table = all_tables[category]
-                    table_deletes = get_old_entries(table, year,
-                                                    postcode_area_id)
-
-                    table_name = table.__table__.name
-                    _logger.info('Deleting {} old entries for table {}'
-                                 ''.format(len(table_deletes), table_name))
-
-                    deletes.extend(table_deletes)
-
-                all_rows = chain.from_iterable(([first_row], reader))
-
-                blank_entries_count = 0
-                for row_i, row in enumerate(all_rows):
-                    row_postcode = row[postcode_header]
-                    postcode_key = split_postcode(row_postcode)
-                    if not postcode_parts:
-                        raise ValueError(
-                            'Invalid postcode {} in file {!r} at row '
-                            '{}'.format(row_postcode, filepath, row_i))
-                    postcode_key = tuple(postcode_key)
-
-                    row_area, row_district, row_sector, row_unit = postcode_key
-
-                    if (first_row_postcode_area != row_area):
-                        raise ValueError(
-                            'Invalid postcode area in file {!r} at row '
-                            '{}'.format(filepath, row_i))
-
-                    unit_id = postcode_units.get(row_unit)
-                    if unit_id is None:
-                        new_postcode_units.setdefault(
-                            row_unit, PostcodeUnit(unit=row_unit))
-
-                    district_id = postcode_districts.get(row_district)
-                    if district_id is None:
-                        new_postcode_districts.setdefault(
-                            row_district,
-                            PostcodeDistrict(district=row_district))
-
-                    for header_source_i, header_source in enumerate(
-                            (down_headers, up_headers)):
-                        for category, header in header_source.items():
-                            entries = rows_entries.setdefault(category, {})
-                            table = all_tables[category]
-
-                            # Added strings purposefully, as placeholders
-                            entry = entries.setdefault(
-                                postcode_key,
-                                table(postcode_area_id=row_area,
-                                      postcode_district_id=row_district,
-                                      postcode_sector=row_sector,
-                                      postcode_unit_id=row_unit,
-                                      year=year))
-
-                            try:
-                                value = float(row[header])
-                            except ValueError:
-                                value = None
-
-                            if header_source_i == 0:
-                                entry.download = value
-                                continue
-
-                            entry.upload = value
-
-                            # Safe to delete since upload header comes after
-                            # download header meaning that download value would
-                            # be set
-                            entry = entries[postcode_key]
-                            if entry.upload is None and entry.download is None:
-                                entries.pop(postcode_key)
-                                blank_entries_count += 1
-
-                _logger.info('Adding {} new postcode units'
-                             ''.format(len(new_postcode_units)))
-                _logger.info('Adding {} new postcode districts'
-                             ''.format(len(new_postcode_districts)))
-
-                session.add_all(new_postcode_units.values())
-                session.add_all(new_postcode_districts.values())
-                session.flush(objects=new_postcode_units.values())
-                session.flush(objects=new_postcode_districts.values())
-
-                for category, entries in rows_entries.items():
-                    for entry_key, entry in entries.items():
-                        district = entry.postcode_district_id
-
-                        district_id = postcode_districts.get(district)
-                        if district_id is None:
-                            district_id = new_postcode_districts[district].id
-
-                        unit = entry.postcode_unit_id
-
-                        unit_id = postcode_units.get(unit)
-                        if unit_id is None:
-                            unit_id = new_postcode_units[unit].id
-
-                        # Remove placeholders in fields
-                        entry.postcode_area_id = postcode_area_id
-                        entry.postcode_unit_id = unit_id
-                        entry.postcode_district_id = district_id
-
-                    table = all_tables[category]
-                    table_name = table.__table__.name
-
-                    _logger.info(
-                        'Storing {} new entries{} for table {}'
-                        ''.format(len(entries),
-                                  (' (ignored {} blank entries)'
-                                   ''.format(blank_entries_count)
-                                   if blank_entries_count else ''),
-                                  table_name))
-
-                    session.add_all(entries.values())
-                    session.flush(objects=entries.values())
-
-                if dry_run:
-                    transaction.abort()
-                elif (postcode_area or new_postcode_units or
-                      new_postcode_districts or
-                      sum(len(g) for g in rows_entries.values())):
-                    # Flush actions causes any entries added to
-                    # session.delete() to commit, add them last
-                    for delete in deletes:
-                        session.delete(delete)
-
-                    _logger.info('Committing...')
-                    transaction.commit()
+    filepaths = list_csv_files(filepath)
+    content_hashes = {}
+    if not force:
+        content_hashes = get_changed_files(
+            session, filepaths, year,
+            hash_header_mapping(postcode_header, down_headers, up_headers))
+        filepaths = list(content_hashes)
+
+    live_tables = get_import_tables()
+    live_tables = (list(live_tables.readings.values()) +
+                   list(live_tables.rollups.values()))
+    if shadow and filepaths:
+        with session.bind.connect() as connection:
+            create_shadow_tables(connection, live_tables)
+
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    if jobs > 1 and not dry_run:
+        results = load_files_in_parallel(
+            settings, session, filepaths, jobs, year, headers,
+            postcode_header, down_headers, up_headers, batch_size,
+            chunk_size, shadow, profile_dir, content_hashes)
+    else:
+        results = [
+            timed_load_file(session, profile_dir, filepath, year, headers,
+                            postcode_header, down_headers, up_headers,
+                            batch_size, dry_run, chunk_size, shadow,
+                            content_hash=content_hashes.get(filepath))
+            for filepath in filepaths]
+    log_summary(results)
+
+    loaded_files = [result.loaded_file for result in results
+                    if result.loaded_file is not None]
+    failures = [(result.filepath, result.error) for result in results
+                if result.error is not None]
+
+    if shadow and filepaths:
+        with session.bind.connect() as connection:
+            if not loaded_files:
+                drop_shadow_tables(connection, live_tables)
+            else:
+                try:
+                    generation = swap_shadow_tables(
+                        connection, live_tables,
+                        lambda connection: publish_swapped_files(
+                            connection, loaded_files, year))
+                except Exception:
+                    _logger.exception('Failed to publish {} files'
+                                      ''.format(len(loaded_files)))
+                    sys.exit(1)
+                _logger.info('Published {} files as dataset generation {}'
+                             ''.format(len(loaded_files), generation))
+
+    snapshot_path = settings.get('store.snapshot')
+    if snapshot_path and not dry_run:
+        with transaction.manager:
+            save_snapshot(session, snapshot_path)
+
+    if failures:
+        _logger.error('Failed to load {} of {} files:'
+                      ''.format(len(failures), len(filepaths)))
+        for filepath, error in failures:
+            _logger.error('    {}: {}'.format(filepath, error))
+        sys.exit(1)
 
     _logger.info('Done.')
 
@@ -3,9 +3,10 @@ from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from zope.sqlalchemy import register
 
+from demo.api.common.utils.replicas import RoutingSession
 from demo.api.models.sql import Base  # noqa
 
-Session = scoped_session(sessionmaker())
+Session = scoped_session(sessionmaker(class_=RoutingSession))
 register(Session)
 
 bakery = baked.bakery()
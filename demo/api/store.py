@@ -0,0 +1,435 @@
+"""In-memory readings store.
+
+Serves average lookups without the database. The latest download and upload
+readings of every postcode and connection type are held in flat arrays:
+
+    keys    -- sorted packed postcode keys, one 4 byte integer per postcode
+    values  -- download and upload pairs of every connection type per
+               postcode, 8 byte floats, NaN when missing
+
+Lookups are a binary search over the keys (see
+demo.api.common.utils.postcodes.pack_postcode), no Python objects are kept per
+postcode. Each postcode uses 4 + 5 * 2 * 8 = 84 bytes, about 80MiB per
+million postcodes.
+
+Enable the store in the ini file; the readings are loaded at startup:
+
+    store.enabled = true
+
+Alternatively serve the store from a snapshot file written by
+`demo-api-snapshot` (or by `demo-api-updatedb` when `store.snapshot` is set):
+
+    store.snapshot = /var/lib/demo-api/readings.snapshot
+
+The snapshot is memory mapped read-only, so every worker process on a node
+shares the same page cache copy and no readings are loaded at startup. When
+the snapshot is missing, unreadable or does not match the database, lookups
+fall back to SQL.
+
+The store is checked against the dataset generation of every lookup. After
+an import the lookups fall back to SQL while the snapshot is reopened, or the
+readings are reloaded, in a background thread (see CurrentReadingsStore).
+
+Snapshot layout, in native byte order:
+
+    header  -- magic, format version, byte order marker, categories count,
+               postcodes count and the dataset generation; padded to
+               SNAPSHOT_HEADER_SIZE bytes
+    keys    -- 4 byte packed postcode keys, padded to a multiple of 8 bytes
+    values  -- 8 byte float readings as in the store
+"""
+from array import array
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from pyramid.settings import asbool
+from sqlalchemy.orm import sessionmaker
+from zope.interface import implementer
+from zope.interface import Interface
+
+from demo.api.common.utils.dataset import get_dataset_generation
+from demo.api.common.utils.postcodes import PostcodeIndex
+from demo.api.common.utils.postcodes import get_postcode_areas
+from demo.api.common.utils.postcodes import get_postcode_districts
+from demo.api.common.utils.postcodes import get_postcode_units
+from demo.api.common.utils.postcodes import pack_postcode
+from demo.api.models.sql import Base
+from demo.api.models.sql.readings import all_tables
+
+_logger = logging.getLogger(__name__)
+
+CATEGORIES = sorted(all_tables)
+BYTES_PER_POSTCODE = 4 + len(CATEGORIES) * 2 * 8
+
+SNAPSHOT_MAGIC = b'DEMOSNAP'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER_SIZE = 256
+_SNAPSHOT_BYTE_ORDER_MARKER = 0x01020304
+_snapshot_header = struct.Struct('=8sIIIQq')
+
+
+class IReadingsStore(Interface):
+    pass
+
+
+class ReadingsStore(object):
+    """Latest readings of every postcode held in flat arrays.
+
+    Lookup methods mirror the SQL lookups of the average views.
+
+        generation: the dataset generation of the readings, None when unknown
+
+    """
+
+    def __init__(self, keys, values, generation=None):
+        if len(values) != len(keys) * len(CATEGORIES) * 2:
+            raise ValueError('Invalid readings store size')
+        self.keys = keys
+        self.values = values
+        self.generation = generation
+        self.index = PostcodeIndex(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, postcode_key):
+        return postcode_key in self.index
+
+    @property
+    def nbytes(self):
+        return (len(self.keys) * self.keys.itemsize +
+                len(self.values) * self.values.itemsize)
+
+    @classmethod
+    def load(cls, session):
+        """Load the latest readings of every reading table."""
+        generation = get_dataset_generation(session)
+        areas = {id: area for area, id in get_postcode_areas(session)}
+        districts = {id: district
+                     for district, id in get_postcode_districts(session)}
+        units = {id: unit for unit, id in get_postcode_units(session)}
+
+        tables_readings = []
+        for category in CATEGORIES:
+            table = all_tables[category]
+            columns = (table.postcode_area_id, table.postcode_district_id,
+                       table.postcode_sector, table.postcode_unit_id)
+            entries = (session.query(*columns + (table.download,
+                                                 table.upload))
+                       .order_by(*columns + (table.year,))
+                       .yield_per(10000))
+
+            # Entries are ordered by year, the latest one of every postcode
+            # is last
+            keys, downloads, uploads = array('i'), array('d'), array('d')
+            for (postcode_area_id, district_id, sector, unit_id, download,
+                 upload) in entries:
+                key = pack_postcode((areas[postcode_area_id],
+                                     districts[district_id], sector,
+                                     units[unit_id]))
+                if keys and keys[-1] == key:
+                    keys.pop()
+                    downloads.pop()
+                    uploads.pop()
+                keys.append(key)
+                downloads.append(math.nan if download is None else download)
+                uploads.append(math.nan if upload is None else upload)
+
+            # Database ids are not in postcode order
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            tables_readings.append((
+                array('i', (keys[i] for i in order)),
+                array('d', (downloads[i] for i in order)),
+                array('d', (uploads[i] for i in order))))
+
+        return cls.from_tables(tables_readings, generation)
+
+    @classmethod
+    def from_tables(cls, tables_readings, generation=None):
+        """Create a store from sorted readings arrays.
+
+            tables_readings: a (keys, downloads, uploads) tuple of arrays for
+                             every category in CATEGORIES order, keys sorted
+            generation: the dataset generation of the readings
+
+        """
+        keys = array('i', sorted(set().union(
+            *(table_keys for table_keys, _, _ in tables_readings))))
+
+        width = len(CATEGORIES) * 2
+        values = array('d', [math.nan]) * (len(keys) * width)
+        for category_i, (table_keys, downloads, uploads) in enumerate(
+                tables_readings):
+            row = 0
+            for table_row, key in enumerate(table_keys):
+                while keys[row] != key:
+                    row += 1
+                offset = row * width + category_i * 2
+                values[offset] = downloads[table_row]
+                values[offset + 1] = uploads[table_row]
+
+        return cls(keys, values, generation)
+
+    def _get_entry(self, row, category):
+        offset = row * len(CATEGORIES) * 2 + CATEGORIES.index(category) * 2
+        download = self.values[offset]
+        upload = self.values[offset + 1]
+        if math.isnan(download) and math.isnan(upload):
+            return None
+
+        return {'connection': all_tables[category].reading_type,
+                'upload': None if math.isnan(upload) else upload,
+                'download': None if math.isnan(download) else download}
+
+    def get_averages(self, categories, postcode_key):
+        """Get averages of a packed postcode key.
+
+        See views._averages._get_averages.
+        """
+        row = self.index.find(postcode_key)
+        if row is None:
+            return []
+
+        results = []
+        for category in categories:
+            entry = self._get_entry(row, category)
+            if entry:
+                results.append(entry)
+        return results
+
+    def get_batch_averages(self, categories_keys):
+        """Get averages of packed postcode keys.
+
+        See views._averages._get_batch_averages.
+        """
+        results = {}
+        for category, keys in categories_keys.items():
+            for postcode_key in keys:
+                row = self.index.find(postcode_key)
+                if row is None:
+                    continue
+                entry = self._get_entry(row, category)
+                if entry:
+                    results[category, postcode_key] = entry
+        return results
+
+
+def write_snapshot(store, generation, path):
+    """Write a store to a snapshot file.
+
+    The snapshot is written to a temporary file that replaces `path` once
+    complete, processes that mapped the previous snapshot keep their copy.
+    """
+    header = _snapshot_header.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, _SNAPSHOT_BYTE_ORDER_MARKER,
+        len(CATEGORIES), len(store), generation)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory,
+                                                  suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as snapshot:
+            snapshot.write(header.ljust(SNAPSHOT_HEADER_SIZE, b'\0'))
+            snapshot.write(store.keys)
+            snapshot.write(b'\0' * (-snapshot.tell() % 8))
+            snapshot.write(store.values)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def open_snapshot(path):
+    """Open a snapshot file as a memory mapped store.
+
+    Returns:
+        A tuple of the store and the dataset generation it was made from
+
+    """
+    with open(path, 'rb') as snapshot:
+        buffer = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(buffer) < SNAPSHOT_HEADER_SIZE:
+        raise ValueError('Invalid snapshot {!r}'.format(path))
+
+    header = _snapshot_header.unpack_from(buffer)
+    magic, version, marker, categories_count, count = header[:5]
+    if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or
+            marker != _SNAPSHOT_BYTE_ORDER_MARKER or
+            categories_count != len(CATEGORIES)):
+        raise ValueError('Unsupported snapshot {!r}'.format(path))
+
+    keys_end = SNAPSHOT_HEADER_SIZE + count * 4
+    values_start = keys_end + (-keys_end % 8)
+    values_end = values_start + count * len(CATEGORIES) * 2 * 8
+    if len(buffer) != values_end:
+        raise ValueError('Truncated snapshot {!r}'.format(path))
+
+    view = memoryview(buffer)
+    store = ReadingsStore(view[SNAPSHOT_HEADER_SIZE:keys_end].cast('i'),
+                          view[values_start:values_end].cast('d'), header[5])
+    return store, header[5]
+
+
+def save_snapshot(session, path):
+    """Load the store from the database and write it to a snapshot file."""
+    generation = get_dataset_generation(session)
+    store = ReadingsStore.load(session)
+    write_snapshot(store, generation, path)
+
+    _logger.info('Wrote {} postcodes of dataset generation {} to readings '
+                 'snapshot {}'.format(len(store), generation, path))
+    return store
+
+
+def open_current_snapshot(session, path):
+    """Open a snapshot if it matches the database.
+
+    Returns:
+        The store or None when the snapshot is missing, invalid or stale
+
+    """
+    try:
+        store, generation = open_snapshot(path)
+    except (OSError, ValueError) as error:
+        _logger.warning('Ignoring readings snapshot: {}'.format(error))
+        return None
+
+    if generation != get_dataset_generation(session):
+        _logger.warning('Ignoring stale readings snapshot {}'.format(path))
+        return None
+
+    return store
+
+
+@implementer(IReadingsStore)
+class CurrentReadingsStore(object):
+    """The readings store of the current dataset generation.
+
+    Imports change the dataset generation after the store was loaded. `get`
+    returns the store only while its generation matches the one a request is
+    served from, so lookups fall back to SQL instead of answering with stale
+    readings. The store is then reloaded in a background thread, at most
+    every `retry_interval` seconds, e.g. while the snapshot of the new
+    generation is still being written. Requests holding the previous store
+    keep using it.
+
+    Imports change the generation once per committed file. Loading the
+    readings from the database scans every reading table, so reloads wait
+    until the generation did not change for `reload_delay` seconds instead
+    of reloading after every file.
+
+        loader: a function called with a session returning a store or None,
+                e.g. ReadingsStore.load
+        bind: the engine the store is loaded from
+        retry_interval: seconds between reload attempts
+        reload_delay: seconds the generation must stay unchanged before
+                      reloading
+
+    """
+
+    def __init__(self, loader, bind, retry_interval=5.0, reload_delay=0.0):
+        self.loader = loader
+        self.bind = bind
+        self.retry_interval = retry_interval
+        self.reload_delay = reload_delay
+        self.store = None
+        self._lock = threading.Lock()
+        self._attempted = None
+        self._reload_thread = None
+        self._pending_generation = None
+        self._pending_since = None
+
+    def get(self, generation):
+        """Get the store of a dataset generation, None when not loaded."""
+        store = self.store
+        if store is not None and store.generation == generation:
+            return store
+
+        if store is None or store.generation is None or (
+                store.generation < generation):
+            now = time.monotonic()
+            with self._lock:
+                if generation != self._pending_generation:
+                    self._pending_generation = generation
+                    self._pending_since = now
+                settled = now - self._pending_since >= self.reload_delay
+            if settled:
+                self._start_reload()
+        return None
+
+    def _start_reload(self):
+        with self._lock:
+            if (self._reload_thread is not None and
+                    self._reload_thread.is_alive()):
+                return
+            now = time.monotonic()
+            if (self._attempted is not None and
+                    now - self._attempted < self.retry_interval):
+                return
+            self._attempted = now
+            self._reload_thread = threading.Thread(
+                target=self._run_reload, name='readings-store-reload',
+                daemon=True)
+            self._reload_thread.start()
+
+    def _run_reload(self):
+        try:
+            self.reload()
+        except Exception:
+            _logger.exception('Failed to reload the readings store')
+
+    def reload(self):
+        """Load the store in the calling thread, within its own session."""
+        session = sessionmaker(bind=self.bind)()
+        try:
+            store = self.loader(session)
+        finally:
+            session.close()
+
+        if store is not None:
+            _logger.info('Loaded {} postcodes of dataset generation {} into '
+                         'the readings store ({} bytes)'.format(
+                             len(store), store.generation, store.nbytes))
+            self.store = store
+        return store
+
+    def wait_for_reload(self):
+        """Block until a background reload is done."""
+        thread = self._reload_thread
+        if thread is not None:
+            thread.join()
+
+
+def includeme(config):
+    settings = config.get_settings()
+    snapshot_path = settings.get('store.snapshot')
+    if (not snapshot_path and
+            not asbool(settings.get('store.enabled', False))):
+        return
+
+    # Snapshots are reopened as soon as they are rewritten, readings are
+    # reloaded from the database once imports are done
+    if snapshot_path:
+        def loader(session):
+            return open_current_snapshot(session, snapshot_path)
+        reload_delay = 0.0
+    else:
+        loader = ReadingsStore.load
+        reload_delay = float(settings.get('store.reload_delay', 60))
+
+    # Reload attempts follow the dataset generation checks of the postcode
+    # cache
+    store = CurrentReadingsStore(
+        loader, Base.metadata.bind,
+        retry_interval=float(settings.get('postcodes.check_interval', 5)),
+        reload_delay=reload_delay)
+    store.reload()
+    config.registry.registerUtility(store, IReadingsStore)
@@ -0,0 +1,54 @@
+import unittest
+
+import sqlalchemy
+import transaction
+
+from demo.api.models.sql import dataset  # noqa
+from demo.api.models.sql import rollups  # noqa
+from demo.api.models.sql import staging  # noqa
+from demo.api.models.sql.postcode import PostcodeArea
+from demo.api.models.sql.postcode import PostcodeDistrict
+from demo.api.models.sql.postcode import PostcodeUnit
+from demo.api.models.sql.readings import all_tables
+from demo.api.sql import Base
+from demo.api.sql import Session
+
+
+class DatabaseTestBase(unittest.TestCase):
+    """Binds the application session to an in-memory SQLite database."""
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        Session.configure(bind=self.engine)
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        self.engine.dispose()
+
+    def add_postcode(self, area, district, unit):
+        """Add postcode parts, returning their ids."""
+        ids = []
+        for model, column, value in ((PostcodeArea, 'area', area),
+                                     (PostcodeDistrict, 'district', district),
+                                     (PostcodeUnit, 'unit', unit)):
+            entry = (Session.query(model)
+                     .filter(getattr(model, column) == value)
+                     .first())
+            if entry is None:
+                entry = model(**{column: value})
+                Session.add(entry)
+                Session.flush()
+            ids.append(entry.id)
+        return tuple(ids)
+
+    def add_reading(self, category, postcode_parts, year, download, upload):
+        area, district, sector, unit = postcode_parts
+        area_id, district_id, unit_id = self.add_postcode(area, district, unit)
+        Session.add(all_tables[category](
+            postcode_area_id=area_id, postcode_district_id=district_id,
+            postcode_sector=sector, postcode_unit_id=unit_id, year=year,
+            download=download, upload=upload))
+        Session.flush()
+        return area_id, district_id, sector, unit_id
@@ -0,0 +1,433 @@
+import csv
+import os
+import tempfile
+import unittest
+import zipfile
+
+import sqlalchemy
+import transaction
+
+from demo.api.common.utils.dataset import get_dataset_generation
+from demo.api.common.utils.dataset import get_imported_files
+from demo.api.common.utils.shadow import create_shadow_tables
+from demo.api.common.utils.shadow import swap_shadow_tables
+from demo.api.common.utils.timers import PhaseTimer
+from demo.api.models.sql.dataset import DatasetGeneration
+from demo.api.models.sql.postcode import PostcodeArea
+from demo.api.models.sql.postcode import PostcodeDistrict
+from demo.api.models.sql.postcode import PostcodeUnit
+from demo.api.models.sql.readings import Reading
+from demo.api.models.sql.readings import ReadingBB
+from demo.api.models.sql.readings import all_tables
+from demo.api.models.sql.rollups import AreaRollup
+from demo.api.models.sql.staging import StagedReading
+from demo.api.scripts import init_sqlalchemy
+from demo.api.scripts.init_db import create_missing_indexes
+from demo.api.scripts.update_db import DEFAULT_DOWNLOAD_CSV_HEADERS
+from demo.api.scripts.update_db import DEFAULT_UPLOAD_CSV_HEADERS
+from demo.api.scripts.update_db import POSTCODE_CSV_HEADER
+from demo.api.scripts.update_db import get_changed_files
+from demo.api.scripts.update_db import get_import_tables
+from demo.api.scripts.update_db import hash_file
+from demo.api.scripts.update_db import hash_header_mapping
+from demo.api.scripts.update_db import list_csv_files
+from demo.api.scripts.update_db import load_file
+from demo.api.scripts.update_db import load_files_in_parallel
+from demo.api.scripts.update_db import publish_swapped_files
+from demo.api.scripts.update_db import replace_header_arg
+from demo.api.scripts.update_db import timed_load_file
+from demo.api.sql import Base
+from demo.api.sql import Session
+from demo.api.tests import DatabaseTestBase
+
+
+class CreateMissingIndexesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def get_index_names(self, table):
+        return set(index['name'] for index in
+                   sqlalchemy.inspect(self.engine).get_indexes(table.name))
+
+    def test_create_missing_indexes(self):
+        Base.metadata.create_all(self.engine)
+        for index in Reading.__table__.indexes:
+            index.drop(self.engine)
+
+        created = create_missing_indexes(self.engine)
+
+        self.assertEqual([index.name for index in created],
+                         ['average_lookup_idx'])
+        self.assertIn('average_lookup_idx',
+                      self.get_index_names(Reading.__table__))
+
+    def test_create_missing_indexes_up_to_date(self):
+        Base.metadata.create_all(self.engine)
+
+        self.assertEqual(create_missing_indexes(self.engine), [])
+
+    def test_create_missing_indexes_skips_missing_tables(self):
+        ReadingBB.__table__.create(self.engine)
+        for index in ReadingBB.__table__.indexes:
+            index.drop(self.engine)
+
+        created = create_missing_indexes(self.engine)
+
+        self.assertEqual([index.name for index in created], ['BB_lookup_idx'])
+
+
+class CsvFilesMixin(object):
+
+    def setUp(self):
+        super(CsvFilesMixin, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        self.down_headers = {}
+        for header in DEFAULT_DOWNLOAD_CSV_HEADERS:
+            replace_header_arg(self.down_headers, header)
+        self.up_headers = {}
+        for header in DEFAULT_UPLOAD_CSV_HEADERS:
+            replace_header_arg(self.up_headers, header)
+
+    def write_csv(self, name, rows):
+        """Write a csv of postcode, average download and upload rows."""
+        filepath = os.path.join(self.directory.name, name)
+        headers = ([POSTCODE_CSV_HEADER] +
+                   list(self.down_headers.values()) +
+                   list(self.up_headers.values()))
+        with open(filepath, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, headers, restval='')
+            writer.writeheader()
+            for postcode, download, upload in rows:
+                writer.writerow({POSTCODE_CSV_HEADER: postcode,
+                                 self.down_headers['0']: download,
+                                 self.up_headers['0']: upload})
+        return filepath
+
+
+class LoadFileTests(CsvFilesMixin, DatabaseTestBase):
+
+    def load_file(self, filepath, year=2016, batch_size=1000,
+                  dry_run=False, chunk_size=None, shadow=False):
+        headers = set([POSTCODE_CSV_HEADER]).union(
+            self.down_headers.values(), self.up_headers.values())
+        return load_file(Session, filepath, year, headers,
+                         POSTCODE_CSV_HEADER, self.down_headers,
+                         self.up_headers, batch_size, dry_run, chunk_size,
+                         shadow)
+
+    def get_readings(self):
+        return sorted(
+            (area.area, district.district, reading.postcode_sector,
+             unit.unit, reading.year, reading.download, reading.upload)
+            for reading, area, district, unit in (
+                Session.query(Reading, PostcodeArea, PostcodeDistrict,
+                              PostcodeUnit)
+                .join(PostcodeArea).join(PostcodeDistrict)
+                .join(PostcodeUnit)))
+
+    def test_load_file(self):
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1.5', '0.5'),
+                                             ('AB10 2AA', '', ''),
+                                             ('AB11 1AU', '2.5', ''),
+                                             ('AB10 1AU', '3.5', '1.5')])
+
+        self.load_file(filepath, batch_size=1)
+
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2016, 3.5, 1.5),
+            ('AB', '11', '1', 'AU', 2016, 2.5, None)])
+        self.assertEqual(Session.query(ReadingBB).count(), 0)
+        self.assertEqual(get_dataset_generation(Session), 1)
+
+    def test_load_file_replaces_year(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1'),
+                                                 ('AB10 1AA', '1', '1')]))
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                       year=2015)
+
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '2', '2')]))
+
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2015, 1, 1),
+            ('AB', '10', '1', 'AU', 2016, 2, 2)])
+
+    def test_load_file_timer(self):
+        timer = PhaseTimer()
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1', '1'),
+                                             ('AB10 1AA', '1', '1')])
+
+        load_file(Session, filepath, 2016, set([POSTCODE_CSV_HEADER]),
+                  POSTCODE_CSV_HEADER, self.down_headers, self.up_headers,
+                  1000, False, timer=timer)
+
+        self.assertEqual(timer.items, 2)
+        self.assertEqual(list(timer.durations), [
+            'hash', 'split_postcode', 'read', 'postcode_parts', 'delete',
+            'insert', 'rollups', 'publish', 'commit'])
+
+    def test_load_file_dry_run(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                       dry_run=True)
+
+        self.assertEqual(self.get_readings(), [])
+        self.assertEqual(Session.query(PostcodeArea).count(), 0)
+
+    def test_load_file_mixed_areas(self):
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1', '1'),
+                                             ('CD10 1AU', '1', '1')])
+
+        self.assertRaises(ValueError, self.load_file, filepath)
+
+    def test_timed_load_file_failure(self):
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1', '1'),
+                                             ('CD10 1AU', '1', '1')])
+        headers = set([POSTCODE_CSV_HEADER])
+
+        result = timed_load_file(
+            Session, None, filepath, 2016, headers, POSTCODE_CSV_HEADER,
+            self.down_headers, self.up_headers, 1000, False)
+
+        self.assertIsNone(result.loaded_file)
+        self.assertTrue(result.error.startswith('ValueError: '))
+        self.assertEqual(self.get_readings(), [])
+
+    def test_load_file_deletes_without_loading(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1'),
+                                                 ('AB10 1AA', '1', '1')]))
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '2', '2')]))
+
+        deletes = [statement for statement in statements
+                   if statement.startswith('DELETE FROM') and
+                   '_readings' in statement]
+        self.assertEqual(len(deletes), len(all_tables))
+        self.assertFalse(any(statement.startswith('SELECT') and
+                             'average_readings' in statement
+                             for statement in statements))
+
+    def get_changed_files(self, filepaths, year=2016):
+        return list(get_changed_files(
+            Session, filepaths, year,
+            hash_header_mapping(POSTCODE_CSV_HEADER, self.down_headers,
+                                self.up_headers)))
+
+    def test_load_file_records_imported_file(self):
+        filepaths = [self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                     self.write_csv('CD.csv', [('CD10 1AU', '1', '1')])]
+
+        self.load_file(filepaths[0])
+
+        self.assertEqual(list(get_imported_files(Session, 2016)), ['AB.csv'])
+        self.assertEqual(self.get_changed_files(filepaths), [filepaths[1]])
+        self.assertEqual(self.get_changed_files(filepaths, year=2015),
+                         filepaths)
+
+    def test_get_changed_files(self):
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1', '1')])
+        self.load_file(filepath)
+
+        self.write_csv('AB.csv', [('AB10 1AU', '2', '2')])
+        self.assertEqual(self.get_changed_files([filepath]), [filepath])
+
+        self.load_file(filepath)
+        self.assertEqual(self.get_changed_files([filepath]), [])
+
+        self.down_headers['0'] = 'download'
+        self.assertEqual(self.get_changed_files([filepath]), [filepath])
+
+    def test_load_file_changed_file_hash(self):
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1', '1')])
+        content_hashes = get_changed_files(
+            Session, [filepath], 2016,
+            hash_header_mapping(POSTCODE_CSV_HEADER, self.down_headers,
+                                self.up_headers))
+        self.assertEqual(content_hashes, {filepath: hash_file(filepath)})
+        timer = PhaseTimer()
+
+        load_file(Session, filepath, 2016, set([POSTCODE_CSV_HEADER]),
+                  POSTCODE_CSV_HEADER, self.down_headers, self.up_headers,
+                  1000, False, timer=timer,
+                  content_hash=content_hashes[filepath])
+
+        self.assertNotIn('hash', timer.durations)
+        self.assertEqual(get_imported_files(Session, 2016)['AB.csv'][0],
+                         content_hashes[filepath])
+
+    def test_load_file_from_zip_archive(self):
+        archive_path = os.path.join(self.directory.name, 'data.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.write(
+                self.write_csv('CD.csv', [('CD10 1AU', '2', '2')]),
+                'data/CD.csv')
+            archive.write(
+                self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                'data/AB.csv')
+            archive.writestr('data/README.txt', 'Not a csv file')
+
+        filepaths = list_csv_files(archive_path)
+        self.assertEqual(filepaths, [
+            os.path.join(archive_path, 'data', 'AB.csv'),
+            os.path.join(archive_path, 'data', 'CD.csv')])
+        self.assertEqual(
+            hash_file(filepaths[0]),
+            hash_file(os.path.join(self.directory.name, 'AB.csv')))
+
+        for filepath in filepaths:
+            self.load_file(filepath)
+
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2016, 1, 1),
+            ('CD', '10', '1', 'AU', 2016, 2, 2)])
+        self.assertEqual(sorted(get_imported_files(Session, 2016)),
+                         ['AB.csv', 'CD.csv'])
+
+    def test_load_file_shadow(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]))
+        live_tables = get_import_tables()
+        live_tables = (list(live_tables.readings.values()) +
+                       list(live_tables.rollups.values()))
+        with self.engine.connect() as connection:
+            create_shadow_tables(connection, live_tables)
+
+        loaded_files = [
+            self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '2', '2')]),
+                           shadow=True),
+            self.load_file(self.write_csv('CD.csv', [('CD10 1AU', '3', '3')]),
+                           chunk_size=1, shadow=True)]
+
+        # Readers keep seeing the live tables until they are swapped
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2016, 1, 1)])
+        self.assertEqual(get_dataset_generation(Session), 1)
+        transaction.abort()
+
+        with self.engine.connect() as connection:
+            generation = swap_shadow_tables(
+                connection, live_tables,
+                lambda connection: publish_swapped_files(
+                    connection, loaded_files, 2016))
+        self.assertEqual(generation, 2)
+
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2016, 2, 2),
+            ('CD', '10', '1', 'AU', 2016, 3, 3)])
+        self.assertEqual(sorted(Session.query(AreaRollup.download)
+                                .filter_by(category='0')), [(2,), (3,)])
+        self.assertEqual(get_dataset_generation(Session), 2)
+        self.assertEqual(sorted(get_imported_files(Session, 2016)),
+                         ['AB.csv', 'CD.csv'])
+
+    def test_load_file_in_chunks(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]))
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '1.5', '0.5'),
+                                             ('AB10 2AA', '', ''),
+                                             ('AB11 1AU', '2.5', ''),
+                                             ('AB10 1AU', '3.5', '1.5'),
+                                             ('AB12 1BB', '4.5', '4.5')])
+
+        self.load_file(filepath, batch_size=2, chunk_size=2)
+
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2016, 3.5, 1.5),
+            ('AB', '11', '1', 'AU', 2016, 2.5, None),
+            ('AB', '12', '1', 'BB', 2016, 4.5, 4.5)])
+        self.assertEqual(Session.query(AreaRollup.count)
+                         .filter_by(category='0').scalar(), 3)
+        self.assertEqual(Session.query(StagedReading).count(), 0)
+        self.assertEqual(get_dataset_generation(Session), 2)
+
+    def test_load_file_in_chunks_mixed_areas(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]))
+        filepath = self.write_csv('AB.csv', [('AB10 1AU', '2', '2'),
+                                             ('CD10 1AU', '2', '2')])
+
+        self.assertRaises(ValueError, self.load_file, filepath, chunk_size=1)
+
+        self.assertEqual(self.get_readings(), [
+            ('AB', '10', '1', 'AU', 2016, 1, 1)])
+        self.assertEqual(Session.query(StagedReading).count(), 0)
+
+    def test_load_file_in_chunks_dry_run(self):
+        self.load_file(self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                       dry_run=True, chunk_size=1)
+
+        self.assertEqual(Session.query(PostcodeArea).count(), 0)
+        self.assertEqual(Session.query(StagedReading).count(), 0)
+
+
+class LoadFilesInParallelTests(CsvFilesMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(LoadFilesInParallelTests, self).setUp()
+        url = 'sqlite:///' + os.path.join(self.directory.name, 'test.db')
+        Base.metadata.create_all(sqlalchemy.create_engine(url))
+        self.settings = {'sqlalchemy.url': url}
+        self.session = init_sqlalchemy(self.settings)
+        self.addCleanup(self.session.bind.dispose)
+
+    def load_files(self, filepaths):
+        headers = set([POSTCODE_CSV_HEADER]).union(
+            self.down_headers.values(), self.up_headers.values())
+        return load_files_in_parallel(
+            self.settings, self.session, filepaths, 2, 2016, headers,
+            POSTCODE_CSV_HEADER, self.down_headers, self.up_headers, 1000)
+
+    def test_load_files_in_parallel(self):
+        filepaths = [
+            self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+            self.write_csv('CD.csv', [('CD10 1AU', '2', '2'),
+                                      ('CD11 1AA', '3', '3')]),
+            self.write_csv('EF.csv', [('EF10 1AU', '1', '1'),
+                                      ('GH10 1AU', '1', '1')])]
+
+        results = self.load_files(filepaths)
+
+        self.assertEqual([result.filepath for result in results], filepaths)
+        self.assertEqual([result.loaded_file.filepath
+                          for result in results[:2]], filepaths[:2])
+        self.assertEqual([result.timer.items for result in results[:2]],
+                         [1, 2])
+        self.assertIsNone(results[2].loaded_file)
+        self.assertIsNotNone(results[2].error)
+        self.assertEqual(self.session.query(Reading).count(), 3)
+        # Postcode parts are added up front in sorted order
+        self.assertEqual(
+            self.session.query(PostcodeUnit.unit)
+            .order_by(PostcodeUnit.id).all(), [('AA',), ('AU',)])
+
+    def test_load_files_in_parallel_area_in_several_files(self):
+        filepaths = [self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                     self.write_csv('AB2.csv', [('AB11 1AU', '1', '1')]),
+                     self.write_csv('CD.csv', [('CD10 1AU', '1', '1')])]
+
+        results = self.load_files(filepaths)
+
+        self.assertEqual([result.filepath for result in results], filepaths)
+        for result in results[:2]:
+            self.assertIsNone(result.loaded_file)
+            self.assertTrue(result.error.startswith(
+                "ValueError: Postal area 'AB' in several files"))
+        self.assertIsNone(results[2].error)
+        self.assertEqual(self.session.query(Reading).count(), 1)
+        self.assertEqual(self.session.query(PostcodeArea.area).all(),
+                         [('CD',)])
+
+    def test_load_files_in_parallel_first_generation(self):
+        filepaths = [self.write_csv('AB.csv', [('AB10 1AU', '1', '1')]),
+                     self.write_csv('CD.csv', [('CD10 1AU', '1', '1')])]
+        self.assertEqual(self.session.query(DatasetGeneration).count(), 0)
+
+        results = self.load_files(filepaths)
+
+        self.assertEqual([result.error for result in results], [None, None])
+        self.assertEqual(get_dataset_generation(self.session), 2)
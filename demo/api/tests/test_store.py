@@ -0,0 +1,303 @@
+from array import array
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from pyramid import testing
+import sqlalchemy
+import transaction
+
+from demo.api.schemas import AverageQuerySchema
+from demo.api.store import BYTES_PER_POSTCODE
+from demo.api.store import CATEGORIES
+from demo.api.store import CurrentReadingsStore
+from demo.api.store import IReadingsStore
+from demo.api.store import ReadingsStore
+from demo.api.common.utils.dataset import get_dataset_generation
+from demo.api.common.utils.dataset import increment_dataset_generation
+from demo.api.store import open_current_snapshot
+from demo.api.store import open_snapshot
+from demo.api.store import save_snapshot
+from demo.api.store import write_snapshot
+from demo.api.common.utils.postcodes import pack_postcode
+from demo.api.tests import DatabaseTestBase
+from demo.api.views import clear_postcode_caching
+from demo.api.views import get_averages
+from demo.api.sql import Base
+from demo.api.sql import Session
+
+
+def make_key(unit, sector='1'):
+    return pack_postcode(('AB', '10', sector, unit))
+
+
+class ReadingsStoreTests(unittest.TestCase):
+
+    def make_store(self, count):
+        # Every integer below POSTCODE_KEY_LIMIT is a valid packed key
+        keys = array('i', range(count))
+        tables_readings = [(keys, array('d', [1.0]) * count,
+                            array('d', [2.0]) * count)]
+        tables_readings.extend((array('i'), array('d'), array('d'))
+                               for _ in CATEGORIES[1:])
+        return ReadingsStore.from_tables(tables_readings)
+
+    def test_from_tables(self):
+        store = ReadingsStore.from_tables([
+            (array('i', [make_key('AA'), make_key('AC')]),
+             array('d', [1.0, 3.0]), array('d', [0.5, math.nan])),
+            (array('i', [make_key('AB')]),
+             array('d', [2.0]), array('d', [1.0])),
+            (array('i'), array('d'), array('d')),
+            (array('i'), array('d'), array('d')),
+            (array('i'), array('d'), array('d'))])
+
+        self.assertEqual(len(store), 3)
+        self.assertIn(make_key('AB'), store)
+        self.assertNotIn(make_key('AD'), store)
+        self.assertEqual(store.get_averages(['0', '1'], make_key('AA')), [
+            {'connection': 'average', 'download': 1.0, 'upload': 0.5}])
+        self.assertEqual(store.get_averages(['0', '1'], make_key('AB')), [
+            {'connection': 'slow', 'download': 2.0, 'upload': 1.0}])
+        self.assertEqual(store.get_averages(['0'], make_key('AC')), [
+            {'connection': 'average', 'download': 3.0, 'upload': None}])
+        self.assertEqual(store.get_averages(['0'], make_key('AD')), [])
+
+    def test_get_batch_averages(self):
+        store = self.make_store(3)
+
+        key, missing_key = 1, 5
+
+        self.assertEqual(
+            store.get_batch_averages({'0': {key, missing_key},
+                                      '1': {key}}),
+            {('0', key): {'connection': 'average', 'download': 1.0,
+                          'upload': 2.0}})
+
+    def test_memory_per_million_postcodes(self):
+        count = 100000
+        store = self.make_store(count)
+
+        self.assertEqual(store.nbytes, count * BYTES_PER_POSTCODE)
+        self.assertLess(sys.getsizeof(store.keys) +
+                        sys.getsizeof(store.values),
+                        count * BYTES_PER_POSTCODE * 1.01)
+        # Documented in the module docstring
+        self.assertLess(1000000 * BYTES_PER_POSTCODE, 80 * 2 ** 20 + 2 ** 19)
+
+
+class ReadingsStoreLoadTests(DatabaseTestBase):
+
+    def setUp(self):
+        super(ReadingsStoreLoadTests, self).setUp()
+        testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+        clear_postcode_caching()
+        super(ReadingsStoreLoadTests, self).tearDown()
+
+    def test_load(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 2.0, 1.0)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2015, 1.0, 0.5)
+        self.add_reading('4', ('AB', '10', '1', 'AU'), 2016, None, 20.0)
+        self.add_reading('2', ('AB', '10', '2', 'AA'), 2014, 5.0, 1.0)
+        # Added last, the ids of the postcode parts are not in postcode order
+        self.add_reading('2', ('AA', '1', '2', 'AA'), 2014, 6.0, 1.0)
+
+        store = ReadingsStore.load(Session())
+
+        self.assertEqual(len(store), 3)
+        self.assertEqual(
+            store.get_averages(CATEGORIES, make_key('AU')), [
+                {'connection': 'average', 'download': 2.0, 'upload': 1.0},
+                {'connection': 'UFBB', 'download': None, 'upload': 20.0}])
+        self.assertEqual(
+            store.get_averages(CATEGORIES, make_key('AA', sector='2')), [
+                {'connection': 'BB', 'download': 5.0, 'upload': 1.0}])
+        self.assertEqual(
+            store.get_averages(CATEGORIES,
+                               pack_postcode(('AA', '1', '2', 'AA'))), [
+                {'connection': 'BB', 'download': 6.0, 'upload': 1.0}])
+
+    def test_get_averages_view_uses_store(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 2.0, 1.0)
+        store = ReadingsStore.load(Session())
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2017, 3.0, 1.5)
+
+        current_store = CurrentReadingsStore(ReadingsStore.load, self.engine)
+        current_store.store = store
+
+        request = testing.DummyRequest()
+        request.registry.registerUtility(current_store, IReadingsStore)
+        request.validated = AverageQuerySchema().deserialize(
+            {'postcode': 'AB101AU'})
+
+        self.assertEqual(get_averages(request), [
+            {'connection': 'average', 'download': '2.0', 'upload': '1.0'}])
+
+
+class SnapshotTests(DatabaseTestBase):
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'readings.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(SnapshotTests, self).tearDown()
+
+    def test_write_snapshot(self):
+        keys = array('i', [make_key('AA'), make_key('AB'), make_key('AC')])
+        values = array('d', range(len(keys) * len(CATEGORIES) * 2))
+        write_snapshot(ReadingsStore(keys, values), 3, self.path)
+
+        store, generation = open_snapshot(self.path)
+
+        self.assertEqual(generation, 3)
+        self.assertEqual(list(store.keys), list(keys))
+        self.assertEqual(list(store.values), list(values))
+        self.assertEqual(store.get_averages(['1'], make_key('AB')), [
+            {'connection': 'slow', 'download': 12.0, 'upload': 13.0}])
+
+    def test_open_snapshot_truncated(self):
+        write_snapshot(ReadingsStore.load(Session()), 1, self.path)
+        with open(self.path, 'ab') as snapshot:
+            snapshot.write(b'\0')
+
+        self.assertRaises(ValueError, open_snapshot, self.path)
+
+    def test_open_current_snapshot(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 2.0, 1.0)
+        save_snapshot(Session(), self.path)
+
+        store = open_current_snapshot(Session(), self.path)
+
+        self.assertEqual(store.get_averages(['0'], make_key('AU')), [
+            {'connection': 'average', 'download': 2.0, 'upload': 1.0}])
+
+    def test_open_current_snapshot_stale(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 2.0, 1.0)
+        save_snapshot(Session(), self.path)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2017, 3.0, 1.0)
+        increment_dataset_generation(Session())
+
+        self.assertEqual(get_dataset_generation(Session()), 1)
+        self.assertIsNone(open_current_snapshot(Session(), self.path))
+
+    def test_open_current_snapshot_missing(self):
+        self.assertIsNone(open_current_snapshot(Session(), self.path))
+
+
+class CurrentReadingsStoreTests(DatabaseTestBase):
+    """Stores reload in another thread, so the database is a file."""
+
+    def setUp(self):
+        testing.setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'readings.snapshot')
+        self.engine = sqlalchemy.create_engine('sqlite:///{}'.format(
+            os.path.join(self.directory, 'test.db')))
+        Base.metadata.create_all(self.engine)
+        Session.configure(bind=self.engine)
+
+    def tearDown(self):
+        super(CurrentReadingsStoreTests, self).tearDown()
+        clear_postcode_caching()
+        testing.tearDown()
+        shutil.rmtree(self.directory)
+
+    def import_reading(self, year, download):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), year, download, 1.0)
+        increment_dataset_generation(Session())
+        transaction.commit()
+
+    def test_get_averages_view_reloads_stale_store(self):
+        self.import_reading(2016, 2.0)
+        current_store = CurrentReadingsStore(ReadingsStore.load, self.engine)
+        current_store.reload()
+        self.import_reading(2017, 3.0)
+
+        request = testing.DummyRequest()
+        request.registry.registerUtility(current_store, IReadingsStore)
+        request.validated = AverageQuerySchema().deserialize(
+            {'postcode': 'AB101AU'})
+
+        # Served from the database while the store reloads
+        self.assertEqual(get_averages(request), [
+            {'connection': 'average', 'download': '3.0', 'upload': '1.0'}])
+        current_store.wait_for_reload()
+        self.assertEqual(current_store.store.generation, 2)
+        self.assertIs(current_store.get(2), current_store.store)
+        self.assertEqual(get_averages(request), [
+            {'connection': 'average', 'download': '3.0', 'upload': '1.0'}])
+
+    def test_reopen_snapshot(self):
+        self.import_reading(2016, 2.0)
+        save_snapshot(Session(), self.path)
+        current_store = CurrentReadingsStore(
+            lambda session: open_current_snapshot(session, self.path),
+            self.engine, retry_interval=0)
+        current_store.reload()
+        store = current_store.get(1)
+        self.assertIsNotNone(store)
+
+        self.import_reading(2017, 3.0)
+
+        # The snapshot of the new generation is not written yet
+        self.assertIsNone(current_store.get(2))
+        current_store.wait_for_reload()
+        self.assertIs(current_store.store, store)
+
+        save_snapshot(Session(), self.path)
+        self.assertIsNone(current_store.get(2))
+        current_store.wait_for_reload()
+
+        self.assertEqual(
+            current_store.get(2).get_averages(['0'], make_key('AU')), [
+                {'connection': 'average', 'download': 3.0, 'upload': 1.0}])
+
+    def test_get_newer_store(self):
+        self.import_reading(2016, 2.0)
+        current_store = CurrentReadingsStore(ReadingsStore.load, self.engine)
+        current_store.reload()
+
+        # Requests of an older generation do not reload
+        self.assertIsNone(current_store.get(0))
+        self.assertIsNone(current_store._reload_thread)
+
+    @mock.patch('demo.api.store.time.monotonic')
+    def test_reload_after_imports(self, monotonic):
+        loads = []
+
+        def loader(session):
+            loads.append(get_dataset_generation(session))
+            return ReadingsStore.load(session)
+
+        monotonic.return_value = 0.0
+        self.import_reading(2016, 2.0)
+        current_store = CurrentReadingsStore(
+            loader, self.engine, retry_interval=0, reload_delay=10)
+        current_store.reload()
+
+        # The generation changes after every imported file
+        self.import_reading(2017, 3.0)
+        self.assertIsNone(current_store.get(2))
+        monotonic.return_value = 5.0
+        self.import_reading(2018, 4.0)
+        self.assertIsNone(current_store.get(3))
+        monotonic.return_value = 14.0
+        self.assertIsNone(current_store.get(3))
+        self.assertIsNone(current_store._reload_thread)
+
+        # The import is done once the generation stays unchanged
+        monotonic.return_value = 15.0
+        self.assertIsNone(current_store.get(3))
+        current_store.wait_for_reload()
+        self.assertIsNotNone(current_store.get(3))
+        self.assertEqual(loads, [1, 3])
@@ -1,6 +1,42 @@
+from array import array
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
+import sqlalchemy
+import transaction
+
+from demo.api.common.utils.cache import ResponseCache
+from demo.api.common.utils.dataset import get_dataset_generation
+from demo.api.common.utils.dataset import get_postcode_area_versions
+from demo.api.common.utils.dataset import increment_dataset_generation
+from demo.api.common.utils.dataset import set_postcode_area_version
+from demo.api.common.utils.postcodes import POSTCODE_KEY_LIMIT
+from demo.api.common.utils.postcodes import PostcodeCache
+from demo.api.common.utils.postcodes import PostcodeIndex
+from demo.api.common.utils.postcodes import pack_postcode
+from demo.api.common.utils.postcodes import postcode_key_range
 from demo.api.common.utils.postcodes import split_postcode
+from demo.api.common.utils.postcodes import split_postcode_prefix
+from demo.api.common.utils.rollups import update_rollups
+from demo.api.common.utils.shadow import create_shadow_tables
+from demo.api.common.utils.shadow import drop_shadow_tables
+from demo.api.common.utils.shadow import get_shadow_table
+from demo.api.common.utils.shadow import swap_shadow_tables
+from demo.api.common.utils.settings import sqlalchemy_engine_from_config
+from demo.api.common.utils.settings import sqlalchemy_replicas_from_config
+from demo.api.common.utils.slow_queries import SlowQueryLog
+from demo.api.common.utils.slow_queries import TokenBucket
+from demo.api.common.utils.timers import PhaseTimer
+from demo.api.models.sql.rollups import all_rollups
+from demo.api.common.utils.postcodes import unpack_postcode
+from demo.api.models.sql.readings import Reading
+from demo.api.sql import Session
+from demo.api.tests import DatabaseTestBase
 
 
 class SplitPostcodeTests(unittest.TestCase):
@@ -31,3 +67,554 @@ class SplitPostcodeTests(unittest.TestCase):
 
     def test_split_postcode_none(self):
         self.assertRaises(TypeError, split_postcode, None)
+
+    def test_split_postcode_prefix(self):
+        self.assertEqual(split_postcode_prefix('ab', 'area'), ('AB',))
+        self.assertEqual(split_postcode_prefix('AB1B', 'district'),
+                         ('AB', '1B'))
+        self.assertEqual(split_postcode_prefix('AB10 1', 'sector'),
+                         ('AB', '10', '1'))
+        self.assertEqual(split_postcode_prefix('AB101', 'sector'),
+                         ('AB', '10', '1'))
+
+    def test_split_postcode_prefix_invalid(self):
+        self.assertEqual(split_postcode_prefix('AB10', 'area'), None)
+        self.assertEqual(split_postcode_prefix('AB101AU', 'sector'), None)
+
+
+class PackPostcodeTests(unittest.TestCase):
+
+    def test_pack_postcode_round_trip(self):
+        for postcode in ('AB101AU', 'A11AA', 'EC1A1BB', 'W1A0AX', 'ZZ9Z9ZZ',
+                         'A00AA'):
+            postcode_parts = split_postcode(postcode)
+            self.assertEqual(
+                unpack_postcode(pack_postcode(postcode_parts)),
+                postcode_parts)
+
+    def test_pack_postcode_limits(self):
+        self.assertEqual(pack_postcode(('A', '0', '0', 'AA')), 0)
+        self.assertEqual(pack_postcode(('ZZ', '9Z', '9', 'ZZ')),
+                         POSTCODE_KEY_LIMIT - 1)
+        self.assertLess(POSTCODE_KEY_LIMIT, 2 ** 31)
+
+    def test_pack_postcode_order(self):
+        postcodes = [('A', '1', '1', 'AA'), ('A', '1', '1', 'AB'),
+                     ('A', '1', '2', 'AA'), ('A', '10', '0', 'AA'),
+                     ('A', '1A', '0', 'AA'), ('AA', '1', '0', 'AA'),
+                     ('B', '1', '0', 'AA')]
+        self.assertEqual(sorted(postcodes, key=pack_postcode), postcodes)
+
+    def test_postcode_key_range(self):
+        start, stop = postcode_key_range('AB', '10', '1')
+        self.assertEqual(start, pack_postcode(('AB', '10', '1', 'AA')))
+        self.assertEqual(stop, pack_postcode(('AB', '10', '1', 'ZZ')) + 1)
+
+        start, stop = postcode_key_range('AB', '10')
+        self.assertEqual(start, pack_postcode(('AB', '10', '0', 'AA')))
+        self.assertEqual(stop, pack_postcode(('AB', '10', '9', 'ZZ')) + 1)
+
+        start, stop = postcode_key_range('AB')
+        self.assertEqual(start, pack_postcode(('AB', '0', '0', 'AA')))
+        self.assertEqual(stop, pack_postcode(('AB', '9Z', '9', 'ZZ')) + 1)
+
+    def test_postcode_key_range_sector_without_district(self):
+        self.assertRaises(ValueError, postcode_key_range, 'AB', None, '1')
+
+
+class PostcodeIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.postcodes = [('AB', '10', '1', 'AU'), ('AB', '10', '1', 'AZ'),
+                          ('AB', '10', '2', 'AA'), ('AB', '11', '1', 'AA'),
+                          ('AC', '1', '1', 'AA')]
+        self.index = PostcodeIndex(
+            array('i', (pack_postcode(postcode)
+                        for postcode in self.postcodes)))
+
+    def test_find(self):
+        self.assertEqual(
+            self.index.find(pack_postcode(('AB', '10', '2', 'AA'))), 2)
+        self.assertIsNone(
+            self.index.find(pack_postcode(('AB', '10', '2', 'AB'))))
+        self.assertIn(pack_postcode(('AC', '1', '1', 'AA')), self.index)
+
+    def test_find_range(self):
+        self.assertEqual(self.index.find_range('AB', '10', '1'), range(0, 2))
+        self.assertEqual(self.index.find_range('AB', '10'), range(0, 3))
+        self.assertEqual(self.index.find_range('AB'), range(0, 4))
+        self.assertEqual(self.index.find_range('AC', '2'), range(5, 5))
+
+
+class DatasetGenerationTests(DatabaseTestBase):
+
+    def test_increment_dataset_generation(self):
+        self.assertEqual(get_dataset_generation(Session()), 0)
+        self.assertEqual(increment_dataset_generation(Session()), 1)
+        self.assertEqual(increment_dataset_generation(Session()), 2)
+        self.assertEqual(get_dataset_generation(Session()), 2)
+
+    def test_set_postcode_area_version(self):
+        area_id, _, _ = self.add_postcode('AB', '10', 'AU')
+        self.add_postcode('CD', '10', 'AU')
+
+        set_postcode_area_version(Session(), area_id, 1)
+        set_postcode_area_version(Session(), area_id, 2)
+
+        versions = get_postcode_area_versions(Session())
+        self.assertEqual(list(versions), ['AB'])
+        self.assertEqual(versions['AB'][0], 2)
+
+
+class UpdateRollupsTests(DatabaseTestBase):
+
+    def get_rollups(self, granularity):
+        rollup = all_rollups[granularity]
+        return (Session.query(rollup.category, rollup.year, rollup.download,
+                              rollup.upload, rollup.count)
+                .order_by(rollup.id)
+                .all())
+
+    def test_update_rollups(self):
+        area_id, _, _, _ = self.add_reading('0', ('AB', '10', '1', 'AU'),
+                                            2016, 10, None)
+        self.add_reading('0', ('AB', '10', '2', 'AU'), 2016, 20, 4)
+        self.add_reading('0', ('AB', '11', '1', 'AU'), 2016, 30, 6)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2015, 99, 99)
+        self.add_reading('0', ('CD', '10', '1', 'AU'), 2016, 99, 99)
+
+        update_rollups(Session(), area_id, 2016)
+        # Rollups are replaced
+        update_rollups(Session(), area_id, 2016)
+
+        self.assertEqual(self.get_rollups('area'),
+                         [('0', 2016, 20, 5, 3)])
+        self.assertEqual(sorted(self.get_rollups('district')),
+                         [('0', 2016, 15, 4, 2), ('0', 2016, 30, 6, 1)])
+        self.assertEqual(len(self.get_rollups('sector')), 3)
+
+
+class ShadowTablesTests(DatabaseTestBase):
+
+    def setUp(self):
+        super(ShadowTablesTests, self).setUp()
+        self.table = Reading.__table__
+        self.shadow_table = get_shadow_table(self.table)
+
+    def get_table_names(self):
+        return set(sqlalchemy.inspect(self.engine).get_table_names())
+
+    def get_index_names(self, table):
+        return set(index['name'] for index in
+                   sqlalchemy.inspect(self.engine).get_indexes(table.name))
+
+    def test_get_shadow_table(self):
+        self.assertEqual(self.shadow_table.name, 'average_readings_shadow')
+        self.assertEqual([index.name for index in self.shadow_table.indexes],
+                         ['average_lookup_idx_shadow'])
+        self.assertIs(get_shadow_table(self.table), self.shadow_table)
+
+    def test_create_shadow_tables(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 1, 1)
+        transaction.commit()
+
+        with self.engine.connect() as connection:
+            create_shadow_tables(connection, [self.table])
+            # Leftover shadow tables are replaced
+            create_shadow_tables(connection, [self.table])
+
+            self.assertEqual(connection.execute(
+                self.shadow_table.select()).fetchall(),
+                connection.execute(self.table.select()).fetchall())
+        self.assertEqual(self.get_index_names(self.shadow_table),
+                         {'average_lookup_idx_shadow'})
+
+    def test_swap_shadow_tables(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 1, 1)
+        transaction.commit()
+
+        with self.engine.connect() as connection:
+            create_shadow_tables(connection, [self.table])
+            connection.execute(self.shadow_table.update().values(download=2))
+            swap_shadow_tables(connection, [self.table])
+
+        self.assertEqual(Session.query(Reading.download).all(), [(2,)])
+        self.assertNotIn('average_readings_shadow', self.get_table_names())
+        self.assertNotIn('average_readings_old', self.get_table_names())
+        self.assertEqual(self.get_index_names(self.table),
+                         {'average_lookup_idx'})
+
+    def test_swap_shadow_tables_publish_failure(self):
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 1, 1)
+        transaction.commit()
+
+        def publish(connection):
+            raise ValueError('publish failed')
+
+        with self.engine.connect() as connection:
+            create_shadow_tables(connection, [self.table])
+            connection.execute(self.shadow_table.update().values(download=2))
+            with self.assertRaises(ValueError):
+                swap_shadow_tables(connection, [self.table], publish)
+
+        # The renames are rolled back with the publish transaction
+        self.assertEqual(Session.query(Reading.download).all(), [(1,)])
+        self.assertIn('average_readings_shadow', self.get_table_names())
+
+    def test_drop_shadow_tables(self):
+        with self.engine.connect() as connection:
+            create_shadow_tables(connection, [self.table])
+            drop_shadow_tables(connection, [self.table])
+
+        self.assertNotIn('average_readings_shadow', self.get_table_names())
+
+
+@mock.patch('demo.api.common.utils.postcodes.get_dataset_generation')
+class PostcodeCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.cache = PostcodeCache(self.load, check_interval=0)
+
+    def load(self, session):
+        self.loads.append(session)
+        count = len(self.loads)
+        return {'AB': count}, {'10': count}, {'AU': count}, {}
+
+    def test_get(self, fake_generation):
+        fake_generation.return_value = 1
+
+        parts = self.cache.get('session')
+
+        self.assertEqual(parts, (1, {'AB': 1}, {'10': 1}, {'AU': 1}, {}))
+        self.assertIs(self.cache.get('session'), parts)
+        self.assertEqual(self.loads, ['session'])
+
+    def test_get_reloads_new_generation(self, fake_generation):
+        fake_generation.return_value = 1
+        parts = self.cache.get('session')
+        fake_generation.return_value = 2
+
+        new_parts = self.cache.get('session')
+
+        self.assertEqual(new_parts,
+                         (2, {'AB': 2}, {'10': 2}, {'AU': 2}, {}))
+        # Holders of the previous mappings are unaffected
+        self.assertEqual(parts.areas, {'AB': 1})
+
+    def test_get_check_interval(self, fake_generation):
+        fake_generation.return_value = 1
+        self.cache.check_interval = 60
+        self.cache.get('session')
+        fake_generation.return_value = 2
+
+        self.assertEqual(self.cache.get('session').generation, 1)
+        self.assertEqual(fake_generation.call_count, 1)
+
+    def test_get_while_reloading(self, fake_generation):
+        fake_generation.return_value = 1
+        parts = self.cache.get('session')
+        fake_generation.return_value = 2
+
+        # Another thread is reloading
+        with self.cache._lock:
+            self.assertIs(self.cache.get('session'), parts)
+
+    def test_clear(self, fake_generation):
+        fake_generation.return_value = 1
+        self.cache.check_interval = 60
+        self.cache.get('session')
+        self.cache.clear()
+
+        self.cache.get('session')
+
+        self.assertEqual(len(self.loads), 2)
+
+    def test_get_concurrent_first_load(self, fake_generation):
+        fake_generation.return_value = 1
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get('session')))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(parts is not None for parts in results))
+
+
+@mock.patch('demo.api.common.utils.cache.time.monotonic')
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.computed = []
+        self.cache = ResponseCache(max_entries=2, ttl=10, stale_ttl=5)
+
+    def compute(self, value):
+        def compute():
+            self.computed.append(value)
+            return value
+        return compute
+
+    def test_get(self, fake_time):
+        fake_time.return_value = 0
+
+        self.assertEqual(self.cache.get('a', 1, self.compute('A')), 'A')
+        self.assertEqual(self.cache.get('a', 1, self.compute('B')), 'A')
+
+        self.assertEqual(self.computed, ['A'])
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_get_evicts_least_recently_used(self, fake_time):
+        fake_time.return_value = 0
+        self.cache.get('a', 1, self.compute('A'))
+        self.cache.get('b', 1, self.compute('B'))
+        self.cache.get('a', 1, self.compute('A'))
+
+        self.cache.get('c', 1, self.compute('C'))
+
+        self.assertEqual(list(self.cache._entries), ['a', 'c'])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_get_new_generation(self, fake_time):
+        fake_time.return_value = 0
+        self.cache.get('a', 1, self.compute('A'))
+
+        self.assertEqual(self.cache.get('a', 2, self.compute('B')), 'B')
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def test_get_expired(self, fake_time):
+        fake_time.return_value = 0
+        self.cache.get('a', 1, self.compute('A'))
+        fake_time.return_value = 15
+
+        self.assertEqual(self.cache.get('a', 1, self.compute('B')), 'B')
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_get_stale_while_revalidate(self, fake_time):
+        fake_time.return_value = 0
+        self.cache.get('a', 1, self.compute('A'))
+        fake_time.return_value = 12
+        refreshed = threading.Event()
+
+        def refresh():
+            self.assertTrue(refreshed.wait(5))
+            return 'B'
+
+        self.assertEqual(
+            self.cache.get('a', 1, self.compute('C'), refresh=refresh), 'A')
+        # A single revalidation runs at a time
+        self.assertEqual(
+            self.cache.get('a', 1, self.compute('C'), refresh=refresh), 'A')
+        self.assertEqual(self.cache._refreshing, {'a'})
+        refreshed.set()
+        self.cache.wait_for_refreshes()
+
+        self.assertEqual(self.cache.get('a', 1, self.compute('C')), 'B')
+        self.assertEqual(self.computed, ['A'])
+        self.assertEqual(self.cache.stats()['stale_hits'], 2)
+
+    def test_get_stale_while_revalidate_new_generation(self, fake_time):
+        fake_time.return_value = 0
+        self.cache.get('a', 1, self.compute('A'))
+        fake_time.return_value = 12
+        refreshed = threading.Event()
+
+        def refresh():
+            self.assertTrue(refreshed.wait(5))
+            return 'B'
+
+        self.assertEqual(
+            self.cache.get('a', 1, self.compute('C'), refresh=refresh), 'A')
+        # An import changes the generation during the refresh
+        self.assertEqual(self.cache.get('b', 2, self.compute('D')), 'D')
+        refreshed.set()
+        self.cache.wait_for_refreshes()
+
+        self.assertEqual(self.cache.stats()['generation'], 2)
+        self.assertEqual(list(self.cache._entries), ['b'])
+        self.assertEqual(self.cache._refreshing, set())
+
+    def test_get_stale_refresh_queue_full(self, fake_time):
+        self.cache = ResponseCache(ttl=10, stale_ttl=5, max_refreshes=1)
+        fake_time.return_value = 0
+        for key in ('a', 'b', 'c'):
+            self.cache.get(key, 1, self.compute(key.upper()))
+        fake_time.return_value = 12
+        refreshed = threading.Event()
+
+        def refresh():
+            self.assertTrue(refreshed.wait(5))
+            return 'R'
+
+        # The first refresh is running, the second one waits in the queue
+        self.cache.get('a', 1, self.compute('X'), refresh=refresh)
+        while not self.cache._refreshes.empty():
+            time.sleep(0.001)
+        self.cache.get('b', 1, self.compute('X'), refresh=refresh)
+        # The queue is full, a later lookup revalidates the entry
+        self.assertEqual(
+            self.cache.get('c', 1, self.compute('X'), refresh=refresh), 'C')
+        self.assertEqual(self.cache._refreshing, {'a', 'b'})
+        refreshed.set()
+        self.cache.wait_for_refreshes()
+
+        self.assertEqual(
+            self.cache.get('c', 1, self.compute('X'), refresh=refresh), 'C')
+        self.cache.wait_for_refreshes()
+        self.assertEqual([self.cache.get(key, 1, self.compute('X'))
+                          for key in ('a', 'b', 'c')], ['R', 'R', 'R'])
+        self.assertEqual(self.computed, ['A', 'B', 'C'])
+
+    def test_set_older_generation(self, fake_time):
+        fake_time.return_value = 0
+        self.cache.get('a', 2, self.compute('A'))
+
+        self.cache.set('b', 'B', 1)
+        self.assertEqual(self.cache.get('c', 1, self.compute('C')), 'C')
+
+        self.assertEqual(self.cache.generation, 2)
+        self.assertEqual(list(self.cache._entries), ['a'])
+
+
+@mock.patch('demo.api.common.utils.timers.time.perf_counter')
+class PhaseTimerTests(unittest.TestCase):
+
+    def test_phase(self, perf_counter):
+        timer = PhaseTimer()
+        perf_counter.side_effect = [0, 1, 4, 10]
+
+        with timer.phase('outer'):
+            with timer.phase('inner'):
+                pass
+
+        self.assertEqual(timer.durations, {'outer': 7, 'inner': 3})
+        self.assertEqual(timer.total, 10)
+
+    def test_add(self, perf_counter):
+        timer = PhaseTimer()
+        perf_counter.side_effect = [0, 10]
+
+        with timer.phase('outer'):
+            timer.add('inner', 2)
+            timer.add('inner', 2)
+            timer.items += 5
+
+        self.assertEqual(timer.durations, {'outer': 6, 'inner': 4})
+        self.assertEqual(timer.rate, 0.5)
+
+    def test_merge(self, perf_counter):
+        timer = PhaseTimer()
+        timer.add('read', 1)
+        other = PhaseTimer()
+        other.add('read', 2)
+        other.add('commit', 1)
+        other.items = 8
+
+        timer.merge(other)
+
+        self.assertEqual(timer.durations, {'read': 3, 'commit': 1})
+        self.assertEqual(timer.items, 8)
+        self.assertEqual(PhaseTimer().rate, 0)
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    @mock.patch('demo.api.common.utils.slow_queries.time.monotonic')
+    def test_consume(self, monotonic):
+        monotonic.return_value = 0
+        bucket = TokenBucket(rate=2, burst=3)
+
+        self.assertEqual([bucket.consume() for _ in range(4)],
+                         [True, True, True, False])
+        monotonic.return_value = 0.5
+        self.assertEqual([bucket.consume() for _ in range(2)], [True, False])
+        monotonic.return_value = 100
+        self.assertEqual([bucket.consume() for _ in range(4)],
+                         [True, True, True, False])
+
+
+class SlowQueryLogTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.url = 'sqlite:///{}'.format(os.path.join(directory, 'test.db'))
+
+    def make_engine(self, **settings):
+        settings = dict(('sqlalchemy.slow_query.' + key, value)
+                        for key, value in settings.items())
+        settings['sqlalchemy.url'] = self.url
+        engine = sqlalchemy_engine_from_config(settings)
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def test_disabled(self):
+        engine = self.make_engine()
+
+        with mock.patch('demo.api.common.utils.slow_queries._logger') as log:
+            engine.execute('SELECT 1')
+
+        self.assertFalse(log.warning.called)
+
+    def test_slow_query(self):
+        engine = self.make_engine(threshold='0')
+
+        with self.assertLogs('demo.api.common.utils.slow_queries') as logs:
+            engine.execute(sqlalchemy.text('SELECT :value'), value=42)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertRegex(
+            logs.output[0],
+            r'Slow query 1 took [\d.]+s in demo\.api\.tests\.test_utils:'
+            r'test_slow_query: SELECT \? \[parameters: \(42,\)\]$')
+
+    def test_read_replicas(self):
+        settings = {'sqlalchemy.url': self.url,
+                    'sqlalchemy.read.url': '{0} {0}'.format(self.url),
+                    'sqlalchemy.slow_query.threshold': '0'}
+        engines = sqlalchemy_replicas_from_config(settings)
+        settings['sqlalchemy.read.slow_query.threshold'] = ''
+        engines.extend(sqlalchemy_replicas_from_config(settings))
+        for engine in engines:
+            self.addCleanup(engine.dispose)
+
+        with self.assertLogs('demo.api.common.utils.slow_queries') as logs:
+            for engine in engines:
+                engine.execute('SELECT 1')
+
+        # Replicas inherit the slow query settings unless overridden
+        self.assertEqual(len(logs.output), 2)
+
+    def test_rate_limit(self):
+        engine = self.make_engine(threshold='0', log_rate='0.001',
+                                  log_burst='2')
+
+        with self.assertLogs('demo.api.common.utils.slow_queries') as logs:
+            for _ in range(5):
+                engine.execute('SELECT 1')
+        self.assertEqual(len(logs.output), 2)
+
+        log = SlowQueryLog(0, log_rate=1000, log_burst=1)
+        log.suppressed = 3
+        with self.assertLogs('demo.api.common.utils.slow_queries') as logs:
+            log.record(engine, 'SELECT 1', (), False, 1.0)
+        self.assertIn('(3 slow queries not logged)', logs.output[0])
+
+    def test_explain(self):
+        engine = self.make_engine()
+        engine.execute('CREATE TABLE foo (id INTEGER PRIMARY KEY)')
+        log = SlowQueryLog(0, explain=True)
+        log.attach(engine)
+
+        with self.assertLogs('demo.api.common.utils.slow_queries') as logs:
+            engine.execute(sqlalchemy.text('SELECT * FROM foo WHERE id = :id'),
+                           id=1)
+            log.wait_for_explains()
+
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('Plan of slow query 1:', logs.output[1])
+        self.assertIn('foo', logs.output[1])
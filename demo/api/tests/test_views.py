@@ -1,17 +1,45 @@
+import datetime
 import json
 import unittest
 from unittest import mock
 import os
 import re
+import shutil
+import tempfile
 
+from colander import null
 from pyramid import testing
 from pyramid.httpexceptions import HTTPBadRequest
-
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.request import Request
+import sqlalchemy
+import transaction
+
+from demo.api import main
+from demo.api.common.utils.cache import IResponseCache
+from demo.api.common.utils.cache import ResponseCache
+from demo.api.common.utils.replicas import IReadReplicas
+from demo.api.common.utils.rollups import update_rollups
+from demo.api.metrics import _on_checkin
+from demo.api.metrics import _on_checkout
+from demo.api.schemas import AverageBatchQuerySchema
 from demo.api.schemas import AverageQuerySchema
+from demo.api.schemas import AverageRollupQuerySchema
+from demo.api.sql import Base
+from demo.api.sql import Session
+from demo.api.models.sql.readings import all_tables
+from demo.api.tests import DatabaseTestBase
 from demo.api.views import demo_home
 from demo.api.views import get_averages
+from demo.api.views import get_batch_averages
 from demo.api.views import demo_average
+from demo.api.views import get_area_averages
+from demo.api.views import get_district_averages
+from demo.api.views import get_sector_averages
+from demo.api.views import get_cache_stats
 from demo.api.views import clear_postcode_caching
+from demo.api.views._averages import _get_averages
+from demo.api.views._averages import _get_batch_averages
 
 fixtures_basedir = os.path.join(os.path.dirname(__file__), 'fixtures')
 
@@ -28,11 +56,21 @@ class TestBase(unittest.TestCase):
     def make_request_params(self, data):
         self.request.params = AverageQuerySchema().deserialize(data)
 
+    def patch_dataset_versions(self, area_versions=None):
+        for target, return_value in (
+                ('demo.api.common.utils.postcodes.get_dataset_generation', 0),
+                ('demo.api.views._averages.get_postcode_area_versions',
+                 area_versions or {})):
+            patcher = mock.patch(target, return_value=return_value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
 
 class PageViewsTests(TestBase):
     def setUp(self):
         self.config = testing.setUp()
         self.request = testing.DummyRequest()
+        self.patch_dataset_versions()
 
     def tearDown(self):
         testing.tearDown()
@@ -123,6 +161,7 @@ class GetAveragesTests(TestBase):
     def setUp(self):
         self.config = testing.setUp()
         self.request = testing.DummyRequest()
+        self.patch_dataset_versions()
 
     def tearDown(self):
         testing.tearDown()
@@ -168,3 +207,435 @@ class GetAveragesTests(TestBase):
         response = get_averages(self.request)
 
         self.assertEqual(response, fake_results)
+
+    @mock.patch('demo.api.views._averages.get_postcode_units')
+    @mock.patch('demo.api.views._averages.get_postcode_districts')
+    @mock.patch('demo.api.views._averages.get_postcode_areas')
+    @mock.patch('demo.api.views._averages._get_averages')
+    def test_get_averages_cached(
+            self, fake_get_averages, fake_areas, fake_districts, fake_units):
+        fake_areas.return_value = [('AB', 1)]
+        fake_districts.return_value = [('10', 1)]
+        fake_units.return_value = [('AU', 1)]
+        fake_get_averages.return_value = [
+            {'connection': 'average',
+             'upload': '0.0',
+             'download': '0.0'}]
+        self.config.registry.registerUtility(ResponseCache(), IResponseCache)
+
+        self.make_request(self.get_fixture('sample_input.json'))
+        response = get_averages(self.request)
+        self.make_request(self.get_fixture('sample_input.json'))
+
+        self.assertEqual(get_averages(self.request), response)
+        self.assertEqual(fake_get_averages.call_count, 1)
+        stats = get_cache_stats(self.request)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def make_conditional_request(self, headers):
+        self.request = Request.blank('/api/average', headers=headers)
+        self.request.registry = self.config.registry
+        self.make_request(self.get_fixture('sample_input.json'))
+
+    @mock.patch('demo.api.views._averages.get_postcode_units')
+    @mock.patch('demo.api.views._averages.get_postcode_districts')
+    @mock.patch('demo.api.views._averages.get_postcode_areas')
+    @mock.patch('demo.api.views._averages._get_averages')
+    def test_get_averages_conditional(
+            self, fake_get_averages, fake_areas, fake_districts, fake_units):
+        fake_areas.return_value = [('AB', 1)]
+        fake_districts.return_value = [('10', 1)]
+        fake_units.return_value = [('AU', 1)]
+        fake_get_averages.return_value = []
+        self.patch_dataset_versions(
+            {'AB': (3, datetime.datetime(2017, 1, 2, 3, 4, 5, 6))})
+        self.config.add_settings({'http.cache_control': 'max-age=60'})
+
+        self.make_conditional_request({})
+        get_averages(self.request)
+        etag = self.request.response.headers['ETag']
+        last_modified = self.request.response.headers['Last-Modified']
+        self.assertEqual(last_modified, 'Mon, 02 Jan 2017 03:04:05 GMT')
+
+        for headers in ({'If-None-Match': etag},
+                        {'If-Modified-Since': last_modified}):
+            self.make_conditional_request(headers)
+            response = get_averages(self.request)
+
+            self.assertIsInstance(response, HTTPNotModified)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(fake_get_averages.call_count, 1)
+
+        # The representation is part of the ETag and If-None-Match takes
+        # precedence over If-Modified-Since
+        for headers in ({'If-None-Match': etag,
+                         'Decimal-As-String': 'true'},
+                        {'If-None-Match': '"other"',
+                         'If-Modified-Since': last_modified}):
+            self.make_conditional_request(headers)
+            self.assertEqual(get_averages(self.request), [])
+
+    def test_get_cache_stats_disabled(self):
+        self.assertEqual(get_cache_stats(self.request), {'enabled': False})
+        self.assertEqual(self.request.response.headers['Cache-Control'],
+                         'no-store')
+
+
+class GetAveragesQueryTests(DatabaseTestBase):
+
+    def test_get_averages_single_statement(self):
+        key = self.add_reading('0', ('AB', '10', '1', 'AU'), 2015, 1.0, 0.5)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 2.0, 1.0)
+        self.add_reading('3', ('AB', '10', '1', 'AU'), 2016, 30.0, None)
+        self.add_reading('4', ('AB', '10', '2', 'AU'), 2016, 300.0, 20.0)
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+        results = _get_averages(['0', '1', '2', '3', '4'], *key)
+
+        self.assertEqual(results, [
+            {'connection': 'average', 'download': 2.0, 'upload': 1.0},
+            {'connection': 'SFBB', 'download': 30.0, 'upload': None}])
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('JOIN', statements[0])
+
+    def test_get_averages_baked_parameters(self):
+        key = self.add_reading('1', ('AB', '10', '1', 'AU'), 2016, 1.0, 0.5)
+        other_key = self.add_reading(
+            '1', ('AB', '10', '1', 'AA'), 2016, 2.0, 1.0)
+
+        self.assertEqual(_get_averages(['1'], *key), [
+            {'connection': 'slow', 'download': 1.0, 'upload': 0.5}])
+        self.assertEqual(_get_averages(['1'], *other_key), [
+            {'connection': 'slow', 'download': 2.0, 'upload': 1.0}])
+
+    def test_get_averages_no_categories(self):
+        self.assertEqual(_get_averages([], 1, 1, '1', 1), [])
+
+
+class GetBatchAveragesTests(TestBase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.request = testing.DummyRequest()
+        self.patch_dataset_versions()
+
+    def tearDown(self):
+        testing.tearDown()
+        clear_postcode_caching()
+
+    def make_request(self, data):
+        self.request.validated = AverageBatchQuerySchema().deserialize(data)
+
+    @mock.patch('demo.api.views._averages.get_postcode_units')
+    @mock.patch('demo.api.views._averages.get_postcode_districts')
+    @mock.patch('demo.api.views._averages.get_postcode_areas')
+    @mock.patch('demo.api.views._averages._get_batch_averages')
+    def test_get_batch_averages(
+            self, fake_get_batch_averages, fake_areas, fake_districts,
+            fake_units):
+        fake_areas.return_value = [('AB', 1)]
+        fake_districts.return_value = [('10', 1)]
+        fake_units.return_value = [('AU', 1)]
+        fake_get_batch_averages.return_value = {
+            ('0', (1, 1, '1', 1)): {'connection': 'average',
+                                    'upload': 1.5,
+                                    'download': 10.0}}
+
+        self.make_request({'postcodes': [
+            {'postcode': 'AB101AU'},
+            {'postcode': 'AB10FFFFF1AU'},
+            {'postcode': 'AB101AU', 'connection': 'foo'},
+            {'postcode': 'AB101ZZ', 'connection': 'all'}]})
+        response = get_batch_averages(self.request)
+
+        self.assertEqual(response, [
+            {'postcode': 'AB101AU', 'connection': 'average', 'error': null,
+             'results': [{'connection': 'average', 'download': '10.0',
+                          'upload': '1.5'}]},
+            {'postcode': 'AB10FFFFF1AU', 'connection': 'average',
+             'error': 'Invalid postal code', 'results': []},
+            {'postcode': 'AB101AU', 'connection': 'foo',
+             'error': 'Invalid connection type', 'results': []},
+            {'postcode': 'AB101ZZ', 'connection': 'all', 'error': null,
+             'results': []}])
+        fake_get_batch_averages.assert_called_once_with(
+            {'0': {(1, 1, '1', 1)}})
+
+
+class GetBatchAveragesQueryTests(DatabaseTestBase):
+
+    def test_get_batch_averages_latest_year(self):
+        key = self.add_reading('0', ('AB', '10', '1', 'AU'), 2015, 1.0, 0.5)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, 2.0, 1.0)
+        other_key = self.add_reading(
+            '0', ('AB', '10', '2', 'AU'), 2016, 3.0, None)
+        self.add_reading('2', ('AB', '10', '1', 'AU'), 2016, 4.0, 2.0)
+
+        results = _get_batch_averages({'0': {key, other_key}, '1': {key}})
+
+        self.assertEqual(results, {
+            ('0', key): {'connection': 'average', 'download': 2.0,
+                         'upload': 1.0},
+            ('0', other_key): {'connection': 'average', 'download': 3.0,
+                               'upload': None}})
+
+    def test_get_batch_averages_query_count(self):
+        keys = set(self.add_reading('0', ('AB', '10', '1', unit), 2016, 1.0,
+                                    1.0)
+                   for unit in ('AA', 'AB', 'AC'))
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+        with mock.patch('demo.api.views._averages.BATCH_QUERY_SIZE', 2):
+            results = _get_batch_averages({'0': keys})
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(statements), 2)
+
+
+class GetRollupAveragesTests(DatabaseTestBase):
+
+    def setUp(self):
+        super(GetRollupAveragesTests, self).setUp()
+        self.config = testing.setUp()
+        self.request = testing.DummyRequest()
+
+    def tearDown(self):
+        testing.tearDown()
+        clear_postcode_caching()
+        super(GetRollupAveragesTests, self).tearDown()
+
+    def make_request(self, data):
+        self.request.validated = AverageRollupQuerySchema().deserialize(data)
+
+    def test_get_rollup_averages(self):
+        area_id, _, _, _ = self.add_reading('0', ('AB', '10', '1', 'AU'),
+                                            2016, 10.0, 1.0)
+        self.add_reading('0', ('AB', '10', '2', 'AU'), 2016, 20.0, None)
+        self.add_reading('2', ('AB', '11', '1', 'AU'), 2016, 30.0, 3.0)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2015, 1.0, 1.0)
+        update_rollups(Session(), area_id, 2015)
+        update_rollups(Session(), area_id, 2016)
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+        for view, data, results in (
+                (get_area_averages, {'postcode': 'ab', 'connection': 'all'},
+                 [{'connection': 'average', 'download': '15.0',
+                   'upload': '1.0', 'count': '2'},
+                  {'connection': 'BB', 'download': '30.0',
+                   'upload': '3.0', 'count': '1'}]),
+                (get_district_averages, {'postcode': 'AB10'},
+                 [{'connection': 'average', 'download': '15.0',
+                   'upload': '1.0', 'count': '2'}]),
+                (get_sector_averages, {'postcode': 'AB10 2'},
+                 [{'connection': 'average', 'download': '20.0',
+                   'upload': null, 'count': '1'}]),
+                (get_sector_averages, {'postcode': 'AB12 1'}, [])):
+            self.make_request(data)
+            self.assertEqual(view(self.request), results)
+
+        rollup_statements = [statement for statement in statements
+                             if 'rollups' in statement]
+        self.assertEqual(len(rollup_statements), 3)
+
+    def test_get_rollup_averages_invalid(self):
+        for data in ({'postcode': 'AB10 1'},
+                     {'postcode': 'AB10', 'connection': 'foo'}):
+            self.make_request(data)
+            self.assertRaises(HTTPBadRequest, get_district_averages,
+                              self.request)
+
+
+class ApplicationTestBase(DatabaseTestBase):
+    """Runs requests through the whole application, against database
+    files with a single reading.
+    """
+
+    def setUp(self):
+        self.bind = Base.metadata.bind
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def tearDown(self):
+        super(ApplicationTestBase, self).tearDown()
+        clear_postcode_caching()
+        Session.configure(replicas=None)
+        Base.metadata.bind = self.bind
+
+    def create_database(self, filename='test.db', download=2.0):
+        """Create a database file with a reading, returning its URL."""
+        url = 'sqlite:///{}'.format(os.path.join(self.directory, filename))
+        engine = sqlalchemy.create_engine(url)
+        Base.metadata.create_all(engine)
+        Session.configure(bind=engine)
+        self.add_reading('0', ('AB', '10', '1', 'AU'), 2016, download, 1.0)
+        transaction.commit()
+        Session.remove()
+        engine.dispose()
+        return url
+
+    def make_app(self, **settings):
+        settings.setdefault('sqlalchemy.url', self.create_database())
+        settings.setdefault('static.prefix', 'assets')
+        app = main({}, **settings)
+        self.engine = Base.metadata.bind
+        return app
+
+    def get(self, app, path):
+        return Request.blank(
+            path, headers={'Accept': 'application/json'}).get_response(app)
+
+
+class TimingTests(ApplicationTestBase):
+
+    def test_server_timing(self):
+        app = self.make_app(**{'timing.enabled': 'true'})
+
+        with self.assertLogs('demo.api.common.pyramid.timing') as logs:
+            response = self.get(app, '/api/average?postcode=AB101AU')
+
+        self.assertEqual(response.status_int, 200)
+        metrics = dict(
+            (metric.split(';', 1)[0], metric)
+            for metric in response.headers['Server-Timing'].split(', '))
+        self.assertEqual(
+            set(metrics),
+            {'validate', 'sql', 'serialize', 'view', 'render', 'app',
+             'total'})
+        self.assertRegex(metrics['sql'],
+                         r'^sql;dur=[\d.]+;desc="\d+ queries"$')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('method=GET path=/api/average status=200 queries=',
+                      logs.output[0])
+        self.assertIn(' sql_ms=', logs.output[0])
+
+    def test_server_timing_sampled_out(self):
+        app = self.make_app(**{'timing.enabled': 'true',
+                               'timing.sample_rate': '0'})
+
+        response = self.get(app, '/api/average?postcode=AB101AU')
+
+        self.assertEqual(response.status_int, 200)
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_server_timing_disabled(self):
+        response = self.get(self.make_app(), '/api/average?postcode=AB101AU')
+
+        self.assertEqual(response.status_int, 200)
+        self.assertNotIn('Server-Timing', response.headers)
+
+
+class CacheStatsTests(ApplicationTestBase):
+
+    def test_cache_stats_not_cached(self):
+        app = self.make_app(**{'http.cache_control': 'public, max-age=300'})
+
+        self.assertEqual(
+            self.get(app, '/api/average?postcode=AB101AU')
+            .headers['Cache-Control'], 'public, max-age=300')
+        self.assertEqual(self.get(app, '/api/cache').headers['Cache-Control'],
+                         'no-store')
+
+
+class MetricsTests(ApplicationTestBase):
+
+    def test_metrics(self):
+        app = self.make_app(**{'metrics.enabled': 'true'})
+        self.get(app, '/api/average?postcode=AB101AU')
+        self.get(app, '/api/average?postcode=foo')
+
+        response = self.get(app, '/metrics')
+
+        self.assertEqual(response.status_int, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = response.text.splitlines()
+        for line in (
+                'demo_api_requests_total{method="GET",route="average",'
+                'status="200"}',
+                'demo_api_requests_total{method="GET",route="average",'
+                'status="400"}',
+                'demo_api_request_duration_seconds_count{method="GET",'
+                'route="average"}',
+                'demo_api_db_pool_checkouts_total',
+                'demo_api_db_pool_checkout_seconds_count',
+                'demo_api_postcode_cache_entries{part="areas"} 1.0',
+                'demo_api_postcode_cache_entries{part="units"} 1.0'):
+            self.assertTrue(
+                any(metric.startswith(line) for metric in lines), line)
+
+    def test_metrics_read_replicas(self):
+        app = self.make_app(**{
+            'metrics.enabled': 'true',
+            'sqlalchemy.read.url': self.create_database('replica.db', 5.0)})
+        replica = app.registry.queryUtility(IReadReplicas).engines[0]
+
+        self.assertTrue(all(
+            sqlalchemy.event.contains(replica, identifier, listener)
+            for identifier, listener in (('checkout', _on_checkout),
+                                         ('checkin', _on_checkin))))
+        self.assertEqual(self.get(app, '/metrics').status_int, 200)
+
+    def test_metrics_disabled(self):
+        response = self.get(self.make_app(), '/metrics')
+
+        self.assertEqual(response.status_int, 404)
+
+
+class ReadReplicaTests(ApplicationTestBase):
+
+    def get_download(self, app):
+        response = self.get(app, '/api/average?postcode=AB101AU')
+        self.assertEqual(response.status_int, 200)
+        return response.json[0]['download']
+
+    def test_read_replicas(self):
+        app = self.make_app(**{'sqlalchemy.read.url': '{} {}'.format(
+            self.create_database('replica1.db', 5.0),
+            self.create_database('replica2.db', 7.0))})
+
+        self.assertEqual([self.get_download(app) for _ in range(3)],
+                         ['5.0', '7.0', '5.0'])
+        # Other sessions use the primary
+        self.assertEqual(Session.query(all_tables['0']).one().download, 2.0)
+
+    def test_read_replicas_cache_refresh(self):
+        app = self.make_app(**{
+            'sqlalchemy.read.url': self.create_database('replica.db', 5.0),
+            'cache.enabled': 'true',
+            'cache.ttl': '0',
+            'cache.stale_ttl': '60'})
+
+        # The second lookup is stale and refreshed in a background thread
+        self.assertEqual([self.get_download(app) for _ in range(2)],
+                         ['5.0', '5.0'])
+        app.registry.queryUtility(IResponseCache).wait_for_refreshes()
+
+        self.assertEqual(self.get_download(app), '5.0')
+
+    def test_read_replica_failover(self):
+        missing = 'sqlite:///{}'.format(
+            os.path.join(self.directory, 'missing', 'replica.db'))
+        app = self.make_app(**{'sqlalchemy.read.url': '{} {}'.format(
+            missing, self.create_database('replica.db', 5.0))})
+
+        with self.assertLogs('demo.api.common.utils.replicas') as logs:
+            self.assertEqual([self.get_download(app) for _ in range(3)],
+                             ['5.0', '5.0', '5.0'])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Read replica', logs.output[0])
+
+    def test_read_replicas_failed(self):
+        missing = 'sqlite:///{}'.format(
+            os.path.join(self.directory, 'missing', 'replica.db'))
+        app = self.make_app(**{'sqlalchemy.read.url': missing})
+
+        with self.assertLogs('demo.api.common.utils.replicas'):
+            self.assertEqual(self.get_download(app), '2.0')
@@ -7,6 +7,7 @@ from pyramid.httpexceptions import HTTPException
 from pyramid.httpexceptions import HTTPInternalServerError
 
 from ._averages import *  # noqa
+from ._rollups import *  # noqa
 from ..sql import Session
 from demo.api.models.sql.readings import all_tables
 
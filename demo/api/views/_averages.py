@@ -1,34 +1,127 @@
+import datetime
+import hashlib
 import logging
 
 from pyramid.httpexceptions import HTTPBadRequest
-from sqlalchemy import desc
-
+from pyramid.httpexceptions import HTTPNotModified
+import transaction
+from sqlalchemy import bindparam
+from sqlalchemy import literal
+from sqlalchemy import tuple_
+
+from ..renderers import get_cache_control
+from ..schemas import AverageBatchResultsSchema
 from ..schemas import AverageItemsSchema
 from ..sql import Session
+from ..sql import bakery
+from ..store import IReadingsStore
+from demo.api.common.pyramid.timing import timed_phase
+from demo.api.common.utils.cache import IResponseCache
+from demo.api.common.utils.dataset import get_postcode_area_versions
+from demo.api.common.utils.postcodes import PostcodeCache
 from demo.api.common.utils.postcodes import get_postcode_areas
 from demo.api.common.utils.postcodes import get_postcode_districts
 from demo.api.common.utils.postcodes import get_postcode_units
+from demo.api.common.utils.postcodes import pack_postcode
 from demo.api.common.utils.postcodes import split_postcode
 from demo.api.models.sql.readings import all_tables
 from demo.api.common.utils import FRIENDLY_CONNECTION_CATEGORIES
 
 _logger = logging.getLogger(__name__)
 
-POSTCODE_AREAS = {}
-POSTCODE_DISTRICTS = {}
-POSTCODE_UNITS = {}
+# Maximum number of postcodes looked up by a single statement. Each postcode
+# adds four bound parameters to the statement.
+BATCH_QUERY_SIZE = 1000
+
+
+def _load_postcode_parts(session):
+    return (dict(get_postcode_areas(session)),
+            dict(get_postcode_districts(session)),
+            dict(get_postcode_units(session)),
+            get_postcode_area_versions(session))
+
+
+POSTCODE_CACHE = PostcodeCache(_load_postcode_parts)
+
+
+def configure_postcode_caching(settings):
+    """Configure postcode part caching from application settings."""
+    POSTCODE_CACHE.check_interval = float(
+        settings.get('postcodes.check_interval', 5))
 
 
 def clear_postcode_caching():
     """Clear postcode part caching."""
-    POSTCODE_AREAS.clear()
-    POSTCODE_DISTRICTS.clear()
-    POSTCODE_UNITS.clear()
+    POSTCODE_CACHE.clear()
+
+
+def _get_postcode_key(postcode_parts):
+    """Get the reading table key for split postcode parts.
+
+    Returns:
+        A tuple of postcode area id, district id, sector and unit id or None
+        when any of the postcode parts is unknown
+
+    """
+    area, district, sector, unit = postcode_parts
+    parts = POSTCODE_CACHE.get(Session)
+
+    postcode_area_id = parts.areas.get(area)
+    district_id = parts.districts.get(district)
+    unit_id = parts.units.get(unit)
+
+    if (postcode_area_id is None or district_id is None or
+            unit_id is None):
+        return None
+
+    return postcode_area_id, district_id, sector, unit_id
+
+
+def _get_connection_categories(connection):
+    if connection == 'all':
+        return list(FRIENDLY_CONNECTION_CATEGORIES.values())
+    try:
+        return [FRIENDLY_CONNECTION_CATEGORIES[connection]]
+    except KeyError:
+        return None
+
+
+def _averages_query(session, categories):
+    queries = []
+    for category in categories:
+        table = all_tables[category]
+        queries.append(
+            session.query(literal(table.reading_type).label('connection'),
+                          table.year, table.download, table.upload)
+            .filter(table.postcode_area_id == bindparam('postcode_area_id'),
+                    table.postcode_district_id == bindparam('district_id'),
+                    table.postcode_sector == bindparam('sector'),
+                    table.postcode_unit_id == bindparam('unit_id')))
+
+    query = queries[0]
+    if len(queries) > 1:
+        query = query.union_all(*queries[1:])
+    return query
+
+
+def _batch_averages_query(session, category):
+    table = all_tables[category]
+    columns = (table.postcode_area_id, table.postcode_district_id,
+               table.postcode_sector, table.postcode_unit_id)
+
+    return (session.query(*columns + (table.year, table.download,
+                                      table.upload))
+            .filter(tuple_(*columns).in_(bindparam('keys', expanding=True))))
 
 
 def _get_averages(categories, postcode_area_id, district_id, sector, unit_id):
     """Get averages from database tables.
 
+    The latest reading of every requested table is fetched with a single
+    statement (a UNION ALL across the tables) to avoid a database round trip
+    per table. Only the needed columns are selected and the statement is
+    baked, so it is built and compiled once per set of categories.
+
         categories: categories for database table selection. Example '0'
         postcode_area_id: postcode area id referencing row entry in table
                           postcode_areas
@@ -42,28 +135,205 @@ def _get_averages(categories, postcode_area_id, district_id, sector, unit_id):
         download upload
 
     """
-    tables = [all_tables[catergory] for catergory in categories]
+    categories = tuple(categories)
+    if not categories:
+        return []
 
-    results = []
-    for table in tables:
-        entry = (Session.query(table)
-                 .filter(table.postcode_area_id == postcode_area_id,
-                         table.postcode_district_id == district_id,
-                         table.postcode_sector == sector,
-                         table.postcode_unit_id == unit_id)
-                 .order_by(desc(table.year))
-                 .first())
+    query = bakery(lambda session: _averages_query(session, categories),
+                   categories)
 
+    entries = {}
+    for connection, year, download, upload in query(Session()).params(
+            postcode_area_id=postcode_area_id, district_id=district_id,
+            sector=sector, unit_id=unit_id):
+        if connection in entries and entries[connection][0] > year:
+            continue
+        entries[connection] = (year, download, upload)
+
+    results = []
+    for category in categories:
+        reading_type = all_tables[category].reading_type
+        entry = entries.get(reading_type)
         if entry:
-            results.append({'connection': table.reading_type,
-                            'upload': entry.upload if entry else None,
-                            'download': entry.download if entry else None})
+            _, download, upload = entry
+            results.append({'connection': reading_type,
+                            'upload': upload,
+                            'download': download})
 
     return results
 
 
+def _get_batch_averages(categories_keys):
+    """Get averages for many postcodes from database tables.
+
+    Runs one query per table for every BATCH_QUERY_SIZE postcodes instead of
+    one query per postcode.
+
+        categories_keys: mapping of categories for database table selection
+                         to sets of postcode keys as returned by
+                         _get_postcode_key
+
+    Returns:
+        Results as key value pairs containing connection, upload average,
+        download upload keyed by category and postcode key
+
+    """
+    results = {}
+    for category, keys in categories_keys.items():
+        reading_type = all_tables[category].reading_type
+        query = bakery(
+            lambda session: _batch_averages_query(session, category),
+            category)
+
+        keys = sorted(keys)
+        latest_years = {}
+        for start in range(0, len(keys), BATCH_QUERY_SIZE):
+            entries = query(Session()).params(
+                keys=keys[start:start + BATCH_QUERY_SIZE])
+
+            for (postcode_area_id, district_id, sector, unit_id, year,
+                 download, upload) in entries:
+                key = (postcode_area_id, district_id, sector, unit_id)
+                if latest_years.get(key, year) > year:
+                    continue
+                latest_years[key] = year
+                results[category, key] = {
+                    'connection': reading_type,
+                    'upload': upload,
+                    'download': download}
+
+    return results
+
+
+def _get_sql_averages(categories, postcode_key):
+    return _get_averages(categories, *postcode_key)
+
+
+def _get_lookups(request):
+    """Get the average lookup functions for a request.
+
+    Lookups are answered from the readings store when it is enabled and
+    matches the dataset generation, and from the database otherwise.
+
+    Returns:
+        A tuple of functions to get the lookup key of postcode parts (None
+        when the postcode is unknown), get the averages of a lookup key and
+        get the averages of many lookup keys
+
+    """
+    store = request.registry.queryUtility(IReadingsStore)
+    if store is not None:
+        store = store.get(POSTCODE_CACHE.get(Session).generation)
+    if store is not None:
+        def get_store_postcode_key(postcode_parts):
+            postcode_key = pack_postcode(postcode_parts)
+            return postcode_key if postcode_key in store else None
+
+        return (get_store_postcode_key, store.get_averages,
+                store.get_batch_averages)
+    return _get_postcode_key, _get_sql_averages, _get_batch_averages
+
+
+def _lookup_averages(lookups, postcode_parts, connection):
+    get_postcode_key, get_averages, _ = lookups
+    postcode_key = get_postcode_key(postcode_parts)
+
+    results = []
+    if postcode_key is not None:
+        categories = _get_connection_categories(connection)
+        if categories is None:
+            raise HTTPBadRequest('Invalid connection type')
+
+        results = get_averages(categories, postcode_key)
+
+    with timed_phase('serialize'):
+        return AverageItemsSchema().serialize(results)
+
+
+def _in_transaction(f):
+    """Call a read-only function within its own transaction and session.
+
+    Used to compute responses outside of a request, e.g. in a background
+    thread. Like the views, the session reads from the read replicas, if any
+    (see decorators.read_only).
+    """
+    session = Session()
+    session.info['read_only'] = True
+    try:
+        with transaction.manager:
+            return f()
+    finally:
+        session.info.pop('read_only', None)
+        session.info.pop('read_engine', None)
+        Session.remove()
+
+
+def _get_validators(request, postcode_parts, connection):
+    """Get the ETag and Last-Modified values of an average response.
+
+    Responses change only when the readings of the postcode area change, so
+    the validators are derived from the version of the area (falling back to
+    the dataset generation for areas without a version) and the parameters
+    changing the response body.
+
+    Returns:
+        A tuple of the strong ETag value and the last modified time (UTC) or
+        None when unknown
+
+    """
+    parts = POSTCODE_CACHE.get(Session)
+    generation, modified = parts.area_versions.get(
+        postcode_parts[0], (parts.generation, None))
+
+    representation = (
+        getattr(request, 'override_renderer', None),
+        request.GET.get('callback'),
+        ('Decimal-As-String' in request.headers or
+         'decimal_as_string' in request.params))
+
+    etag = hashlib.sha1(repr(
+        (generation, tuple(postcode_parts), connection, representation))
+        .encode('utf-8')).hexdigest()
+
+    if modified is not None:
+        modified = modified.replace(microsecond=0,
+                                    tzinfo=datetime.timezone.utc)
+    return etag, modified
+
+
+def _set_validators(response, etag, modified):
+    response.etag = (etag, True)
+    response.last_modified = modified
+
+
+def _is_not_modified(request, etag, modified):
+    if 'If-None-Match' in request.headers:
+        return etag in request.if_none_match
+    if modified is not None and request.if_modified_since is not None:
+        return modified <= request.if_modified_since
+    return False
+
+
+def _not_modified(request, etag, modified):
+    response = HTTPNotModified()
+    cache_control = get_cache_control(request.registry.settings or {})
+    if cache_control is not None:
+        response.headers['Cache-Control'] = cache_control
+    _set_validators(response, etag, modified)
+    return response
+
+
 def get_averages(request):
-    """Get average endpoint."""
+    """Get average endpoint.
+
+    Responses carry a strong ETag and a Last-Modified value derived from the
+    version of the postcode area. Conditional requests are answered with a
+    304 before any reading is looked up.
+
+    Serialized responses are cached by normalized postcode and connection
+    when the response cache is enabled. Cached responses are dropped when the
+    dataset generation changes.
+    """
     postcode = request.validated['postcode']
     connection = request.validated['connection']
 
@@ -72,32 +342,85 @@ def get_averages(request):
     if postcode_parts is None:
         raise HTTPBadRequest('Invalid postal code')
 
-    area, district, sector, unit = postcode_parts
+    etag, modified = _get_validators(request, postcode_parts, connection)
+    if _is_not_modified(request, etag, modified):
+        return _not_modified(request, etag, modified)
 
-    if not POSTCODE_AREAS:
-        POSTCODE_AREAS.update(dict(get_postcode_areas(Session)))
-        POSTCODE_DISTRICTS.update(dict(get_postcode_districts(Session)))
-        POSTCODE_UNITS.update(dict(get_postcode_units(Session)))
+    lookups = _get_lookups(request)
 
-    postcode_area_id = POSTCODE_AREAS.get(area)
-    district_id = POSTCODE_DISTRICTS.get(district)
-    unit_id = POSTCODE_UNITS.get(unit)
+    def compute():
+        return _lookup_averages(lookups, postcode_parts, connection)
 
-    results = []
-    if (postcode_area_id is not None and district_id is not None and
-            unit_id is not None):
-        if connection == 'all':
-            categories = FRIENDLY_CONNECTION_CATEGORIES.values()
-        else:
-            try:
-                categories = [FRIENDLY_CONNECTION_CATEGORIES[connection]]
-            except KeyError:
-                raise HTTPBadRequest('Invalid connection type')
+    cache = request.registry.queryUtility(IResponseCache)
+    if cache is None:
+        results = compute()
+    else:
+        generation = POSTCODE_CACHE.get(Session).generation
+        results = cache.get((postcode_parts, connection), generation,
+                            compute, refresh=lambda: _in_transaction(compute))
 
-        results = _get_averages(
-            categories, postcode_area_id, district_id, sector, unit_id)
+    _set_validators(request.response, etag, modified)
+    return results
+
+
+def get_cache_stats(request):
+    """Get response cache counters endpoint.
+
+    The counters change with every lookup, the response is never cached, also
+    when cacheable responses get the 'http.cache_control' header.
+    """
+    request.response.headers['Cache-Control'] = 'no-store'
+    cache = request.registry.queryUtility(IResponseCache)
+    if cache is None:
+        return {'enabled': False}
+
+    return dict(cache.stats(), enabled=True)
 
-    return AverageItemsSchema().serialize(results)
+
+def get_batch_averages(request):
+    """Get averages for a batch of postcodes endpoint.
+
+    Errors are reported per postcode so that a single invalid entry does not
+    fail the whole batch.
+    """
+    get_postcode_key, _, get_batch_averages = _get_lookups(request)
+
+    batch_results = []
+    lookups = []
+    categories_keys = {}
+    for item in request.validated['postcodes']:
+        batch_result = {'postcode': item['postcode'],
+                        'connection': item['connection'],
+                        'error': None,
+                        'results': []}
+        batch_results.append(batch_result)
+
+        postcode_parts = split_postcode(item['postcode'])
+        if postcode_parts is None:
+            batch_result['error'] = 'Invalid postal code'
+            continue
+
+        categories = _get_connection_categories(item['connection'])
+        if categories is None:
+            batch_result['error'] = 'Invalid connection type'
+            continue
+
+        postcode_key = get_postcode_key(postcode_parts)
+        if postcode_key is None:
+            continue
+
+        lookups.append((batch_result, categories, postcode_key))
+        for category in categories:
+            categories_keys.setdefault(category, set()).add(postcode_key)
+
+    averages = get_batch_averages(categories_keys)
+    for batch_result, categories, postcode_key in lookups:
+        batch_result['results'] = [
+            averages[category, postcode_key] for category in categories
+            if (category, postcode_key) in averages]
+
+    with timed_phase('serialize'):
+        return AverageBatchResultsSchema().serialize(batch_results)
 
 
 def demo_average(request):
@@ -110,30 +433,16 @@ def demo_average(request):
     meesage = 'No results.'
     results = []
     if postcode_parts:
-        area, district, sector, unit = postcode_parts
-
-        if not POSTCODE_AREAS:
-            POSTCODE_AREAS.update(dict(get_postcode_areas(Session)))
-            POSTCODE_DISTRICTS.update(dict(get_postcode_districts(Session)))
-            POSTCODE_UNITS.update(dict(get_postcode_units(Session)))
-
-        postcode_area_id = POSTCODE_AREAS.get(area)
-        district_id = POSTCODE_DISTRICTS.get(district)
-        unit_id = POSTCODE_UNITS.get(unit)
-
-        if (postcode_area_id is not None and district_id is not None and
-                unit_id is not None):
-            categories = []
-            if connection == 'all':
-                categories = FRIENDLY_CONNECTION_CATEGORIES.values()
-            else:
-                try:
-                    categories = [FRIENDLY_CONNECTION_CATEGORIES[connection]]
-                except KeyError:
-                    meesage = 'Invalid connection.'
-
-            results = _get_averages(
-                categories, postcode_area_id, district_id, sector, unit_id)
+        get_postcode_key, get_averages, _ = _get_lookups(request)
+        postcode_key = get_postcode_key(postcode_parts)
+
+        if postcode_key is not None:
+            categories = _get_connection_categories(connection)
+            if categories is None:
+                categories = []
+                meesage = 'Invalid connection.'
+
+            results = get_averages(categories, postcode_key)
     else:
         meesage = 'Invalid postal code.'
 
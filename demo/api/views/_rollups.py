@@ -0,0 +1,130 @@
+import logging
+
+from pyramid.httpexceptions import HTTPBadRequest
+from sqlalchemy import bindparam
+
+from ._averages import POSTCODE_CACHE
+from ._averages import _get_connection_categories
+from ._averages import _get_validators
+from ._averages import _is_not_modified
+from ._averages import _not_modified
+from ._averages import _set_validators
+from ..schemas import AverageRollupItemsSchema
+from ..sql import Session
+from ..sql import bakery
+from demo.api.common.pyramid.timing import timed_phase
+from demo.api.common.utils.postcodes import split_postcode_prefix
+from demo.api.models.sql.readings import all_tables
+from demo.api.models.sql.rollups import all_rollups
+
+_logger = logging.getLogger(__name__)
+
+
+def _rollup_query(session, granularity, categories):
+    rollup = all_rollups[granularity]
+    query = session.query(rollup.category, rollup.year, rollup.download,
+                          rollup.upload, rollup.count)
+    for column in rollup.rollup_columns:
+        query = query.filter(getattr(rollup, column) == bindparam(column))
+    return query.filter(rollup.category.in_(categories))
+
+
+def _get_rollup_key(postcode_parts):
+    """Get the rollup table key of split partial postcode parts.
+
+    Returns:
+        A mapping of the rollup columns to their values or None when any of
+        the postcode parts is unknown
+
+    """
+    parts = POSTCODE_CACHE.get(Session)
+    key = {'postcode_area_id': parts.areas.get(postcode_parts[0])}
+    if len(postcode_parts) > 1:
+        key['postcode_district_id'] = parts.districts.get(postcode_parts[1])
+    if len(postcode_parts) > 2:
+        key['postcode_sector'] = postcode_parts[2]
+
+    if None in key.values():
+        return None
+    return key
+
+
+def _get_rollup_averages(granularity, categories, rollup_key):
+    """Get averages from a rollup table.
+
+    The rollups of every requested category are fetched with a single baked
+    statement served from the rollup lookup index.
+
+        granularity: the rollup table, 'area', 'district' or 'sector'
+        categories: categories for database table selection. Example '0'
+        rollup_key: mapping of the rollup columns to their values
+
+    Returns:
+        Results as key value pairs containing connection, upload average,
+        download average and the number of postcodes averaged
+
+    """
+    categories = tuple(categories)
+    query = bakery(
+        lambda session: _rollup_query(session, granularity, categories),
+        granularity, categories)
+
+    entries = {}
+    for category, year, download, upload, count in query(Session()).params(
+            **rollup_key):
+        if category in entries and entries[category][0] > year:
+            continue
+        entries[category] = (year, download, upload, count)
+
+    results = []
+    for category in categories:
+        entry = entries.get(category)
+        if entry:
+            _, download, upload, count = entry
+            results.append({'connection': all_tables[category].reading_type,
+                            'upload': upload,
+                            'download': download,
+                            'count': count})
+
+    return results
+
+
+def _rollup_averages_view(request, granularity):
+    postcode = request.validated['postcode']
+    connection = request.validated['connection']
+
+    postcode_parts = split_postcode_prefix(postcode, granularity)
+    if postcode_parts is None:
+        raise HTTPBadRequest('Invalid postal code')
+
+    categories = _get_connection_categories(connection)
+    if categories is None:
+        raise HTTPBadRequest('Invalid connection type')
+
+    etag, modified = _get_validators(request, postcode_parts, connection)
+    if _is_not_modified(request, etag, modified):
+        return _not_modified(request, etag, modified)
+
+    results = []
+    rollup_key = _get_rollup_key(postcode_parts)
+    if rollup_key is not None:
+        results = _get_rollup_averages(granularity, categories, rollup_key)
+
+    _set_validators(request.response, etag, modified)
+    with timed_phase('serialize'):
+        return AverageRollupItemsSchema().serialize(results)
+
+
+def get_area_averages(request):
+    """Get postcode area average endpoint, e.g. 'AB'."""
+    return _rollup_averages_view(request, 'area')
+
+
+def get_district_averages(request):
+    """Get postcode district average endpoint, e.g. 'AB10'."""
+    return _rollup_averages_view(request, 'district')
+
+
+def get_sector_averages(request):
+    """Get postcode sector average endpoint, e.g. 'AB10 1'."""
+    return _rollup_averages_view(request, 'sector')
@@ -19,6 +19,7 @@ setup(name='demo-api',
           'httplib2',
           'docopt',
           'Jinja2',
+          'prometheus_client',
           'PyMySQL',
           'pyramid==1.10.4',
           'pyramid-jinja2==1.6',
@@ -37,4 +38,5 @@ setup(name='demo-api',
       [console_scripts]
       demo-api-initialisedb = demo.api.scripts.init_db:main
       demo-api-updatedb = demo.api.scripts.update_db:main
+      demo-api-snapshot = demo.api.scripts.snapshot:main
       """)